@@ -2,39 +2,234 @@
 A simple script to ask a question to an Amazon Bedrock
 knowledge base and Bedrock FM.
 
+Without arguments it prompts for questions until an empty line or EOF.
+With --batch it reads questions from a JSONL file (or - for stdin), one
+{"id": ..., "prompt": ...} object per line, answers them concurrently and
+writes {"id", "prompt", "answer", "citations", "latency"} lines to the
+output file. With --resume questions already answered in the output file
+are skipped, so an interrupted run can be picked up where it stopped.
+
 Pre-requisites:
 - Run the create_knowledge_base.py script to create a knowledge base
 
 Call with:
 python ask_bedrock_knowledge_base.py
+python ask_bedrock_knowledge_base.py --batch questions.jsonl --workers 16 --resume
+python ask_bedrock_knowledge_base.py --batch questions.jsonl --requests-per-minute 500
 """
-import boto3
+import argparse
+import json
+import os
+import sys
+import threading
+import time
 import utils
 
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger as log
 
+from flask_chatbot.utils import bedrock
+
 
 # Update as needed
 AWS_REGION = "us-east-1"
 MODEL_ID = "anthropic.claude-v2"
 KNOWLEDGE_BASE_NAME = "demo-rag"
+MODEL_ARN = f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{MODEL_ID}"
+DEFAULT_WORKERS = 8
+DEFAULT_OUTPUT = "answers.jsonl"
+# Times a question waits up to bedrock.ADMISSION_TIMEOUT_SECONDS for the
+# local rate limiter before it's given up on
+MAX_ADMISSION_ATTEMPTS = 6
 
-br_agent_client = boto3.client("bedrock-agent")
-br_agent_rt_client = boto3.client("bedrock-agent-runtime")
-log.info("Amazon Bedrock clients created")
 
+def get_agent_client():
+    return bedrock.get_client("bedrock-agent", AWS_REGION)
 
-def main():
-    log.info(f"Using Model ID: {MODEL_ID}")
-    prompt = input("Enter your prompt: ")
 
+def get_agent_runtime_client():
+    return bedrock.get_client("bedrock-agent-runtime", AWS_REGION)
+
+
+def ask(prompt: str, kb_id: str) -> dict:
+    start_time = time.monotonic()
+    for attempt in range(1, MAX_ADMISSION_ATTEMPTS + 1):
+        try:
+            response = bedrock.admitted_invoke_knowledge_base(
+                get_agent_runtime_client(), prompt, kb_id, MODEL_ARN
+            )
+            break
+        except bedrock.AdmissionTimeout:
+            # The local rate limiter is saturated, keep queueing for a while
+            if attempt == MAX_ADMISSION_ATTEMPTS:
+                raise
+    return {
+        "answer": response["output"]["text"],
+        "citations": bedrock.get_knowledge_base_citations(response),
+        "latency": round(time.monotonic() - start_time, 3),
+    }
+
+
+def read_questions(path: str):
+    """
+    Yields {"id", "prompt"} for every non-empty line. Lines may also be
+    plain JSON strings, in which case the line number is the ID.
+    """
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            question = json.loads(line)
+            if isinstance(question, str):
+                question = {"prompt": question}
+            yield {"id": question.get("id", line_number), "prompt": question["prompt"]}
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def read_answered_ids(path: str) -> set:
+    """
+    Returns the IDs that already have an answer in the output file. Failed
+    questions and a line cut off by an interruption are retried.
+    """
+    answered = set()
+    if not os.path.exists(path):
+        return answered
+    with open(path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if "answer" in result:
+                answered.add(result["id"])
+    return answered
+
+
+def ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read() == b"\n"
+
+
+def run_batch(input_path: str, output_path: str, workers: int, resume: bool) -> None:
+    kb_id = utils.get_knowledge_base_id(get_agent_client(), KNOWLEDGE_BASE_NAME)
+    if not kb_id:
+        # Every question would fail the same way
+        log.error(f"Knowledge base {KNOWLEDGE_BASE_NAME} not found")
+        exit(1)
+    answered = read_answered_ids(output_path) if resume else set()
+    if answered:
+        log.info(f"Resuming, skipping {len(answered)} answered questions")
+    questions = (q for q in read_questions(input_path) if q["id"] not in answered)
+
+    write_lock = threading.Lock()
+    counts = {"answered": 0, "failed": 0}
+    start_time = time.monotonic()
+    output = open(output_path, "a" if resume else "w")
+    if output.tell() and not ends_with_newline(output_path):
+        # Start a new line after a line cut off by an interruption
+        output.write("\n")
+
+    def answer(question: dict) -> None:
+        try:
+            result = {**question, **ask(question["prompt"], kb_id)}
+            counts_key = "answered"
+        except Exception as e:
+            log.error(f"Question {question['id']} failed: {e}")
+            result = {**question, "error": str(e)}
+            counts_key = "failed"
+        with write_lock:
+            # One flushed line per question so an interrupted run loses nothing
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            counts[counts_key] += 1
+            done = counts["answered"] + counts["failed"]
+            if done % 100 == 0:
+                log.info(f"{done} questions done")
+
+    # Only a few questions per worker are queued at a time so a huge input
+    # file is streamed rather than read up front
+    slots = threading.BoundedSemaphore(workers * 2)
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            for question in questions:
+                slots.acquire()
+                future = executor.submit(answer, question)
+                future.add_done_callback(lambda _: slots.release())
+    finally:
+        output.close()
+
+    elapsed = time.monotonic() - start_time
+    log.success(
+        f"Answered {counts['answered']} questions ({counts['failed']} failed) "
+        f"in {elapsed:.1f}s, results in {output_path}"
+    )
+
+
+def run_interactive() -> None:
+    log.info(f"Using Model ID: {MODEL_ID}")
     # Knowledge base created from the create_knowledge_base.py script
-    kb_id = utils.get_knowledge_base_id(br_agent_client, KNOWLEDGE_BASE_NAME)
-    model_arn = f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{MODEL_ID}"
+    kb_id = utils.get_knowledge_base_id(get_agent_client(), KNOWLEDGE_BASE_NAME)
+    if not kb_id:
+        log.error(f"Knowledge base {KNOWLEDGE_BASE_NAME} not found")
+        exit(1)
+    while True:
+        try:
+            prompt = input("Enter your prompt: ")
+        except EOFError:
+            break
+        if not prompt.strip():
+            break
+        try:
+            result = ask(prompt, kb_id)
+        except (bedrock.AdmissionTimeout, ClientError, BotoCoreError, ValueError) as e:
+            # e.g. throttled after every retry or a rejected prompt, ask another
+            log.error(f"Question failed: {e}")
+            continue
+        log.info(f"Answer: {result['answer']}")
+        for citation in result["citations"]:
+            log.info(f"Citation: {citation}")
+        log.info(f"Latency: {result['latency']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--batch", metavar="FILE", help="JSONL file of questions, - for stdin"
+    )
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSONL answers file")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Questions answered concurrently",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Append to the output file, skipping questions it already answers",
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=int,
+        help="The model's Bedrock quota, unlimited by default",
+    )
+    args = parser.parse_args()
+
+    # Concurrency follows --workers, admission only keeps under the quota
+    limits = {"max_concurrency": max(args.workers, 1)}
+    if args.requests_per_minute:
+        limits["requests_per_minute"] = args.requests_per_minute
+    bedrock.configure_admission(model_limits={MODEL_ID: limits})
 
-    response = utils.invoke_knowledge_base(br_agent_rt_client, prompt, kb_id, model_arn)
-    log.info(f"Response: {response}")
-    log.info(f"Answer: {response['output']['text']}")
+    if args.batch:
+        run_batch(args.batch, args.output, args.workers, args.resume)
+    else:
+        run_interactive()
 
 
 if __name__ == "__main__":
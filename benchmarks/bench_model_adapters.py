@@ -0,0 +1,76 @@
+"""
+Microbenchmark of the per-request encode/decode overhead of the model
+adapters against the dict copy + string replace + if-chain they replaced.
+No AWS calls are made.
+
+Call with:
+python -m benchmarks.bench_model_adapters
+"""
+import json
+import timeit
+
+from flask_chatbot.utils.adapters import get_model_adapter
+
+
+MODEL_ID = "anthropic.claude-v2"
+MESSAGE = "What is Retrieval Augmented Generation and when should I use it?"
+RESPONSE = json.dumps({"completion": " RAG grounds answers in your data." * 20})
+NUMBER = 100000
+
+# The previous implementation, kept here as the baseline
+LEGACY_BODY = {
+    "prompt": "\n\nHuman: ${{message}}\n\nAssistant:",
+    "max_tokens_to_sample": 300,
+    "temperature": 0.1,
+    "top_p": 0.9,
+}
+
+
+def legacy_encode(message: str) -> str:
+    invoke_body = dict(LEGACY_BODY)
+    invoke_body["prompt"] = invoke_body["prompt"].replace("${{message}}", message)
+    return json.dumps(invoke_body)
+
+
+def legacy_decode(model_id: str, response_body: dict) -> str:
+    model_key = model_id.split("-")[0]
+    if model_key == "amazon.titan":
+        return response_body["results"][0]["outputText"]
+    if model_key == "ai21.j2":
+        return response_body["completions"][0]["data"]["text"]
+    if model_key == "anthropic.claude":
+        return response_body["completion"]
+    return None
+
+
+def report(name: str, seconds: float) -> None:
+    print(f"{name:<24} {seconds / NUMBER * 1e6:8.3f} us/request")
+
+
+def main():
+    adapter = get_model_adapter(MODEL_ID)
+    assert json.loads(adapter.build_body(MESSAGE)) == json.loads(legacy_encode(MESSAGE))
+    response_body = json.loads(RESPONSE)
+
+    report("legacy encode", timeit.timeit(lambda: legacy_encode(MESSAGE), number=NUMBER))
+    report(
+        "adapter encode",
+        timeit.timeit(
+            lambda: get_model_adapter(MODEL_ID).build_body(MESSAGE), number=NUMBER
+        ),
+    )
+    report(
+        "legacy decode",
+        timeit.timeit(lambda: legacy_decode(MODEL_ID, response_body), number=NUMBER),
+    )
+    report(
+        "adapter decode",
+        timeit.timeit(
+            lambda: get_model_adapter(MODEL_ID).response_text(response_body),
+            number=NUMBER,
+        ),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Load generator for the Flask chatbot routes. Reports latency percentiles,
+throughput and error rates per route.
+
+Requests are sent open loop at --rps whatever the response times are, and
+each route runs in turn for --duration seconds. Latency is measured from
+when a request was due, so requests queued behind a slow server count
+their wait too.
+
+Without --url the app is started in this process on the stubbed Bedrock
+clients (see benchmarks/stub_bedrock.py). Pass --url to load a server
+started with benchmarks.stub_server instead, so the load generator doesn't
+share the server's GIL.
+
+Call with:
+python -m benchmarks.load_generator --rps 20 --duration 30
+python -m benchmarks.load_generator --url http://127.0.0.1:5200 --routes rag --rps 50
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import stub_server
+from benchmarks.stub_bedrock import StubBedrock, add_stub_arguments, get_stub_settings
+
+
+ROUTES = {
+    "model": "/get_bedrock_response",
+    "rag": "/get_bedrock_rag_response",
+    "index": "/",
+    "model_stream": "/get_bedrock_stream_response",
+    "rag_stream": "/get_bedrock_rag_stream_response",
+}
+DEFAULT_ROUTES = ["model", "rag", "index"]
+DEFAULT_MODEL_ID = "anthropic.claude-v2"
+PERCENTILES = [50, 95, 99]
+SSE_ERROR_EVENT = b"event: error\n"
+
+# Asked again and again with --repeat-ratio, to measure cache hits
+POPULAR_PROMPTS = [
+    "What is Amazon Bedrock?",
+    "What is Retrieval Augmented Generation?",
+    "How do I create a knowledge base?",
+    "Which foundation models are available?",
+    "How is my data kept private?",
+]
+
+
+def get_prompt(run_id: str, number: int, repeat_ratio: float) -> str:
+    if random.random() < repeat_ratio:
+        return random.choice(POPULAR_PROMPTS)
+    # The run ID keeps a long-running server's caches from answering
+    return f"Question {number} of load test {run_id}: what is topic {number}?"
+
+
+def get_request_url(base_url: str, route: str, model_id: str, prompt: str) -> str:
+    path = ROUTES[route]
+    if route == "index":
+        return base_url + path
+    query = urllib.parse.urlencode({"model_id": model_id, "chat_input_val": prompt})
+    return f"{base_url}{path}?{query}"
+
+
+def send(url: str, due: float, timeout: float) -> dict:
+    """
+    Sends one GET and reads the whole response. Times are in seconds from
+    when the request was due, time to first byte being when the headers
+    arrived (the first token on the streaming routes). Streams that end in
+    an error event count as failed even though their status is 200.
+    """
+    result = {"status": None, "ttfb": None, "latency": None}
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            result["ttfb"] = time.perf_counter() - due
+            body = response.read()
+            result["status"] = response.status
+            if SSE_ERROR_EVENT in body:
+                result["status"] = "stream_error"
+    except urllib.error.HTTPError as e:
+        result["status"] = e.code
+    except Exception as e:
+        result["status"] = type(e).__name__
+    result["latency"] = time.perf_counter() - due
+    return result
+
+
+def percentile(sorted_values: list, p: float):
+    """
+    Nearest-rank percentile of an ascending list, None when it's empty
+    """
+    if not sorted_values:
+        return None
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(1, rank)) - 1]
+
+
+def summarize(route: str, results: list, elapsed: float) -> dict:
+    ok = []
+    errors = {}
+    for result in results:
+        status = result["status"]
+        if isinstance(status, int) and status < 400:
+            ok.append(result)
+        else:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    latencies = sorted(r["latency"] for r in ok)
+    ttfbs = sorted(r["ttfb"] for r in ok)
+    summary = {
+        "route": route,
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": 1 - len(ok) / len(results) if results else 0.0,
+        "errors": errors,
+        "throughput": len(ok) / elapsed if elapsed else 0.0,
+        "ttfb_p50_ms": None,
+        "max_ms": latencies[-1] * 1000 if latencies else None,
+    }
+    if ttfbs:
+        summary["ttfb_p50_ms"] = percentile(ttfbs, 50) * 1000
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary[f"p{p}_ms"] = value * 1000 if value is not None else None
+    return summary
+
+
+def run_route(
+    base_url: str,
+    route: str,
+    rps: float,
+    duration: float,
+    model_id: str,
+    repeat_ratio: float,
+    timeout: float,
+    max_in_flight: int,
+) -> dict:
+    """
+    Sends rps requests per second to the route for duration seconds and
+    waits for all of them to finish
+    """
+    run_id = uuid.uuid4().hex[:8]
+    results = []
+    results_lock = threading.Lock()
+
+    def record(url: str, due: float) -> None:
+        result = send(url, due, timeout)
+        with results_lock:
+            results.append(result)
+
+    total = max(1, int(rps * duration))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_in_flight, thread_name_prefix="load") as executor:
+        for number in range(total):
+            due = start + number / rps
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            prompt = get_prompt(run_id, number, repeat_ratio)
+            url = get_request_url(base_url, route, model_id, prompt)
+            executor.submit(record, url, due)
+    return summarize(route, results, time.perf_counter() - start)
+
+
+def format_ms(value) -> str:
+    return f"{value:8.0f}" if value is not None else f"{'-':>8}"
+
+
+def print_report(summaries: list, rps: float) -> None:
+    columns = ["p50", "p95", "p99", "max", "ttfb50"]
+    header = f"{'Route':<14} {'Sent':>6} {'OK':>6} {'Err %':>6} {'Req/s':>7}"
+    print(f"\nTarget {rps:g} req/s, latencies in ms")
+    print(header + "".join(f"{column:>8}" for column in columns))
+    for s in summaries:
+        row = (
+            f"{s['route']:<14} {s['requests']:>6} {s['ok']:>6} "
+            f"{s['error_rate'] * 100:>6.1f} {s['throughput']:>7.1f}"
+        )
+        values = [s["p50_ms"], s["p95_ms"], s["p99_ms"], s["max_ms"], s["ttfb_p50_ms"]]
+        print(row + "".join(format_ms(value) for value in values))
+    for s in summaries:
+        if s["errors"]:
+            print(f"{s['route']} errors: {s['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--url", help="Server to load, by default the app runs in this process"
+    )
+    parser.add_argument(
+        "--routes", nargs="+", choices=list(ROUTES), default=DEFAULT_ROUTES
+    )
+    parser.add_argument("--rps", type=float, default=10, help="Target requests/s")
+    parser.add_argument(
+        "--duration", type=float, default=30, help="Seconds per route"
+    )
+    parser.add_argument("--model-id", default=DEFAULT_MODEL_ID)
+    parser.add_argument(
+        "--repeat-ratio",
+        type=float,
+        default=0.0,
+        help="Fraction of requests asking a popular question again",
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=512,
+        help="Requests outstanding at once, later ones wait their turn",
+    )
+    parser.add_argument("--output", help="Also write the results to a JSON file")
+    parser.add_argument("--log-level", default="WARNING")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    stub = server = None
+    base_url = args.url
+    if base_url is None:
+        stub_server.configure_logging(args.log_level)
+        stub = StubBedrock(**get_stub_settings(args))
+        server = stub_server.start_server(stub_server.load_app(stub), port=0)
+        base_url = f"http://{stub_server.DEFAULT_HOST}:{server.port}"
+    base_url = base_url.rstrip("/")
+
+    summaries = []
+    try:
+        for route in args.routes:
+            print(f"Loading {ROUTES[route]} at {args.rps:g} req/s")
+            summaries.append(
+                run_route(
+                    base_url,
+                    route,
+                    args.rps,
+                    args.duration,
+                    args.model_id,
+                    args.repeat_ratio,
+                    args.timeout,
+                    args.max_in_flight,
+                )
+            )
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    print_report(summaries, args.rps)
+    if stub is not None:
+        print(f"Stubbed Bedrock: {stub.stats()}")
+    if args.output:
+        report = {
+            "args": vars(args),
+            "results": summaries,
+            "stub": stub.stats() if stub is not None else None,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
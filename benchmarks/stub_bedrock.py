@@ -0,0 +1,435 @@
+"""
+Local stand-in for the bedrock, bedrock-runtime, bedrock-agent and
+bedrock-agent-runtime clients so the Flask app can be load tested without
+AWS.
+
+Every call sleeps for a configurable latency (with jitter) and returns a
+response shaped like the real one. Streamed answers arrive one token at a
+time, and calls can be throttled at random or once too many are in flight,
+the same way Bedrock answers with ThrottlingException. The stub clients
+are registered in the app's client registry before the app is imported.
+"""
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+
+# Seconds each stubbed call takes before jitter, and the fault injection
+# settings. Every key can be overridden on the command line.
+DEFAULT_STUB_SETTINGS = {
+    "control_plane_latency": 0.05,
+    "embedding_latency": 0.03,
+    "retrieve_latency": 0.15,
+    "first_token_latency": 0.4,
+    "token_latency": 0.02,
+    "retrieve_and_generate_latency": 2.0,
+    # Each latency is scaled by a random factor in [1 - jitter, 1 + jitter]
+    "jitter": 0.2,
+    # Fraction of generations that take slow_call_factor times longer, for
+    # a long latency tail
+    "slow_call_rate": 0.0,
+    "slow_call_factor": 10.0,
+    "output_tokens": 60,
+    # Fraction of data plane calls answered with ThrottlingException
+    "throttle_rate": 0.0,
+    # Data plane calls over this many in flight are throttled, 0 for no limit
+    "max_concurrency": 0,
+}
+
+KNOWLEDGE_BASE_NAME = "demo-rag"
+KNOWLEDGE_BASE_ID = "STUBKB0001"
+DATA_SOURCE_ID = "STUBDS0001"
+EMBEDDING_DIMENSION = 1536
+CHUNK_TEXT = "Amazon Bedrock knowledge bases ground answers in your own documents. "
+
+# (model ID, streams responses) listed by the stub bedrock client
+STUB_MODELS = [
+    ("amazon.titan-text-express-v1", True),
+    ("amazon.titan-text-lite-v1", True),
+    ("ai21.j2-ultra-v1", False),
+    ("anthropic.claude-instant-v1", True),
+    ("anthropic.claude-v2", True),
+    ("anthropic.claude-v2:1", True),
+    ("anthropic.claude-3-haiku-20240307-v1:0", True),
+    ("cohere.command-text-v14", True),
+    ("meta.llama2-13b-chat-v1", True),
+    ("mistral.mistral-7b-instruct-v0:2", True),
+]
+
+# Where each model family puts the text in an invoke_model response and in
+# a stream chunk, most specific prefix first
+RESPONSE_FORMATS = [
+    ("anthropic.claude-3", ("content", 0, "text"), ("delta", "text")),
+    ("anthropic.claude", ("completion",), ("completion",)),
+    ("amazon.titan", ("results", 0, "outputText"), ("outputText",)),
+    ("ai21.j2", ("completions", 0, "data", "text"), ("completions", 0, "data", "text")),
+    ("cohere.command-r", ("text",), ("text",)),
+    ("cohere.command", ("generations", 0, "text"), ("text",)),
+    ("meta.llama", ("generation",), ("generation",)),
+    ("mistral.", ("outputs", 0, "text"), ("outputs", 0, "text")),
+]
+
+ERROR_STATUS_CODES = {
+    "ThrottlingException": 429,
+    "ValidationException": 400,
+    "ResourceNotFoundException": 404,
+}
+
+
+# Modeled exceptions are ClientError subclasses, like client.exceptions.X
+STUB_EXCEPTIONS = SimpleNamespace(
+    **{code: type(code, (ClientError,), {}) for code in ERROR_STATUS_CODES}
+)
+
+
+def make_client_error(code: str, message: str, operation: str) -> ClientError:
+    error_class = getattr(STUB_EXCEPTIONS, code, ClientError)
+    return error_class(
+        {
+            "Error": {"Code": code, "Message": message},
+            "ResponseMetadata": {"HTTPStatusCode": ERROR_STATUS_CODES.get(code, 400)},
+        },
+        operation,
+    )
+
+
+def nest(path: tuple, value):
+    """
+    Builds the structure that path walks to reach value, e.g.
+    ("results", 0, "outputText") -> {"results": [{"outputText": value}]}
+    """
+    for key in reversed(path):
+        value = [value] if isinstance(key, int) else {key: value}
+    return value
+
+
+def get_response_format(model_id: str) -> tuple:
+    for prefix, response_path, chunk_path in RESPONSE_FORMATS:
+        if model_id.startswith(prefix):
+            return response_path, chunk_path
+    raise make_client_error(
+        "ValidationException", f"The stub has no format for {model_id}", "InvokeModel"
+    )
+
+
+def fake_embedding(text: str) -> list:
+    # Deterministic so the same question always embeds the same way
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+    rng = random.Random(seed)
+    return [rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSION)]
+
+
+def get_token_headers(input_tokens: int, output_tokens: int, latency: float) -> dict:
+    return {
+        "x-amzn-bedrock-input-token-count": str(input_tokens),
+        "x-amzn-bedrock-output-token-count": str(output_tokens),
+        "x-amzn-bedrock-invocation-latency": str(int(latency * 1000)),
+    }
+
+
+class StubBedrock:
+    """
+    Shared state of the stub clients: the settings, per operation call
+    counts and the in-flight count behind the concurrency limit
+    """
+
+    def __init__(self, **settings):
+        unknown = set(settings) - set(DEFAULT_STUB_SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown stub settings {sorted(unknown)}")
+        self.settings = {**DEFAULT_STUB_SETTINGS, **settings}
+        self.calls = {}
+        self.throttled = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def sleep(self, name: str, scale: float = 1.0) -> float:
+        jitter = self.settings["jitter"]
+        seconds = self.settings[name] * scale * random.uniform(1 - jitter, 1 + jitter)
+        time.sleep(max(0.0, seconds))
+        return seconds
+
+    def slow_call_scale(self) -> float:
+        if random.random() < self.settings["slow_call_rate"]:
+            return self.settings["slow_call_factor"]
+        return 1.0
+
+    def count(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def admit(self, operation: str) -> None:
+        """
+        Takes an in-flight slot for a data plane call or raises
+        ThrottlingException. Every admitted call must call release().
+        """
+        self.count(operation)
+        max_concurrency = self.settings["max_concurrency"]
+        with self._lock:
+            throttled = random.random() < self.settings["throttle_rate"] or (
+                max_concurrency and self.in_flight >= max_concurrency
+            )
+            if throttled:
+                self.throttled += 1
+            else:
+                self.in_flight += 1
+        if throttled:
+            raise make_client_error("ThrottlingException", "Rate exceeded", operation)
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def client(self, service: str, region: str):
+        return STUB_CLIENTS[service](self, region)
+
+    def install(self, bedrock, region: str) -> None:
+        """
+        Registers a stub client for every Bedrock service in the app's
+        client registry (the app's utils.bedrock module)
+        """
+        for service in STUB_CLIENTS:
+            bedrock.register_client(service, region, self.client(service, region))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": dict(sorted(self.calls.items())),
+                "throttled": self.throttled,
+                "in_flight": self.in_flight,
+            }
+
+
+class StubClient:
+    def __init__(self, stub: StubBedrock, region: str):
+        self.stub = stub
+        self.meta = SimpleNamespace(region_name=region)
+        self.exceptions = STUB_EXCEPTIONS
+
+    def can_paginate(self, operation: str) -> bool:
+        # Every listing fits in one page, read without a paginator
+        return False
+
+
+class StubBedrockClient(StubClient):
+    def list_foundation_models(self, **kwargs) -> dict:
+        self.stub.count("list_foundation_models")
+        self.stub.sleep("control_plane_latency")
+        return {
+            "modelSummaries": [
+                {
+                    "modelId": model_id,
+                    "modelName": model_id,
+                    "providerName": model_id.split(".")[0],
+                    "inputModalities": ["TEXT"],
+                    "outputModalities": ["TEXT"],
+                    "responseStreamingSupported": streaming,
+                }
+                for model_id, streaming in STUB_MODELS
+            ]
+        }
+
+
+class StubBedrockRuntimeClient(StubClient):
+    def invoke_model(self, modelId: str, body: str, **kwargs) -> dict:
+        self.stub.admit("invoke_model")
+        try:
+            if "embed" in modelId:
+                latency = self.stub.sleep("embedding_latency")
+                embedding = fake_embedding(json.loads(body)["inputText"])
+                response_body = {"embedding": embedding}
+                output_tokens = 0
+            else:
+                response_path, _ = get_response_format(modelId)
+                output_tokens = self.stub.settings["output_tokens"]
+                scale = self.stub.slow_call_scale()
+                latency = self.stub.sleep("first_token_latency", scale)
+                latency += self.stub.sleep("token_latency", output_tokens * scale)
+                response_body = nest(response_path, "token " * output_tokens)
+        finally:
+            self.stub.release()
+        headers = get_token_headers(len(body) // 4, output_tokens, latency)
+        return {
+            "body": io.BytesIO(json.dumps(response_body).encode()),
+            "contentType": "application/json",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": headers},
+        }
+
+    def invoke_model_with_response_stream(
+        self, modelId: str, body: str, **kwargs
+    ) -> dict:
+        _, chunk_path = get_response_format(modelId)
+        self.stub.admit("invoke_model_with_response_stream")
+        try:
+            # Bedrock answers once the first token is ready
+            self.stub.sleep("first_token_latency")
+        except BaseException:
+            self.stub.release()
+            raise
+        return {
+            "body": self._stream(modelId, body, chunk_path),
+            "contentType": "application/json",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": {}},
+        }
+
+    def _stream(self, model_id: str, body: str, chunk_path: tuple):
+        start = time.perf_counter()
+        output_tokens = self.stub.settings["output_tokens"]
+        try:
+            for i in range(output_tokens):
+                if i:
+                    self.stub.sleep("token_latency")
+                chunk = nest(chunk_path, "token ")
+                if model_id.startswith("anthropic.claude-3"):
+                    chunk["type"] = "content_block_delta"
+                yield {"chunk": {"bytes": json.dumps(chunk).encode()}}
+            # Like Bedrock, the last chunk carries the invocation metrics
+            metrics = {
+                "inputTokenCount": len(body) // 4,
+                "outputTokenCount": output_tokens,
+                "invocationLatency": int((time.perf_counter() - start) * 1000),
+            }
+            last = {"amazon-bedrock-invocationMetrics": metrics}
+            yield {"chunk": {"bytes": json.dumps(last).encode()}}
+        finally:
+            self.stub.release()
+
+
+class StubBedrockAgentClient(StubClient):
+    def list_knowledge_bases(self, **kwargs) -> dict:
+        self.stub.count("list_knowledge_bases")
+        self.stub.sleep("control_plane_latency")
+        return {
+            "knowledgeBaseSummaries": [
+                {
+                    "knowledgeBaseId": KNOWLEDGE_BASE_ID,
+                    "name": KNOWLEDGE_BASE_NAME,
+                    "status": "ACTIVE",
+                    "updatedAt": datetime(2024, 1, 1, tzinfo=timezone.utc),
+                }
+            ]
+        }
+
+    def get_knowledge_base(self, knowledgeBaseId: str) -> dict:
+        self.stub.count("get_knowledge_base")
+        self.stub.sleep("control_plane_latency")
+        if knowledgeBaseId != KNOWLEDGE_BASE_ID:
+            raise make_client_error(
+                "ResourceNotFoundException",
+                "Knowledge base not found",
+                "GetKnowledgeBase",
+            )
+        return {
+            "knowledgeBase": {
+                "knowledgeBaseId": KNOWLEDGE_BASE_ID,
+                "name": KNOWLEDGE_BASE_NAME,
+                "knowledgeBaseArn": (
+                    f"arn:aws:bedrock:{self.meta.region_name}:000000000000:"
+                    f"knowledge-base/{KNOWLEDGE_BASE_ID}"
+                ),
+                "status": "ACTIVE",
+            }
+        }
+
+    def list_data_sources(self, knowledgeBaseId: str, **kwargs) -> dict:
+        self.stub.count("list_data_sources")
+        self.stub.sleep("control_plane_latency")
+        return {
+            "dataSourceSummaries": [
+                {
+                    "dataSourceId": DATA_SOURCE_ID,
+                    "knowledgeBaseId": knowledgeBaseId,
+                    "name": f"{KNOWLEDGE_BASE_NAME}-data-source",
+                    "status": "AVAILABLE",
+                }
+            ]
+        }
+
+    def list_ingestion_jobs(self, knowledgeBaseId: str, dataSourceId: str, **kwargs):
+        self.stub.count("list_ingestion_jobs")
+        self.stub.sleep("control_plane_latency")
+        return {
+            "ingestionJobSummaries": [
+                {
+                    "ingestionJobId": "STUBJOB001",
+                    "knowledgeBaseId": knowledgeBaseId,
+                    "dataSourceId": dataSourceId,
+                    "status": "COMPLETE",
+                    "startedAt": datetime(2024, 1, 1, tzinfo=timezone.utc),
+                }
+            ]
+        }
+
+
+def get_retrieval_results(count: int) -> list:
+    return [
+        {
+            "content": {"text": CHUNK_TEXT * 10},
+            "location": {
+                "type": "S3",
+                "s3Location": {"uri": f"s3://stub-rag-data/document-{i}.txt"},
+            },
+            "score": 1.0 - i / 100,
+        }
+        for i in range(count)
+    ]
+
+
+class StubBedrockAgentRuntimeClient(StubClient):
+    def retrieve(
+        self, knowledgeBaseId: str, retrievalQuery: dict, retrievalConfiguration=None
+    ) -> dict:
+        self.stub.admit("retrieve")
+        try:
+            self.stub.sleep("retrieve_latency")
+        finally:
+            self.stub.release()
+        config = (retrievalConfiguration or {}).get("vectorSearchConfiguration", {})
+        count = config.get("numberOfResults", 5)
+        return {"retrievalResults": get_retrieval_results(count)}
+
+    def retrieve_and_generate(
+        self, input: dict, retrieveAndGenerateConfiguration: dict, sessionId=None
+    ) -> dict:
+        self.stub.admit("retrieve_and_generate")
+        try:
+            self.stub.sleep("retrieve_and_generate_latency")
+        finally:
+            self.stub.release()
+        output_tokens = self.stub.settings["output_tokens"]
+        return {
+            "output": {"text": "token " * output_tokens},
+            "citations": [{"retrievedReferences": get_retrieval_results(3)}],
+            "sessionId": sessionId or str(uuid.uuid4()),
+        }
+
+
+STUB_CLIENTS = {
+    "bedrock": StubBedrockClient,
+    "bedrock-runtime": StubBedrockRuntimeClient,
+    "bedrock-agent": StubBedrockAgentClient,
+    "bedrock-agent-runtime": StubBedrockAgentRuntimeClient,
+}
+
+
+def add_stub_arguments(parser) -> None:
+    """
+    Adds a --setting-name option for every stub setting
+    """
+    group = parser.add_argument_group("stubbed Bedrock")
+    for name, default in DEFAULT_STUB_SETTINGS.items():
+        group.add_argument(
+            f"--{name.replace('_', '-')}", type=type(default), default=default
+        )
+
+
+def get_stub_settings(args) -> dict:
+    return {name: getattr(args, name) for name in DEFAULT_STUB_SETTINGS}
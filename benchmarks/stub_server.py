@@ -0,0 +1,85 @@
+"""
+Serves the Flask chatbot with the stubbed Bedrock clients, so it can be
+load tested (or clicked through) without AWS.
+
+Call with:
+python -m benchmarks.stub_server --port 5200 --first-token-latency 0.8
+"""
+import argparse
+import importlib
+import logging
+import os
+import sys
+import threading
+
+from loguru import logger as log
+from werkzeug.serving import make_server
+
+from benchmarks.stub_bedrock import StubBedrock, add_stub_arguments, get_stub_settings
+
+
+FLASK_CHATBOT_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flask_chatbot"
+)
+# Same region as AWS_REGION in flask_chatbot/app.py
+AWS_REGION = "us-east-1"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5200
+
+
+def load_app(stub: StubBedrock, region: str = AWS_REGION):
+    """
+    Imports flask_chatbot/app.py the way `python app.py` does, with the stub
+    clients registered first so startup and every request use them
+    """
+    if FLASK_CHATBOT_DIR not in sys.path:
+        sys.path.insert(0, FLASK_CHATBOT_DIR)
+    bedrock = importlib.import_module("utils.bedrock")
+    stub.install(bedrock, region)
+    return importlib.import_module("app").app
+
+
+def start_server(app, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    """
+    Serves the app from a daemon thread, one thread per request like
+    app.run(). Call shutdown() on the returned server to stop it.
+    """
+    server = make_server(host, port, app, threaded=True)
+    thread = threading.Thread(
+        target=server.serve_forever, name="stub-server", daemon=True
+    )
+    thread.start()
+    print(f"Serving the stubbed app on http://{host}:{server.port}")
+    return server
+
+
+def configure_logging(level: str) -> None:
+    # The app logs every request and answer at INFO, which would dominate
+    # the measurements
+    log.remove()
+    log.add(sys.stderr, level=level)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--log-level", default="WARNING")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    configure_logging(args.log_level)
+    stub = StubBedrock(**get_stub_settings(args))
+    server = make_server(args.host, args.port, load_app(stub), threaded=True)
+    print(f"Serving the stubbed app on http://{args.host}:{server.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Stubbed Bedrock: {stub.stats()}")
+
+
+if __name__ == "__main__":
+    main()
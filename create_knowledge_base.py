@@ -8,22 +8,19 @@ AWS Resources Created:
 - Amazon OpenSearch Service collection index
 - Amazon OpenSearch Service policies
 
-# Important note
-This script is not handling next tokens for pagination
-from AWS Boto3 API calls. If you have more than 123 results
-for your knowledge base and or data sources, you will need to
-update this script to handle pagination.
-
 Call with:
 python create_knowledge_base.py
 """
+import argparse
 import boto3
+import index_profiles
 import json
-import time
 import utils
+import waiters
+
+from provisioning import Step, log_plan, run_steps
 
-from opensearchpy import OpenSearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
+from opensearchpy.exceptions import AuthorizationException
 from loguru import logger as log
 
 
@@ -32,33 +29,20 @@ DEBUG = False  # True
 if DEBUG:
     boto3.set_stream_logger(name="botocore")
 
-bedrock_client = boto3.client("bedrock-agent")
-os_client = boto3.client("opensearchserverless")
+# Clients are created on first use
+bedrock_client = utils.LazyClient("bedrock-agent")
+os_client = utils.LazyClient("opensearchserverless")
 
 # Constants
+# The bucket and role ARN are looked up on first use via shared_consts
 shared_consts = utils.get_shared_consts()
 KB_NAME = shared_consts["KB_NAME"]
 KB_DESCRIPTION = shared_consts["KB_DESCRIPTION"]
-KB_BUCKET_NAME = shared_consts["KB_BUCKET_NAME"]
-KB_BUCKET_ARN = shared_consts["KB_BUCKET_ARN"]
+AWS_REGION = shared_consts["AWS_REGION"]
 BEDROCK_FM = shared_consts["BEDROCK_FM"]
-BEDROCK_EMBED_MODEL_ARN = shared_consts["BEDROCK_EMBED_MODEL_ARN"]
 OS_COLLECTION_NAME = shared_consts["OS_COLLECTION_NAME"]
 OS_VECTOR_PREFIX = shared_consts["OS_VECTOR_PREFIX"]
 OS_POLICY_NAME = shared_consts["OS_POLICY_NAME"]
-KB_ROLE_NAME = shared_consts["KB_ROLE_NAME"]
-KB_ROLE_ARN = shared_consts["KB_ROLE_ARN"]
-
-# Init AWS4Auth for OpenSearch
-client = boto3.client("opensearchserverless")
-credentials = boto3.Session().get_credentials()
-awsauth = AWS4Auth(
-    credentials.access_key,
-    credentials.secret_key,
-    "us-east-1",
-    "aoss",
-    session_token=credentials.token,
-)
 
 
 def create_opensearch_access_policy(name: str) -> None:
@@ -89,7 +73,7 @@ def create_opensearch_access_policy(name: str) -> None:
             },
         ],
         "Principal": [
-            f"{KB_ROLE_ARN}",
+            shared_consts["KB_ROLE_ARN"],
             "arn:aws:sts::576720715620:assumed-role/AWSReservedSSO_AdministratorAccess_b2d69c4e698ab806/cooper.miller",
             "arn:aws:iam::576720715620:user/cm-cli-admin",
         ],
@@ -133,86 +117,112 @@ def create_opensearch_network_security_policy(name: str) -> None:
     log.info(f"Created OpenSearch network security policy: {policy_name}")
 
 
-def create_opensearch_collection() -> str:
-    os_client.create_collection(
-        description=KB_DESCRIPTION,
-        name=OS_COLLECTION_NAME,
-        standbyReplicas="DISABLED",
-        type="VECTORSEARCH",
-    )
+def create_opensearch_collection() -> dict:
+    collection_data = utils.get_opensearch_collection(os_client, OS_COLLECTION_NAME)
+    if collection_data:
+        log.info("Collection found... Using it")
+    else:
+        log.info("Collection not found... Creating it now")
+        os_client.create_collection(
+            description=KB_DESCRIPTION,
+            name=OS_COLLECTION_NAME,
+            standbyReplicas="DISABLED",
+            type="VECTORSEARCH",
+        )
+    # Also covers a collection still being created by an interrupted run
     collection_status = wait_for_collection_creation()
     if collection_status != "ACTIVE":
-        log.error("Failed to successfully create collection...")
-        exit(1)
+        raise waiters.WaiterError(
+            f"Failed to successfully create collection, status: {collection_status}"
+        )
+    collection_data = utils.get_opensearch_collection(os_client, OS_COLLECTION_NAME)
+    log.info(f"Collection Host: {collection_data['host']}")
+    log.info(f"Collection ARN: {collection_data['arn']}")
+    return collection_data
+
 
+def wait_for_collection_creation() -> str:
+    """Waits for the collection to leave the CREATING state"""
+    status = {}
 
-def wait_for_collection_creation() -> bool:
-    """Waits for the collection to become active"""
-    response = os_client.batch_get_collection(names=[OS_COLLECTION_NAME])
-    while (response["collectionDetails"][0]["status"]) == "CREATING":
-        log.info("Creating collection...")
-        time.sleep(30)
+    def probe():
         response = os_client.batch_get_collection(names=[OS_COLLECTION_NAME])
-    return response["collectionDetails"][0]["status"]
-
-
-def index_opensearch_collection_data(host: str):
-    """Create an index and add some sample data"""
-    os_collection_client = OpenSearch(
-        hosts=[{"host": host, "port": 443}],
-        http_auth=awsauth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-        timeout=300,
+        status["value"] = response["collectionDetails"][0]["status"]
+        return status["value"] != "CREATING"
+
+    waiters.wait_until(probe, "OpenSearch collection", 900, initial_delay=5)
+    return status["value"]
+
+
+def wait_for_index_access(os_collection_client, index_name: str) -> None:
+    """Waits for the data access rules to be enforced for this principal"""
+
+    def probe():
+        try:
+            os_collection_client.indices.exists(index_name)
+            return True
+        except AuthorizationException:
+            return False
+
+    waiters.wait_until(probe, "OpenSearch data access rules", 300)
+
+
+def wait_for_index(os_collection_client, index_name: str) -> None:
+    waiters.wait_until(
+        lambda: os_collection_client.indices.exists(index_name),
+        "OpenSearch index",
+        300,
     )
+
+
+def index_opensearch_collection_data(
+    host: str, profile: str, dimension: int, embed_model_id: str
+):
+    """Create the vector index the knowledge base writes to"""
+    os_collection_client = utils.get_opensearch_collection_client(host)
+    index_name = f"{OS_VECTOR_PREFIX}-index"
     # It can take up to a minute for data access rules to be enforced
-    log.info("Waiting for data access rules to be enforced (up to a minute)...")
-    time.sleep(45)
+    wait_for_index_access(os_collection_client, index_name)
+    if os_collection_client.indices.exists(index_name):
+        log.info("Index found... Using it")
+        return
 
     # Create index
+    log.info(f"Creating a {dimension} dimension index with the '{profile}' profile")
     response = os_collection_client.indices.create(
-        f"{OS_VECTOR_PREFIX}-index",
-        body={
-            "settings": {
-                "index": {
-                    "knn.algo_param": {"ef_search": "512"},
-                    "knn": "true",
-                }
-            },
-            "mappings": {
-                "properties": {
-                    "AMAZON_BEDROCK_METADATA": {"type": "text", "index": False},
-                    "AMAZON_BEDROCK_TEXT_CHUNK": {"type": "text"},
-                    "bedrock-knowledge-base-default-vector": {
-                        "type": "knn_vector",
-                        "dimension": 1536,
-                        "method": {
-                            "engine": "nmslib",
-                            "space_type": "cosinesimil",
-                            "name": "hnsw",
-                            "parameters": {},
-                        },
-                    },
-                }
-            },
-        },
+        index_name,
+        body=index_profiles.get_index_body(
+            profile, dimension, f"{OS_VECTOR_PREFIX}-vector", embed_model_id
+        ),
     )
     log.info(f"Index response: {response}")
+    wait_for_index(os_collection_client, index_name)
 
 
-def create_knowledge_base(collection_arn: str) -> str:
+def create_knowledge_base(
+    collection_arn: str, embed_model_id: str, dimensions: int = None
+) -> str:
+    kb_id = utils.get_knowledge_base_id(bedrock_client, KB_NAME)
+    if kb_id:
+        log.info(f"Knowledge base found... Using {kb_id}")
+        return kb_id
+    log.info("Knowledge base not found... Creating it now")
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/bedrock-agent/client/create_knowledge_base.html
     storage_prefix = "bedrock-knowledge-base-default"
+    embed_model_arn = f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{embed_model_id}"
+    vector_config = {"embeddingModelArn": embed_model_arn}
+    if dimensions is not None:
+        # Reduced dimensions need a boto3 release with embeddingModelConfiguration
+        vector_config["embeddingModelConfiguration"] = {
+            "bedrockEmbeddingModelConfiguration": {"dimensions": dimensions}
+        }
     response = bedrock_client.create_knowledge_base(
         name=KB_NAME,
         description=KB_DESCRIPTION,
-        roleArn=KB_ROLE_ARN,
+        roleArn=shared_consts["KB_ROLE_ARN"],
         knowledgeBaseConfiguration={
             "type": "VECTOR",
-            "vectorKnowledgeBaseConfiguration": {
-                "embeddingModelArn": BEDROCK_EMBED_MODEL_ARN
-            },
+            "vectorKnowledgeBaseConfiguration": vector_config,
         },
         storageConfiguration={
             "type": "OPENSEARCH_SERVERLESS",
@@ -229,10 +239,25 @@ def create_knowledge_base(collection_arn: str) -> str:
     )
     if "failureReasons" in response:
         log.error(f"Error creating knowledge base: {response['failureReasons']}")
-    return response["knowledgeBase"]["knowledgeBaseId"]
+    kb_id = response["knowledgeBase"]["knowledgeBaseId"]
+    utils.wait_for_operation(
+        bedrock_client.get_knowledge_base,
+        ["knowledgeBase", "status"],
+        "ACTIVE",
+        300,
+        failure_values=("FAILED",),
+        knowledgeBaseId=kb_id,
+    )
+    return kb_id
 
 
 def create_data_source(kb_id: str) -> str:
+    kb_ds_ids = utils.get_knowledge_base_data_source_ids(bedrock_client, kb_id)
+    # Default to first ds since we only create one
+    if kb_ds_ids:
+        log.info(f"Data source found... Using {kb_ds_ids[0]['id']}")
+        return kb_ds_ids[0]["id"]
+    log.info("Data source not found... Creating it now")
     response = bedrock_client.create_data_source(
         knowledgeBaseId=kb_id,
         name=f"{KB_NAME}-data-source",
@@ -240,7 +265,7 @@ def create_data_source(kb_id: str) -> str:
         dataSourceConfiguration={
             "type": "S3",
             "s3Configuration": {
-                "bucketArn": KB_BUCKET_ARN,
+                "bucketArn": shared_consts["KB_BUCKET_ARN"],
             },
         },
     )
@@ -248,65 +273,99 @@ def create_data_source(kb_id: str) -> str:
 
 
 def ingest_data_source_into_knowledge_base(kb_id: str, data_source_id: str) -> None:
-    response = bedrock_client.start_ingestion_job(
-        knowledgeBaseId=kb_id,
-        dataSourceId=data_source_id,
-        description="Syncing S3 data source",
-    )
-    data = response["ingestionJob"]
-    log.info(f"Ingestion Job Started...")
-    log.info(f"Ingestion Job Status: {data['status']} ID: {data['ingestionJobId']}")
-
-    utils.wait_for_operation(
-        bedrock_client.get_ingestion_job,
-        ["ingestionJob", "status"],
-        "COMPLETE",
-        700,
-        knowledgeBaseId=kb_id,
-        dataSourceId=data_source_id,
-        ingestionJobId=data["ingestionJobId"],
-    )
+    utils.ingest_data_source(bedrock_client, kb_id, data_source_id)
+
+
+def get_steps(
+    profile: str = "default", embed_model_id: str = BEDROCK_FM, dimensions: int = None
+) -> list:
+    dimension = index_profiles.get_embedding_dimension(embed_model_id, dimensions)
+    index_profiles.check_profile(profile, embed_model_id)
+    # Each step skips its resource if it already exists so re-runs are safe
+    return [
+        Step(
+            "Access policy",
+            lambda _: create_opensearch_access_policy(OS_POLICY_NAME),
+        ),
+        Step(
+            "Encryption policy",
+            lambda _: create_opensearch_encryption_security_policy(OS_POLICY_NAME),
+        ),
+        Step(
+            "Network policy",
+            lambda _: create_opensearch_network_security_policy(OS_POLICY_NAME),
+        ),
+        # A collection can't be created until it's covered by both policies
+        Step(
+            "Collection",
+            lambda _: create_opensearch_collection(),
+            ["Encryption policy", "Network policy"],
+        ),
+        Step(
+            "Index",
+            lambda results: index_opensearch_collection_data(
+                results["Collection"]["host"], profile, dimension, embed_model_id
+            ),
+            ["Collection", "Access policy"],
+        ),
+        Step(
+            "Knowledge base",
+            lambda results: create_knowledge_base(
+                results["Collection"]["arn"], embed_model_id, dimensions
+            ),
+            ["Collection", "Index"],
+        ),
+        Step(
+            "Data source",
+            lambda results: create_data_source(results["Knowledge base"]),
+            ["Knowledge base"],
+        ),
+        Step(
+            "Ingestion",
+            lambda results: ingest_data_source_into_knowledge_base(
+                results["Knowledge base"], results["Data source"]
+            ),
+            ["Knowledge base", "Data source"],
+        ),
+    ]
 
 
 def main():
-    log.info("Creating OpenSearch Security Policies...")
-    create_opensearch_access_policy(OS_POLICY_NAME)
-    create_opensearch_encryption_security_policy(OS_POLICY_NAME)
-    create_opensearch_network_security_policy(OS_POLICY_NAME)
-    log.success("Created OpenSearch Security Policies!")
-
-    collection_data = utils.get_opensearch_collection(os_client, OS_COLLECTION_NAME)
-    if not collection_data:
-        log.info("Collection not found... Creating it now")
-        create_opensearch_collection()
-        collection_data = utils.get_opensearch_collection(os_client, OS_COLLECTION_NAME)
-
-        index_opensearch_collection_data(collection_data["host"])
-        log.info("Waiting for index to be created...")
-        time.sleep(30)
-
-    log.info(f"Collection Host: {collection_data['host']}")
-    log.info(f"Collection ARN: {collection_data['arn']}")
-
-    kb_id = utils.get_knowledge_base_id(bedrock_client, KB_NAME)
-    if not kb_id:
-        log.info("Knowledge base not found... Creating it now")
-        kb_id = create_knowledge_base(collection_data["arn"])
-    log.info(f"Knowledge Base ID: {kb_id}")
-
-    kb_ds_ids = utils.get_knowledge_base_data_source_ids(bedrock_client, kb_id)
-    # Default to first ds since we only create one
-    data_source_id = ""
-    if kb_ds_ids:
-        log.info("Data source found... Using it")
-        data_source_id = kb_ds_ids[0]["id"]
-    else:
-        log.info("Data source not found... Creating it now")
-        data_source_id = create_data_source(kb_id)
-    log.info(f"Data Source ID: {data_source_id}")
-
-    ingest_data_source_into_knowledge_base(kb_id, data_source_id)
-
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show the provisioning steps without calling AWS",
+    )
+    parser.add_argument(
+        "--index-profile",
+        choices=list(index_profiles.INDEX_PROFILES),
+        default="default",
+        help="Vector index engine, HNSW parameters and quantization",
+    )
+    parser.add_argument(
+        "--embedding-model",
+        choices=list(index_profiles.EMBEDDING_MODEL_DIMENSIONS),
+        default=BEDROCK_FM,
+        help="Embedding model the knowledge base uses",
+    )
+    parser.add_argument(
+        "--dimensions",
+        type=int,
+        help="Embedding dimensions, for models that support several",
+    )
+    args = parser.parse_args()
+
+    try:
+        steps = get_steps(args.index_profile, args.embedding_model, args.dimensions)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.dry_run:
+        log_plan(steps)
+        return
+    results = run_steps(steps)
+    log.info(f"Knowledge Base ID: {results['Knowledge base']}")
+    log.info(f"Data Source ID: {results['Data source']}")
     log.success("Successfully created all resources!!!")
 
 
@@ -2,51 +2,40 @@
 Cleans up Amazon Bedrock knowledge base resources created
 by the create_knowledge_base.py script
 
-# Important note
-This script is not handling next tokens for pagination
-from AWS Boto3 API calls. If you have more than 123 results
-for your knowledge base and or data sources, you will need to
-update this script to handle pagination.
-
 Call with:
 python delete_knowledge_base.py
 """
+import argparse
 import boto3
-import time
 import utils
 
 from loguru import logger as log
+from provisioning import Step, log_plan, run_steps
 
 # Enable Boto3 debug logging
 DEBUG = False  # True
 if DEBUG:
     boto3.set_stream_logger(name="botocore")
 
-bedrock_client = boto3.client("bedrock-agent")
-os_client = boto3.client("opensearchserverless")
+# Clients are created on first use
+bedrock_client = utils.LazyClient("bedrock-agent")
+os_client = utils.LazyClient("opensearchserverless")
 
 # Constants
 shared_consts = utils.get_shared_consts()
 KB_NAME = shared_consts["KB_NAME"]
-KB_DESCRIPTION = shared_consts["KB_DESCRIPTION"]
-KB_BUCKET_NAME = shared_consts["KB_BUCKET_NAME"]
-KB_BUCKET_ARN = shared_consts["KB_BUCKET_ARN"]
-BEDROCK_FM = shared_consts["BEDROCK_FM"]
-BEDROCK_EMBED_MODEL_ARN = shared_consts["BEDROCK_EMBED_MODEL_ARN"]
 OS_COLLECTION_NAME = shared_consts["OS_COLLECTION_NAME"]
-OS_VECTOR_PREFIX = shared_consts["OS_VECTOR_PREFIX"]
 OS_POLICY_NAME = shared_consts["OS_POLICY_NAME"]
-KB_ROLE_NAME = shared_consts["KB_ROLE_NAME"]
-KB_ROLE_ARN = shared_consts["KB_ROLE_ARN"]
 
 
-def delete_knowledge_base_data_sources(kb_id: str, data_source_ids: list[str]):
-    for ds in data_source_ids:
-        response = bedrock_client.delete_data_source(
-            knowledgeBaseId=kb_id, dataSourceId=ds["id"]
-        )
-        log.info(f"Data source {ds['name']} status: {response['status']}")
+def delete_knowledge_base_data_source(kb_id: str, ds: dict[str, str]):
+    response = bedrock_client.delete_data_source(
+        knowledgeBaseId=kb_id, dataSourceId=ds["id"]
+    )
+    log.info(f"Data source {ds['name']} status: {response['status']}")
+
 
+def wait_for_data_sources_deletion(kb_id: str):
     utils.wait_for_operation(
         bedrock_client.list_data_sources,
         ["dataSourceSummaries"],
@@ -63,8 +52,6 @@ def delete_knowledge_base(kb_id: str):
     utils.wait_for_resource_to_not_exist(
         bedrock_client,
         bedrock_client.get_knowledge_base,
-        ["knowledgeBase","status"],
-        "DELETING",
         500,
         knowledgeBaseId=kb_id,
     )
@@ -124,8 +111,12 @@ def delete_opensearch_network_security_policy(name: str) -> None:
         log.info("OpenSearch network policy not found... Already deleted")
 
 
-def main():
-    log.info("Cleaning up Amazon Bedrock knowledge base resources...")
+def get_steps() -> list:
+    """
+    Looks up which resources still exist and returns the steps to delete them
+    """
+    # Each step skips resources that are already gone so re-runs are safe
+    steps = []
 
     kb_id = utils.get_knowledge_base_id(bedrock_client, KB_NAME)
     if kb_id:
@@ -133,30 +124,92 @@ def main():
             bedrock_client, kb_id
         )
         if kb_data_source_ids:
-            log.info("Deleting knowledge base data sources...")
             log.info(f"Data source IDs: {kb_data_source_ids}")
-            delete_knowledge_base_data_sources(kb_id, kb_data_source_ids)
         else:
             log.info("No knowledge base data sources found... Already deleted")
-        log.info("Deleting knowledge base...")
-        delete_knowledge_base(kb_id)
+        ds_steps = [
+            Step(
+                f"Data source {ds['name']}",
+                lambda _, ds=ds: delete_knowledge_base_data_source(kb_id, ds),
+            )
+            for ds in kb_data_source_ids
+        ]
+        steps.extend(ds_steps)
+        steps.append(
+            Step(
+                "Data sources deleted",
+                lambda _: wait_for_data_sources_deletion(kb_id),
+                [step.name for step in ds_steps],
+            )
+        )
+        steps.append(
+            Step(
+                "Knowledge base",
+                lambda _: delete_knowledge_base(kb_id),
+                ["Data sources deleted"],
+            )
+        )
     else:
         log.info(f"Knowledge base {KB_NAME} not found... Already deleted")
 
-    log.info("Deleting OpenSearch resources...")
     os_collection = utils.get_opensearch_collection(os_client, OS_COLLECTION_NAME)
     if "id" in os_collection:
-        delete_opensearch_collection(OS_COLLECTION_NAME, os_collection["id"])
+        steps.append(
+            Step(
+                "Collection",
+                lambda _: delete_opensearch_collection(
+                    OS_COLLECTION_NAME, os_collection["id"]
+                ),
+                # The knowledge base removes its vectors from the collection
+                ["Knowledge base"] if kb_id else [],
+            )
+        )
     else:
         log.info(
             f"OpenSearch collection {OS_COLLECTION_NAME} not found... Already deleted"
         )
 
-    # Delete OpenSearch policies if they exist otherwise skip
-    delete_opensearch_access_policy(OS_POLICY_NAME)
-    delete_opensearch_encryption_security_policy(OS_POLICY_NAME)
-    delete_opensearch_network_security_policy(OS_POLICY_NAME)
+    # Delete OpenSearch policies if they exist otherwise skip. The policies
+    # can't be deleted while a collection still uses them.
+    policy_deps = [step.name for step in steps if step.name == "Collection"]
+    steps.extend(
+        [
+            Step(
+                "Access policy",
+                lambda _: delete_opensearch_access_policy(OS_POLICY_NAME),
+                policy_deps,
+            ),
+            Step(
+                "Encryption policy",
+                lambda _: delete_opensearch_encryption_security_policy(OS_POLICY_NAME),
+                policy_deps,
+            ),
+            Step(
+                "Network policy",
+                lambda _: delete_opensearch_network_security_policy(OS_POLICY_NAME),
+                policy_deps,
+            ),
+        ]
+    )
+
+    return steps
+
 
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show what would be deleted without deleting anything",
+    )
+    args = parser.parse_args()
+
+    log.info("Cleaning up Amazon Bedrock knowledge base resources...")
+    steps = get_steps()
+    if args.dry_run:
+        log_plan(steps)
+        return
+    run_steps(steps)
     log.success("Clean up complete...")
 
 
@@ -0,0 +1,211 @@
+"""
+Measures recall and query latency of each vector index profile so you can
+trade a little recall for lower latency and memory.
+
+Every profile gets a scratch index in the knowledge base's collection,
+loaded with the same vectors. Query vectors are searched with k-NN and the
+hits are compared against an exact brute-force cosine search in NumPy. The
+vectors are loaded as the embedding model returns them, normalized or not,
+so a profile that ranks them differently from cosine shows up as lower
+recall. They come from the local replica written by export_local_index.py
+when it exists (your real embedding distribution), otherwise they are
+random. Profiles that don't support the embedding model are skipped.
+
+Pre-requisites:
+- Run the create_knowledge_base.py script to create the collection
+
+Call with:
+python evaluate_index_profiles.py --profiles default fast --queries 200
+"""
+import argparse
+import index_profiles
+import numpy as np
+import os
+import time
+import utils
+import waiters
+
+from loguru import logger as log
+from opensearchpy import helpers
+
+from flask_chatbot.utils.local_index import NORMS_FILE, VECTORS_FILE, normalize
+
+
+# Constants
+shared_consts = utils.get_shared_consts()
+OS_COLLECTION_NAME = shared_consts["OS_COLLECTION_NAME"]
+OS_VECTOR_PREFIX = shared_consts["OS_VECTOR_PREFIX"]
+VECTOR_FIELD = f"{OS_VECTOR_PREFIX}-vector"
+LOCAL_INDEX_DIR = os.path.join(utils.PROJECT_DIR, "flask_chatbot", "local_index")
+BULK_CHUNK_SIZE = 200
+
+os_client = utils.LazyClient("opensearchserverless")
+
+
+def load_vectors(
+    count: int, dimension: int, normalized: bool, seed: int = 0
+) -> np.ndarray:
+    """
+    Returns vectors as the embedding model returns them, unit length only
+    if it normalizes its embeddings
+    """
+    path = os.path.join(LOCAL_INDEX_DIR, VECTORS_FILE)
+    norms_path = os.path.join(LOCAL_INDEX_DIR, NORMS_FILE)
+    if os.path.exists(path) and (normalized or os.path.exists(norms_path)):
+        vectors = np.load(path, mmap_mode="r")
+        if vectors.shape[1] == dimension:
+            log.info(f"Using {min(count, len(vectors))} vectors from {path}")
+            vectors = np.asarray(vectors[:count], dtype=np.float32)
+            if normalized:
+                return vectors
+            # The replica is stored normalized, scale it back
+            return vectors * np.load(norms_path)[:count, None]
+        log.warning(f"{path} has {vectors.shape[1]} dimensions, using random vectors")
+    elif os.path.exists(path):
+        log.warning(f"{norms_path} not found, re-run export_local_index.py")
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, dimension)).astype(np.float32)
+    if normalized:
+        return normalize(vectors)
+    # Embedding lengths vary from chunk to chunk
+    return vectors * rng.lognormal(0, 0.5, (count, 1)).astype(np.float32)
+
+
+def get_query_vectors(
+    vectors: np.ndarray, count: int, normalized: bool, seed: int = 1
+) -> np.ndarray:
+    """
+    Perturbed copies of random indexed vectors, like a question landing near
+    but not exactly on a chunk
+    """
+    rng = np.random.default_rng(seed)
+    picks = vectors[rng.choice(len(vectors), count)]
+    noise = rng.standard_normal(picks.shape).astype(np.float32) * 0.05
+    queries = picks + noise * np.linalg.norm(picks, axis=1, keepdims=True)
+    return normalize(queries) if normalized else queries
+
+
+def get_exact_neighbors(vectors: np.ndarray, queries: np.ndarray, k: int) -> list:
+    scores = normalize(queries) @ normalize(vectors).T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return [set(row.tolist()) for row in top]
+
+
+def load_index(os_collection_client, index_name: str, vectors: np.ndarray) -> None:
+    actions = (
+        {"_index": index_name, "_id": str(i), VECTOR_FIELD: vector.tolist()}
+        for i, vector in enumerate(vectors)
+    )
+    helpers.bulk(os_collection_client, actions, chunk_size=BULK_CHUNK_SIZE)
+    # Serverless collections have no refresh, documents show up within seconds
+    waiters.wait_until(
+        lambda: os_collection_client.count(index=index_name)["count"] >= len(vectors),
+        f"{index_name} documents",
+        300,
+    )
+
+
+def measure(os_collection_client, index_name: str, queries, exact, k: int) -> dict:
+    latencies = []
+    recalls = []
+    for query, neighbors in zip(queries, exact):
+        body = {
+            "size": k,
+            "_source": False,
+            "query": {"knn": {VECTOR_FIELD: {"vector": query.tolist(), "k": k}}},
+        }
+        start = time.perf_counter()
+        response = os_collection_client.search(index=index_name, body=body)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits = {int(hit["_id"]) for hit in response["hits"]["hits"]}
+        recalls.append(len(hits & neighbors) / k)
+    return {
+        "recall": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=list(index_profiles.INDEX_PROFILES),
+        default=list(index_profiles.INDEX_PROFILES),
+    )
+    parser.add_argument(
+        "--embedding-model",
+        choices=list(index_profiles.EMBEDDING_MODEL_DIMENSIONS),
+        default=shared_consts["BEDROCK_FM"],
+    )
+    parser.add_argument("--dimensions", type=int)
+    parser.add_argument("--vectors", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the scratch indexes afterwards"
+    )
+    args = parser.parse_args()
+
+    dimension = index_profiles.get_embedding_dimension(
+        args.embedding_model, args.dimensions
+    )
+    profiles = []
+    for profile in args.profiles:
+        try:
+            index_profiles.check_profile(profile, args.embedding_model)
+            profiles.append(profile)
+        except ValueError as e:
+            log.warning(f"Skipping {profile}: {e}")
+    if not profiles:
+        log.error(f"No profile supports {args.embedding_model}")
+        exit(1)
+    normalized = args.embedding_model in index_profiles.NORMALIZED_EMBEDDING_MODELS
+    vectors = load_vectors(args.vectors, dimension, normalized)
+    queries = get_query_vectors(vectors, args.queries, normalized)
+    exact = get_exact_neighbors(vectors, queries, args.k)
+
+    collection_data = utils.get_opensearch_collection(os_client, OS_COLLECTION_NAME)
+    if not collection_data:
+        log.error(f"OpenSearch collection {OS_COLLECTION_NAME} not found")
+        exit(1)
+    os_collection_client = utils.get_opensearch_collection_client(
+        collection_data["host"]
+    )
+
+    report = []
+    for profile in profiles:
+        index_name = f"{OS_VECTOR_PREFIX}-eval-{profile}"
+        if os_collection_client.indices.exists(index_name):
+            os_collection_client.indices.delete(index_name)
+        os_collection_client.indices.create(
+            index_name,
+            body=index_profiles.get_index_body(
+                profile, dimension, VECTOR_FIELD, args.embedding_model
+            ),
+        )
+        try:
+            load_index(os_collection_client, index_name, vectors)
+            result = measure(os_collection_client, index_name, queries, exact, args.k)
+        finally:
+            if not args.keep:
+                os_collection_client.indices.delete(index_name)
+        result["memory_mb"] = (
+            index_profiles.estimate_memory_bytes(profile, dimension, len(vectors))
+            / 2**20
+        )
+        report.append((profile, result))
+        log.info(f"{profile}: {result}")
+
+    log.info(f"{len(vectors)} vectors, {dimension} dimensions, recall@{args.k}")
+    log.info(f"{'Profile':<12} {'Recall':>8} {'p50 ms':>8} {'p95 ms':>8} {'Mem MB':>8}")
+    for profile, result in report:
+        log.info(
+            f"{profile:<12} {result['recall']:8.3f} {result['p50_ms']:8.1f} "
+            f"{result['p95_ms']:8.1f} {result['memory_mb']:8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Exports the knowledge base's OpenSearch Serverless vector index into a
+local replica the Flask app can search in-process. Writes the vectors to a
+memory mappable NumPy file alongside the text chunks and an IVF index, then
+checks the IVF index's recall against an exact search.
+
+Pre-requisites:
+- Run the create_knowledge_base.py script to create and ingest the knowledge base
+
+Set RETRIEVAL_MODE = "local" in flask_chatbot/app.py to use the replica,
+and re-run this script after every ingestion job. Pass the n_probe the app
+uses (LOCAL_INDEX_N_PROBE) so the recall check matches what it serves.
+
+Call with:
+python export_local_index.py --n-probe 8
+"""
+import argparse
+import json
+import numpy as np
+import os
+import utils
+
+from loguru import logger as log
+
+from flask_chatbot.utils.local_index import DEFAULT_N_PROBE, LocalVectorIndex
+
+
+# Constants
+shared_consts = utils.get_shared_consts()
+OS_COLLECTION_NAME = shared_consts["OS_COLLECTION_NAME"]
+OS_VECTOR_PREFIX = shared_consts["OS_VECTOR_PREFIX"]
+OS_INDEX_NAME = f"{OS_VECTOR_PREFIX}-index"
+OS_VECTOR_FIELD = f"{OS_VECTOR_PREFIX}-vector"
+OUTPUT_DIR = os.path.join(utils.PROJECT_DIR, "flask_chatbot", "local_index")
+# Serverless collections don't support scroll or point in time, and from/size
+# stops at index.max_result_window (10000), so page with search_after on _id
+PAGE_SIZE = 500
+# Below this recall the export suggests probing more IVF lists
+MIN_RECALL = 0.9
+
+os_client = utils.LazyClient("opensearchserverless")
+
+
+def get_chunk_uri(metadata: str) -> str:
+    try:
+        return json.loads(metadata).get("source", "")
+    except (TypeError, ValueError):
+        return ""
+
+
+def read_index(host: str):
+    """
+    Returns every vector and text chunk in the knowledge base index
+    """
+    os_collection_client = utils.get_opensearch_collection_client(host)
+    vectors = []
+    chunks = []
+    body = {
+        "size": PAGE_SIZE,
+        # A unique sort key so every page starts exactly after the last one
+        "sort": [{"_id": "asc"}],
+        "query": {"match_all": {}},
+        "_source": [
+            OS_VECTOR_FIELD,
+            "AMAZON_BEDROCK_TEXT_CHUNK",
+            "AMAZON_BEDROCK_METADATA",
+        ],
+    }
+    while True:
+        response = os_collection_client.search(index=OS_INDEX_NAME, body=body)
+        hits = response["hits"]["hits"]
+        for hit in hits:
+            source = hit["_source"]
+            vectors.append(source[OS_VECTOR_FIELD])
+            chunks.append(
+                {
+                    "text": source["AMAZON_BEDROCK_TEXT_CHUNK"],
+                    "uri": get_chunk_uri(source.get("AMAZON_BEDROCK_METADATA")),
+                }
+            )
+        log.info(f"Read {len(vectors)} chunks from {OS_INDEX_NAME}")
+        if len(hits) < PAGE_SIZE:
+            return vectors, chunks
+        body["search_after"] = hits[-1]["sort"]
+
+
+def get_query_vectors(vectors, count: int, seed: int = 0) -> np.ndarray:
+    """
+    Perturbed copies of random chunk vectors, like a question landing near
+    but not exactly on a chunk
+    """
+    rng = np.random.default_rng(seed)
+    picks = np.asarray(vectors[rng.choice(len(vectors), count)])
+    return picks + rng.standard_normal(picks.shape).astype(np.float32) * 0.05
+
+
+def check_recall(index: LocalVectorIndex, count: int, k: int, n_probe: int) -> None:
+    """
+    Logs the IVF index's recall@k at n_probe, and the smallest n_probe that
+    reaches MIN_RECALL when it falls short
+    """
+    if index.centroids is None:
+        log.info("No IVF index, every search is exact")
+        return
+    queries = get_query_vectors(index.vectors, count)
+    recall = index.recall(queries, k, n_probe)
+    log.info(f"IVF recall@{k} with n_probe={n_probe}: {recall:.3f}")
+    if recall >= MIN_RECALL:
+        return
+    n_lists = len(index.centroids)
+    while n_probe < n_lists:
+        n_probe = min(n_probe * 2, n_lists)
+        recall = index.recall(queries, k, n_probe)
+        log.info(f"IVF recall@{k} with n_probe={n_probe}: {recall:.3f}")
+        if recall >= MIN_RECALL:
+            break
+    log.warning(
+        f"Recall is below {MIN_RECALL}, set LOCAL_INDEX_N_PROBE in "
+        f"flask_chatbot/app.py to {n_probe}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-probe", type=int, default=DEFAULT_N_PROBE)
+    parser.add_argument("--recall-queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    collection_data = utils.get_opensearch_collection(os_client, OS_COLLECTION_NAME)
+    if not collection_data:
+        log.error(f"OpenSearch collection {OS_COLLECTION_NAME} not found")
+        exit(1)
+
+    vectors, chunks = read_index(collection_data["host"])
+    if not vectors:
+        log.error(f"No chunks found in {OS_INDEX_NAME}, has ingestion run?")
+        exit(1)
+    LocalVectorIndex.build(vectors, chunks, OUTPUT_DIR)
+    log.success(f"Exported the local vector index to {OUTPUT_DIR}")
+    check_recall(
+        LocalVectorIndex.load(OUTPUT_DIR), args.recall_queries, args.k, args.n_probe
+    )
+
+
+if __name__ == "__main__":
+    main()
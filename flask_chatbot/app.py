@@ -1,24 +1,615 @@
-from flask import Flask, render_template, request
+import contextvars
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import (
+    Flask,
+    Response,
+    g,
+    render_template,
+    request,
+    stream_with_context,
+)
 from loguru import logger as log
 
 # Local imports
 import utils.bedrock as bedrock
+import utils.cache as cache
+import utils.catalog as catalog
+import utils.local_index as local_index
+import utils.metrics as metrics
+import utils.semantic_cache as semantic_cache
+import utils.sessions as sessions
 
 
 def page_not_found(e):
     return render_template("404.html"), 404
 
 
+def bedrock_busy(e):
+    return str(e), 503, {"Retry-After": "1"}
+
+
 app = Flask(__name__)
 app.register_error_handler(404, page_not_found)
+app.register_error_handler(bedrock.AdmissionTimeout, bedrock_busy)
 
 
 AWS_REGION = "us-east-1"
+
+# Stage timings and token counts are served on /metrics. Set TRACING_ENABLED
+# to also report the stages as OpenTelemetry spans (needs opentelemetry-api
+# and an SDK configured e.g. by running under opentelemetry-instrument).
+TRACING_ENABLED = False
+if TRACING_ENABLED:
+    metrics.enable_tracing("bedrock-chatbot")
+
+# Clients are shared per (service, region); build them and open connections
+# before serving (bedrock-agent-runtime only connects on its first retrieve)
+bedrock.warm_up_clients(AWS_REGION)
+br_rt_client = bedrock.get_bedrock_runtime_client(AWS_REGION)
 br_agent_client = bedrock.get_bedrock_agent_client(AWS_REGION)
 br_agent_rt_client = bedrock.get_bedrock_agent_runtime_client(AWS_REGION)
 
+# Generations slower than the model's recent p95 are sent a second time and
+# the first answer wins, for at most 5% more calls. Hedges go to the same
+# model unless HEDGE_TARGETS names another region or model, e.g.
+# {"anthropic.claude-v2": ("us-west-2", "anthropic.claude-v2")}
+HEDGING_ENABLED = False
+HEDGE_TARGETS = {}
+if HEDGING_ENABLED:
+    bedrock.configure_hedging(HEDGE_TARGETS, enabled=True)
+
 BEDROCK_KNOWLEDGE_BASE_NAME = "demo-rag"
 
+# Knowledge base IDs are resolved once and refreshed in the background
+kb_resolver = bedrock.get_knowledge_base_resolver(br_agent_client)
+kb_resolver.start()
+
+# Foundation models are listed at startup and refreshed hourly
+MODEL_CATALOG_REFRESH_SECONDS = 3600
+model_catalog = catalog.get_model_catalog(AWS_REGION, MODEL_CATALOG_REFRESH_SECONDS)
+model_catalog.start()
+
+# Repeated prompts are answered from cache. Set RESPONSE_CACHE_SQLITE_PATH
+# to cache.DEFAULT_SQLITE_PATH to share answers across worker processes.
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+RESPONSE_CACHE_TTL_SECONDS = 3600
+RESPONSE_CACHE_SQLITE_PATH = None
+RESPONSE_CACHE_SQLITE_MAX_ENTRIES = 100000
+response_cache = cache.ResponseCache(
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTL_SECONDS,
+    RESPONSE_CACHE_SQLITE_PATH,
+    RESPONSE_CACHE_SQLITE_MAX_ENTRIES,
+)
+
+# RAG questions worded differently from an earlier one reuse its answer
+# when their embeddings are at least this similar
+SEMANTIC_CACHE_CAPACITY = 4096
+SEMANTIC_CACHE_THRESHOLD = 0.95
+answer_index = semantic_cache.SemanticCache(
+    SEMANTIC_CACHE_CAPACITY, SEMANTIC_CACHE_THRESHOLD
+)
+
+# RAG retrieves once per question and generates with any model, so the
+# retrieved chunks are cached and shared across models
+RETRIEVAL_CACHE_MAX_ENTRIES = 1024
+RETRIEVAL_CACHE_TTL_SECONDS = 600
+retrieval_cache = cache.ResponseCache(
+    RETRIEVAL_CACHE_MAX_ENTRIES, RETRIEVAL_CACHE_TTL_SECONDS
+)
+
+# "knowledge_base" retrieves over the network from OpenSearch Serverless,
+# "local" searches the in-process replica written by export_local_index.py
+RETRIEVAL_MODE = "knowledge_base"
+LOCAL_INDEX_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "local_index"
+)
+# IVF lists probed per query, check the recall with export_local_index.py
+LOCAL_INDEX_N_PROBE = local_index.DEFAULT_N_PROBE
+local_vector_index = None
+
+
+def load_local_index():
+    """
+    Returns the local replica, or None when it's missing or was embedded
+    with a different dimension than bedrock.get_embedding returns
+    """
+    try:
+        index = local_index.LocalVectorIndex.load(LOCAL_INDEX_DIR)
+    except FileNotFoundError:
+        log.warning("Local vector index not found, retrieving from the knowledge base")
+        return None
+    try:
+        dimension = len(bedrock.get_embedding(br_rt_client, "dimension check"))
+    except Exception as e:
+        log.warning(f"Couldn't check the local index's embedding dimension: {e}")
+        dimension = index.dimension
+    if dimension != index.dimension:
+        log.error(
+            f"The local index has {index.dimension} dimension vectors but "
+            f"{bedrock.BEDROCK_EMBED_MODEL_ID} returns {dimension}, set "
+            "BEDROCK_EMBED_SETTINGS to match the knowledge base. Retrieving "
+            "from the knowledge base."
+        )
+        return None
+    log.info(f"Loaded {len(index.chunks)} chunks from the local index")
+    return index
+
+
+if RETRIEVAL_MODE == "local":
+    local_vector_index = load_local_index()
+
+# Retrieval and context size for RAG generation, overridable per model
+# e.g. {"anthropic.claude-instant-v1": {"number_of_results": 3}}
+RAG_SETTINGS = {"number_of_results": 5, "max_context_chars": 12000}
+MODEL_RAG_SETTINGS = {}
+
+# Cached RAG answers are dropped when a new ingestion job completes
+INGESTION_POLL_SECONDS = 60
+ingestion_watcher = cache.IngestionWatcher(
+    br_agent_client,
+    [response_cache, answer_index, retrieval_cache],
+    lambda: kb_resolver.get(BEDROCK_KNOWLEDGE_BASE_NAME),
+    INGESTION_POLL_SECONDS,
+)
+ingestion_watcher.start()
+
+# Hit and miss counts of the caches are served on /metrics
+metrics.add_cache("response", response_cache)
+metrics.add_cache("semantic", answer_index)
+metrics.add_cache("retrieval", retrieval_cache)
+
+
+# Conversations are keyed by a cookie so follow-up questions keep their
+# context. Set CHAT_SESSION_SQLITE_PATH to share them across worker processes.
+CHAT_SESSION_COOKIE = "chat_session_id"
+CHAT_SESSION_MAX_SESSIONS = 10000
+CHAT_SESSION_IDLE_SECONDS = 1800
+CHAT_HISTORY_MAX_TOKENS = 2000
+CHAT_SESSION_SQLITE_PATH = None
+session_store = sessions.SessionStore(
+    CHAT_SESSION_MAX_SESSIONS,
+    CHAT_SESSION_IDLE_SECONDS,
+    CHAT_HISTORY_MAX_TOKENS,
+    CHAT_SESSION_SQLITE_PATH,
+)
+
+
+# Batch prompts share one bounded pool so a large batch can't exhaust
+# the Bedrock quota or the connection pool
+BATCH_MAX_WORKERS = 8
+BATCH_MAX_PROMPTS = 1000
+batch_executor = ThreadPoolExecutor(BATCH_MAX_WORKERS, thread_name_prefix="batch")
+
+
+def get_cache_key(model_id: str, message: str, kb_id: str = "") -> str:
+    try:
+        params = bedrock.get_model_adapter(model_id).body
+    except ValueError:
+        # No adapter, RAG questions are answered by retrieve_and_generate
+        params = None
+    return cache.make_cache_key(model_id, message, kb_id, params)
+
+
+def get_semantic_answer(model_id: str, message: str, kb_id: str):
+    """
+    Returns the question embedding and the semantically cached answer,
+    (None, None) if the embedding call fails
+    """
+    try:
+        embedding = bedrock.get_embedding(br_rt_client, message)
+    except Exception as e:
+        log.warning(f"Failed to embed the question, skipping the semantic cache: {e}")
+        return None, None
+    return embedding, answer_index.lookup(embedding, model_id, kb_id)
+
+
+def get_rag_settings(model_id: str) -> dict:
+    return {**RAG_SETTINGS, **MODEL_RAG_SETTINGS.get(model_id, {})}
+
+
+def retrieve_chunks(
+    message: str, kb_id: str, number_of_results: int, embedding: list = None
+) -> list:
+    """
+    Returns the knowledge base chunks for the question, from the local index
+    when it's loaded, otherwise from the retrieval cache when the same
+    question was retrieved with the same settings
+    """
+    if local_vector_index is not None:
+        if embedding is None:
+            embedding = bedrock.get_embedding(br_rt_client, message)
+        with metrics.span("retrieve"):
+            return local_vector_index.search(
+                embedding, number_of_results, LOCAL_INDEX_N_PROBE
+            )
+
+    retrieval_config = {"number_of_results": number_of_results}
+    cache_key = cache.make_cache_key("retrieve", message, kb_id, retrieval_config)
+    results = retrieval_cache.get(cache_key)
+    if results is None:
+        results = bedrock.retrieve(
+            br_agent_rt_client, message, kb_id, number_of_results
+        )
+        retrieval_cache.set(cache_key, results, kb_id)
+    return results
+
+
+def invoke_knowledge_base(
+    model_id: str, message: str, kb_id: str, kb_session_id: str = None
+) -> dict:
+    model_arn = f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{model_id}"
+    try:
+        response = bedrock.coalesced_invoke_knowledge_base(
+            br_agent_rt_client,
+            message,
+            kb_id,
+            model_arn,
+            kb_session_id,
+        )
+    except (
+        br_agent_rt_client.exceptions.ResourceNotFoundException,
+        br_agent_rt_client.exceptions.ValidationException,
+    ):
+        # The cached ID may point at a deleted knowledge base
+        kb_resolver.invalidate(BEDROCK_KNOWLEDGE_BASE_NAME)
+        raise
+
+    log.info(f"Response from Amazon Bedrock: '{response}'")
+    return response
+
+
+def get_knowledge_base_answer(model_id: str, message: str, kb_id: str) -> dict:
+    """
+    Answers with the single retrieve_and_generate call
+    """
+    response = invoke_knowledge_base(model_id, message, kb_id)
+    return {
+        "text": response["output"]["text"],
+        "citations": bedrock.get_knowledge_base_citations(response),
+    }
+
+
+def get_follow_up_rag_answer(
+    model_id: str, message: str, kb_id: str, session: dict
+) -> tuple:
+    """
+    Answers a follow-up question inside the knowledge base's own session so
+    retrieve_and_generate resolves references to the earlier turns. Returns
+    the answer and the knowledge base session ID.
+
+    The first question is answered by the cached two-stage path, so the
+    first follow-up has no knowledge base session yet and carries the
+    trimmed history in its prompt instead.
+    """
+    kb_session_id = session["kb_session_id"]
+    if kb_session_id:
+        try:
+            response = invoke_knowledge_base(model_id, message, kb_id, kb_session_id)
+        except br_agent_rt_client.exceptions.ValidationException as e:
+            # Bedrock expires idle sessions, start a new one
+            log.warning(f"Knowledge base session {kb_session_id} rejected: {e}")
+            kb_session_id = None
+    if not kb_session_id:
+        prompt = sessions.get_conversation_prompt(session["history"], message)
+        response = invoke_knowledge_base(model_id, prompt, kb_id)
+    answer = {
+        "text": response["output"]["text"],
+        "citations": bedrock.get_knowledge_base_citations(response),
+    }
+    return answer, response.get("sessionId")
+
+
+def get_model_answer(model_id: str, message: str, session_id: str = None) -> str:
+    history = session_store.get(session_id)["history"]
+    # Follow-ups depend on the conversation so only first messages are cached
+    cache_key = None if history else get_cache_key(model_id, message)
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        log.info(f"Answering from cache - Model: {model_id} Message: '{message}'")
+        session_store.add_turn(session_id, message, cached["text"])
+        return cached["text"]
+
+    prompt = sessions.get_conversation_prompt(history, message)
+    invoke_body = bedrock.get_model_invoke_body(model_id, prompt)
+
+    log.info(f"Querying Amazon Bedrock - Model: {model_id} Message: '{invoke_body}'")
+    response = bedrock.coalesced_invoke_model(br_rt_client, model_id, invoke_body)
+    log.info(f"Response from Amazon Bedrock: '{response}'")
+    if response is None:
+        return "No response from Amazon Bedrock"
+    if cache_key:
+        response_cache.set(cache_key, {"text": response, "citations": []})
+    session_store.add_turn(session_id, message, response)
+    return response
+
+
+def get_rag_answer(model_id: str, message: str, session_id: str = None) -> str:
+    kb_id = kb_resolver.get(BEDROCK_KNOWLEDGE_BASE_NAME)
+    log.info(f"Knowledge base ID: {kb_id}")
+    session = session_store.get(session_id)
+    if session["history"]:
+        answer, kb_session_id = get_follow_up_rag_answer(
+            model_id, message, kb_id, session
+        )
+        log.info(f"Answer: {answer['text']}")
+        session_store.add_turn(session_id, message, answer["text"], kb_session_id)
+        return answer["text"]
+
+    answer = get_first_rag_answer(model_id, message, kb_id)
+    session_store.add_turn(session_id, message, answer["text"])
+    return answer["text"]
+
+
+def get_first_rag_answer(model_id: str, message: str, kb_id: str) -> dict:
+    """
+    Answers a question that doesn't depend on earlier turns, from the
+    caches when possible. Falls back to retrieve_and_generate when the
+    retrieval fails, unless Bedrock is out of capacity.
+    """
+    cache_key = get_cache_key(model_id, message, kb_id)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        log.info(f"Answering from cache - Model: {model_id} Message: '{message}'")
+        return cached
+    embedding, cached = get_semantic_answer(model_id, message, kb_id)
+    if cached is not None:
+        log.info(f"Answering from semantic cache - Model: {model_id} Message: '{message}'")
+        return cached
+
+    log.info(f"Querying Amazon Bedrock - Model: {model_id} Message: '{message}'")
+    settings = get_rag_settings(model_id)
+    try:
+        results = retrieve_chunks(
+            message, kb_id, settings["number_of_results"], embedding
+        )
+    except Exception as e:
+        if bedrock.is_capacity_error(e):
+            raise
+        log.warning(f"Retrieval failed, falling back to retrieve_and_generate: {e}")
+        answer = get_knowledge_base_answer(model_id, message, kb_id)
+    else:
+        with metrics.span("build_prompt"):
+            prompt = bedrock.get_rag_prompt(
+                message, results, settings["max_context_chars"]
+            )
+        invoke_body = bedrock.get_model_invoke_body(model_id, prompt)
+        text = bedrock.coalesced_invoke_model(br_rt_client, model_id, invoke_body)
+        answer = {
+            "text": text or "",
+            "citations": bedrock.get_retrieval_citations(results),
+        }
+
+    log.info(f"Answer: {answer['text']}")
+    response_cache.set(cache_key, answer, kb_id)
+    if embedding is not None:
+        answer_index.add(embedding, answer, model_id, kb_id)
+    return answer
+
+
+def generate_model_stream(model_id: str, message: str, session_id: str = None):
+    """
+    Yields the model answer as Server-Sent Events
+    """
+    history = session_store.get(session_id)["history"]
+    cache_key = None if history else get_cache_key(model_id, message)
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        log.info(f"Answering from cache - Model: {model_id} Message: '{message}'")
+        session_store.add_turn(session_id, message, cached["text"])
+        yield bedrock.format_sse({"text": cached["text"]})
+        yield bedrock.format_sse({}, event="done")
+        return
+
+    prompt = sessions.get_conversation_prompt(history, message)
+    invoke_body = bedrock.get_model_invoke_body(model_id, prompt)
+    log.info(f"Streaming from Amazon Bedrock - Model: {model_id} Message: '{invoke_body}'")
+    answer = []
+    try:
+        if model_catalog.supports_streaming(model_id):
+            for text in bedrock.invoke_model_with_response_stream(
+                br_rt_client, model_id, invoke_body
+            ):
+                answer.append(text)
+                yield bedrock.format_sse({"text": text})
+        else:
+            # Models without streaming support arrive as a single message
+            text = bedrock.coalesced_invoke_model(br_rt_client, model_id, invoke_body)
+            answer.append(text or "")
+            yield bedrock.format_sse({"text": text or ""})
+    except Exception as e:
+        log.error(f"Streaming from Amazon Bedrock failed: {e}")
+        yield bedrock.format_sse({"error": str(e)}, event="error")
+        return
+    answer = "".join(answer)
+    if cache_key:
+        response_cache.set(cache_key, {"text": answer, "citations": []})
+    session_store.add_turn(session_id, message, answer)
+    yield bedrock.format_sse({}, event="done")
+
+
+def generate_rag_stream(model_id: str, message: str, session_id: str = None):
+    """
+    Yields the retrieval citations and then the RAG answer as Server-Sent
+    Events, falling back to retrieve_and_generate if nothing was generated
+    and the model wasn't out of capacity.
+    Follow-up questions are answered in one piece by the knowledge base
+    session since retrieve_and_generate doesn't stream.
+    """
+    kb_id = kb_resolver.get(BEDROCK_KNOWLEDGE_BASE_NAME)
+    log.info(f"Knowledge base ID: {kb_id}")
+    session = session_store.get(session_id)
+    if session["history"]:
+        try:
+            answer, kb_session_id = get_follow_up_rag_answer(
+                model_id, message, kb_id, session
+            )
+        except Exception as e:
+            log.error(f"Follow-up RAG question failed: {e}")
+            yield bedrock.format_sse({"error": str(e)}, event="error")
+            return
+        session_store.add_turn(session_id, message, answer["text"], kb_session_id)
+        yield bedrock.format_sse({"citations": answer["citations"]}, event="citations")
+        yield bedrock.format_sse({"text": answer["text"]})
+        yield bedrock.format_sse({}, event="done")
+        return
+
+    cache_key = get_cache_key(model_id, message, kb_id)
+    cached = response_cache.get(cache_key)
+    embedding = None
+    if cached is None:
+        embedding, cached = get_semantic_answer(model_id, message, kb_id)
+    if cached is not None:
+        log.info(f"Answering from cache - Model: {model_id} Message: '{message}'")
+        session_store.add_turn(session_id, message, cached["text"])
+        yield bedrock.format_sse({"citations": cached["citations"]}, event="citations")
+        yield bedrock.format_sse({"text": cached["text"]})
+        yield bedrock.format_sse({}, event="done")
+        return
+    log.info(f"Streaming RAG from Amazon Bedrock - Model: {model_id} Message: '{message}'")
+
+    answer = []
+    citations = []
+    cited = streamed = False
+    try:
+        settings = get_rag_settings(model_id)
+        results = retrieve_chunks(
+            message, kb_id, settings["number_of_results"], embedding
+        )
+        citations = bedrock.get_retrieval_citations(results)
+        cited = True
+        yield bedrock.format_sse({"citations": citations}, event="citations")
+
+        with metrics.span("build_prompt"):
+            prompt = bedrock.get_rag_prompt(
+                message, results, settings["max_context_chars"]
+            )
+        invoke_body = bedrock.get_model_invoke_body(model_id, prompt)
+        if model_catalog.supports_streaming(model_id):
+            for text in bedrock.invoke_model_with_response_stream(
+                br_rt_client, model_id, invoke_body
+            ):
+                streamed = True
+                answer.append(text)
+                yield bedrock.format_sse({"text": text})
+        else:
+            text = bedrock.coalesced_invoke_model(br_rt_client, model_id, invoke_body)
+            streamed = True
+            answer.append(text or "")
+            yield bedrock.format_sse({"text": text or ""})
+    except Exception as e:
+        # Out of capacity, the blocking call would only add to the load
+        if streamed or bedrock.is_capacity_error(e):
+            log.error(f"Streaming RAG from Amazon Bedrock failed: {e}")
+            yield bedrock.format_sse({"error": str(e)}, event="error")
+            return
+        # Nothing was generated yet so fall back to the blocking call
+        log.warning(f"Streaming RAG failed, falling back to blocking call: {e}")
+        try:
+            fallback = get_knowledge_base_answer(model_id, message, kb_id)
+        except Exception as e:
+            log.error(f"Blocking RAG fallback failed: {e}")
+            yield bedrock.format_sse({"error": str(e)}, event="error")
+            return
+        if not cited:
+            citations = fallback["citations"]
+            yield bedrock.format_sse({"citations": citations}, event="citations")
+        answer.append(fallback["text"])
+        yield bedrock.format_sse({"text": fallback["text"]})
+    answer = {"text": "".join(answer), "citations": citations}
+    response_cache.set(cache_key, answer, kb_id)
+    if embedding is not None:
+        answer_index.add(embedding, answer, model_id, kb_id)
+    session_store.add_turn(session_id, message, answer["text"])
+    yield bedrock.format_sse({}, event="done")
+
+
+def get_timed_answer(answer_fn, model_id: str, index: int, prompt: str) -> dict:
+    start = time.perf_counter()
+    result = {"index": index, "prompt": prompt}
+    try:
+        result["answer"] = answer_fn(model_id, prompt)
+    except Exception as e:
+        log.error(f"Batch prompt {index} failed: {e}")
+        result["error"] = str(e)
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def generate_batch(model_id: str, prompts: list, use_knowledge_base: bool):
+    """
+    Fans the prompts out over the batch thread pool and yields one NDJSON
+    line per prompt in the order they complete
+    """
+    answer_fn = get_rag_answer if use_knowledge_base else get_model_answer
+    # Each prompt runs in a copy of the request's context so its stages are
+    # labelled with the route and model
+    futures = [
+        batch_executor.submit(
+            contextvars.copy_context().run,
+            get_timed_answer,
+            answer_fn,
+            model_id,
+            index,
+            prompt,
+        )
+        for index, prompt in enumerate(prompts)
+    ]
+    try:
+        for future in as_completed(futures):
+            yield json.dumps(future.result()) + "\n"
+    finally:
+        # The client went away, don't keep paying for its prompts
+        for future in futures:
+            future.cancel()
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def get_session_id() -> str:
+    """
+    Returns the browser's chat session ID, starting a session (and setting
+    its cookie on the response) if it doesn't have one
+    """
+    session_id = g.get("new_session_id") or request.cookies.get(CHAT_SESSION_COOKIE)
+    if not sessions.is_valid_session_id(session_id):
+        session_id = g.new_session_id = sessions.new_session_id()
+    return session_id
+
+
+@app.after_request
+def set_session_cookie(response):
+    if "new_session_id" in g:
+        response.set_cookie(
+            CHAT_SESSION_COOKIE, g.new_session_id, httponly=True, samesite="Lax"
+        )
+    return response
+
+
+def get_model_label(model_id: str) -> str:
+    # Only catalog models become label values so the series stay bounded
+    return model_id if model_id and model_catalog.get(model_id) else ""
+
+
+@app.before_request
+def start_request_metrics():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.start_request(route, get_model_label(request.args.get("model_id")))
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses are only done once the last chunk is sent
+    labels = metrics.get_request_labels()
+    status = response.status_code
+    response.call_on_close(lambda: metrics.observe_request(labels, status))
+    return response
+
 
 # Update ./templates/index.html from `url: "/get_bedrock_rag_response"`
 # to `url: "/get_bedrock_response"` to use the Bedrock API without RAG
@@ -27,15 +618,26 @@ def get_bedrock_response() -> str:
     # Make a request to the Amazon Bedrock API
     model_id = request.args.get("model_id")
     message = request.args.get("chat_input_val")
-    invoke_body = bedrock.get_model_invoke_body(model_id, message)
+    if not model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    return get_model_answer(model_id, message, get_session_id())
 
-    log.info(f"Querying Amazon Bedrock - Model: {model_id} Message: '{invoke_body}'")
-    client_runtime = bedrock.get_bedrock_runtime_client(AWS_REGION)
-    response = bedrock.invoke_model(client_runtime, model_id, invoke_body)
-    log.info(f"Response from Amazon Bedrock: '{response}'")
-    if response is None:
-        return "No response from Amazon Bedrock"
-    return response
+
+# Set `streamResponses = true` in ./templates/index.html to render tokens
+# from this route as they are generated
+@app.route("/get_bedrock_stream_response")
+def get_bedrock_stream_response() -> Response:
+    model_id = request.args.get("model_id")
+    message = request.args.get("chat_input_val")
+    if not model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    return Response(
+        stream_with_context(
+            generate_model_stream(model_id, message, get_session_id())
+        ),
+        mimetype="text/event-stream",
+        headers=SSE_HEADERS,
+    )
 
 
 @app.route("/get_bedrock_rag_response")
@@ -43,30 +645,66 @@ def get_bedrock_rag_response() -> str:
     # Make a request to the Amazon Bedrock API
     model_id = request.args.get("model_id")
     message = request.args.get("chat_input_val")
+    if not model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    return get_rag_answer(model_id, message, get_session_id())
 
-    kb_id = bedrock.get_knowledge_base_id(br_agent_client, BEDROCK_KNOWLEDGE_BASE_NAME)
-    log.info(f"Knowledge base ID: {kb_id}")
-    model_arn = f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{model_id}"
 
-    log.info(f"Querying Amazon Bedrock - Model: {model_id} Message: '{message}'")
-    response = bedrock.invoke_knowledge_base(
-        br_agent_rt_client,
-        message,
-        kb_id,
-        model_arn,
+# Set `streamResponses = true` in ./templates/index.html to stream RAG
+# answers from this route. Citations are sent as soon as retrieval finishes.
+@app.route("/get_bedrock_rag_stream_response")
+def get_bedrock_rag_stream_response() -> Response:
+    model_id = request.args.get("model_id")
+    message = request.args.get("chat_input_val")
+    if not model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    return Response(
+        stream_with_context(generate_rag_stream(model_id, message, get_session_id())),
+        mimetype="text/event-stream",
+        headers=SSE_HEADERS,
     )
 
-    log.info(f"Response from Amazon Bedrock: '{response}'")
-    log.info(f"Answer: {response['output']['text']}")
-    return response["output"]["text"]
+
+# POST {"model_id": ..., "prompts": [...], "use_knowledge_base": false}
+# Answers are streamed back as NDJSON in completion order with their latency
+@app.route("/batch", methods=["POST"])
+def batch() -> Response:
+    body = request.get_json(silent=True) or {}
+    model_id = body.get("model_id")
+    prompts = body.get("prompts")
+    if not model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    if not isinstance(prompts, list) or not prompts:
+        return "prompts must be a non-empty list", 400
+    if len(prompts) > BATCH_MAX_PROMPTS:
+        return f"A batch can have at most {BATCH_MAX_PROMPTS} prompts", 400
+
+    use_knowledge_base = bool(body.get("use_knowledge_base", False))
+    metrics.set_request_model(get_model_label(model_id))
+    log.info(f"Running a batch of {len(prompts)} prompts - Model: {model_id}")
+    return Response(
+        stream_with_context(generate_batch(model_id, prompts, use_knowledge_base)),
+        mimetype="application/x-ndjson",
+    )
+
+
+# Prometheus scrape endpoint: per-stage latency histograms by route and
+# model, request durations and Bedrock token counts
+@app.route("/metrics")
+def metrics_endpoint() -> Response:
+    return Response(metrics.render_metrics(), content_type=metrics.CONTENT_TYPE)
 
 
 @app.route("/", methods=["POST", "GET"])
 def index():
-    client = bedrock.get_bedrock_client(AWS_REGION)
-    models = bedrock.get_foundation_model_ids(client)
+    # The page starts with an empty chat so start a new conversation too
+    session_store.clear(request.cookies.get(CHAT_SESSION_COOKIE))
+    g.new_session_id = sessions.new_session_id()
+    models = model_catalog.model_ids()
     log.debug(f"Available models: {models}")
-    return render_template("index.html", models=models)
+    return render_template(
+        "index.html", models=models, model_info=model_catalog.models()
+    )
 
 
 if __name__ == "__main__":
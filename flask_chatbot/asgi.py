@@ -0,0 +1,225 @@
+"""
+Async (ASGI) serving mode for the chatbot. Exposes the same routes as
+app.py but runs the Bedrock calls in worker threads so the event loop can
+hold hundreds of concurrent chats, with per-model concurrency and
+queue-depth limits. A model's concurrency is the max_concurrency of its
+Bedrock admission limits (see bedrock.DEFAULT_RATE_LIMITS).
+
+Call with:
+hypercorn asgi:app --bind 0.0.0.0:5100
+"""
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, g, render_template, request
+from loguru import logger as log
+
+# Local imports
+import app as wsgi
+import utils.concurrency as concurrency
+import utils.metrics as metrics
+import utils.sessions as sessions
+
+
+# How many more requests per model may wait once its slots are all in use
+MAX_QUEUE_DEPTH_PER_MODEL = 128
+# Threads running the blocking Bedrock calls of every model together. Calls
+# beyond it queue for a thread, so it bounds the process however many
+# models the catalog lists.
+WORKER_THREADS = 128
+
+
+async def page_not_found(e):
+    return await render_template("404.html"), 404
+
+
+app = Quart(__name__)
+app.register_error_handler(404, page_not_found)
+
+limiter = concurrency.ModelConcurrencyLimiter(
+    lambda model_id: wsgi.bedrock.get_rate_limits(model_id)["max_concurrency"],
+    MAX_QUEUE_DEPTH_PER_MODEL,
+)
+# Runs the blocking Bedrock calls, created when serving starts
+worker_threads = None
+
+
+@app.before_serving
+async def start_worker_threads():
+    global worker_threads
+    # asyncio.to_thread runs on the loop's default executor, which is capped
+    # at min(32, CPUs + 4) threads and would bound every model together.
+    # Threads are started on demand so the pool only grows under load.
+    worker_threads = ThreadPoolExecutor(WORKER_THREADS, thread_name_prefix="bedrock")
+    asyncio.get_running_loop().set_default_executor(worker_threads)
+    log.info(f"Running Bedrock calls on up to {WORKER_THREADS} worker threads")
+
+
+@app.after_serving
+async def stop_worker_threads():
+    worker_threads.shutdown(wait=False)
+
+
+@app.errorhandler(concurrency.QueueFullError)
+@app.errorhandler(wsgi.bedrock.AdmissionTimeout)
+async def queue_full(e):
+    return str(e), 503, {"Retry-After": "1"}
+
+
+def get_session_id() -> str:
+    """
+    Returns the browser's chat session ID, starting a session (and setting
+    its cookie on the response) if it doesn't have one
+    """
+    session_id = g.get("new_session_id") or request.cookies.get(
+        wsgi.CHAT_SESSION_COOKIE
+    )
+    if not sessions.is_valid_session_id(session_id):
+        session_id = g.new_session_id = sessions.new_session_id()
+    return session_id
+
+
+@app.after_request
+async def set_session_cookie(response):
+    if "new_session_id" in g:
+        response.set_cookie(
+            wsgi.CHAT_SESSION_COOKIE, g.new_session_id, httponly=True, samesite="Lax"
+        )
+    return response
+
+
+@app.before_request
+async def start_request_metrics():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.start_request(route, wsgi.get_model_label(request.args.get("model_id")))
+
+
+@app.after_request
+async def record_request_metrics(response):
+    # Streamed bodies record the request when their last chunk is sent
+    if not g.get("streamed"):
+        metrics.observe_request(metrics.get_request_labels(), response.status_code)
+    return response
+
+
+def observe_stream(body):
+    """
+    Wraps a streamed response body so the request's duration is recorded
+    once it ends, Quart responses have no call_on_close
+    """
+    g.streamed = True
+    labels = metrics.get_request_labels()
+
+    async def observed():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            metrics.observe_request(labels, 200)
+
+    return observed()
+
+
+def stream_response(model_id: str, generator):
+    """
+    Streams a blocking SSE generator while holding one of the model's slots
+    """
+    limiter.check_queue(model_id)
+
+    async def generate():
+        async with limiter.limit(model_id):
+            async for event in concurrency.iterate_in_thread(generator):
+                yield event
+
+    headers = {"Content-Type": "text/event-stream", **wsgi.SSE_HEADERS}
+    return observe_stream(generate()), 200, headers
+
+
+@app.route("/get_bedrock_response")
+async def get_bedrock_response() -> str:
+    model_id = request.args.get("model_id")
+    message = request.args.get("chat_input_val")
+    if not wsgi.model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    async with limiter.limit(model_id):
+        return await asyncio.to_thread(
+            wsgi.get_model_answer, model_id, message, get_session_id()
+        )
+
+
+@app.route("/get_bedrock_stream_response")
+async def get_bedrock_stream_response():
+    model_id = request.args.get("model_id")
+    message = request.args.get("chat_input_val")
+    if not wsgi.model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    return stream_response(
+        model_id, wsgi.generate_model_stream(model_id, message, get_session_id())
+    )
+
+
+@app.route("/get_bedrock_rag_response")
+async def get_bedrock_rag_response() -> str:
+    model_id = request.args.get("model_id")
+    message = request.args.get("chat_input_val")
+    if not wsgi.model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    async with limiter.limit(model_id):
+        return await asyncio.to_thread(
+            wsgi.get_rag_answer, model_id, message, get_session_id()
+        )
+
+
+@app.route("/get_bedrock_rag_stream_response")
+async def get_bedrock_rag_stream_response():
+    model_id = request.args.get("model_id")
+    message = request.args.get("chat_input_val")
+    if not wsgi.model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    return stream_response(
+        model_id, wsgi.generate_rag_stream(model_id, message, get_session_id())
+    )
+
+
+@app.route("/batch", methods=["POST"])
+async def batch():
+    body = await request.get_json(silent=True) or {}
+    model_id = body.get("model_id")
+    prompts = body.get("prompts")
+    if not wsgi.model_catalog.is_available(model_id):
+        return f"Model {model_id} is not available", 400
+    if not isinstance(prompts, list) or not prompts:
+        return "prompts must be a non-empty list", 400
+    if len(prompts) > wsgi.BATCH_MAX_PROMPTS:
+        return f"A batch can have at most {wsgi.BATCH_MAX_PROMPTS} prompts", 400
+
+    use_knowledge_base = bool(body.get("use_knowledge_base", False))
+    metrics.set_request_model(wsgi.get_model_label(model_id))
+    log.info(f"Running a batch of {len(prompts)} prompts - Model: {model_id}")
+    lines = wsgi.generate_batch(model_id, prompts, use_knowledge_base)
+    return (
+        observe_stream(concurrency.iterate_in_thread(lines)),
+        200,
+        {"Content-Type": "application/x-ndjson"},
+    )
+
+
+@app.route("/metrics")
+async def metrics_endpoint():
+    return metrics.render_metrics(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+
+@app.route("/", methods=["POST", "GET"])
+async def index():
+    # The page starts with an empty chat so start a new conversation too
+    wsgi.session_store.clear(request.cookies.get(wsgi.CHAT_SESSION_COOKIE))
+    g.new_session_id = sessions.new_session_id()
+    models = wsgi.model_catalog.model_ids()
+    log.debug(f"Available models: {models}")
+    return await render_template(
+        "index.html", models=models, model_info=wsgi.model_catalog.models()
+    )
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5100)
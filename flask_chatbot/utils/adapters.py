@@ -0,0 +1,272 @@
+import json
+
+from functools import reduce
+from operator import itemgetter
+
+
+# Stands in for the message while a body template is serialized
+_MESSAGE_SENTINEL = "\x00message\x00"
+
+
+def compile_path(path: tuple):
+    """
+    Returns a function that walks a parsed response along the given keys
+    and indexes
+    """
+
+    getters = [itemgetter(key) for key in path]
+    if len(getters) == 1:
+        return getters[0]
+
+    def extract(body):
+        for getter in getters:
+            body = getter(body)
+        return body
+
+    return extract
+
+
+class ModelAdapter:
+    """
+    Builds invoke bodies for, and reads generated text from, one model family.
+
+    The default body is serialized once with a sentinel where the message
+    goes, so building a request is two string concatenations around
+    json.dumps(message) rather than a dict copy and a full json.dumps.
+    Per-request overrides take generic names (temperature, top_p,
+    max_tokens) mapped to the family's own keys and fall back to a full
+    serialization.
+    """
+
+    def __init__(
+        self,
+        prefixes: list,
+        body: dict,
+        response_path: tuple,
+        chunk_paths: list = None,
+        prompt_template: str = "{message}",
+        parameter_keys: dict = None,
+        chunk_filter=None,
+    ):
+        self.prefixes = prefixes
+        self.body = body
+        self.prompt_template = prompt_template
+        self.parameter_keys = parameter_keys or {}
+        # response_text(response_body) reads the text straight off the parsed body
+        self.response_text = compile_path(response_path)
+        self.extract_chunks = [
+            compile_path(path) for path in chunk_paths or [response_path]
+        ]
+        self.chunk_filter = chunk_filter
+        template = json.dumps(body)
+        self._head, self._tail = template.split(json.dumps(_MESSAGE_SENTINEL))
+
+    def build_body(self, message: str, overrides: dict = None) -> str:
+        prompt = self.prompt_template.format(message=message)
+        if not overrides:
+            return self._head + json.dumps(prompt) + self._tail
+        body = json.loads(self._head + json.dumps(prompt) + self._tail)
+        for name, value in overrides.items():
+            path = self.parameter_keys.get(name)
+            if path is None:
+                raise ValueError(f"Unsupported parameter override '{name}'")
+            target = reduce(lambda value, key: value[key], path[:-1], body)
+            target[path[-1]] = value
+        return json.dumps(body)
+
+    def chunk_text(self, chunk: dict) -> str:
+        if self.chunk_filter is not None and not self.chunk_filter(chunk):
+            return ""
+        for extract in self.extract_chunks:
+            try:
+                return extract(chunk) or ""
+            except (KeyError, IndexError):
+                continue
+        # Start/stop and metadata chunks carry no text
+        return ""
+
+
+# https://docs.aws.amazon.com/bedrock/latest/userguide/model-parameters.html
+# The longest matching prefix wins, e.g. anthropic.claude-3 over anthropic.claude
+MODEL_ADAPTERS = [
+    ModelAdapter(
+        ["anthropic.claude-3"],
+        {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": 1024,
+            "temperature": 0.1,
+            "top_p": 0.9,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [{"type": "text", "text": _MESSAGE_SENTINEL}],
+                }
+            ],
+        },
+        ("content", 0, "text"),
+        chunk_paths=[("delta", "text")],
+        parameter_keys={
+            "temperature": ("temperature",),
+            "top_p": ("top_p",),
+            "max_tokens": ("max_tokens",),
+        },
+        chunk_filter=lambda chunk: chunk.get("type") == "content_block_delta",
+    ),
+    ModelAdapter(
+        ["anthropic.claude"],
+        {
+            "prompt": _MESSAGE_SENTINEL,
+            "max_tokens_to_sample": 300,
+            "temperature": 0.1,
+            "top_p": 0.9,
+        },
+        ("completion",),
+        prompt_template="\n\nHuman: {message}\n\nAssistant:",
+        parameter_keys={
+            "temperature": ("temperature",),
+            "top_p": ("top_p",),
+            "max_tokens": ("max_tokens_to_sample",),
+        },
+    ),
+    # Titan Text G1 (Lite, Express, Premier) share one format
+    ModelAdapter(
+        ["amazon.titan-text", "amazon.titan-tg1"],
+        {
+            "inputText": _MESSAGE_SENTINEL,
+            "textGenerationConfig": {
+                "maxTokenCount": 4096,
+                "stopSequences": [],
+                "temperature": 0,
+                "topP": 1,
+            },
+        },
+        ("results", 0, "outputText"),
+        chunk_paths=[("outputText",)],
+        parameter_keys={
+            "temperature": ("textGenerationConfig", "temperature"),
+            "top_p": ("textGenerationConfig", "topP"),
+            "max_tokens": ("textGenerationConfig", "maxTokenCount"),
+        },
+    ),
+    ModelAdapter(
+        ["ai21.j2"],
+        {
+            "prompt": _MESSAGE_SENTINEL,
+            "maxTokens": 200,
+            "temperature": 0.5,
+            "topP": 0.5,
+        },
+        ("completions", 0, "data", "text"),
+        parameter_keys={
+            "temperature": ("temperature",),
+            "top_p": ("topP",),
+            "max_tokens": ("maxTokens",),
+        },
+    ),
+    ModelAdapter(
+        ["cohere.command-r"],
+        {
+            "message": _MESSAGE_SENTINEL,
+            "max_tokens": 512,
+            "temperature": 0.3,
+            "p": 0.75,
+        },
+        ("text",),
+        parameter_keys={
+            "temperature": ("temperature",),
+            "top_p": ("p",),
+            "max_tokens": ("max_tokens",),
+        },
+    ),
+    ModelAdapter(
+        ["cohere.command"],
+        {
+            "prompt": _MESSAGE_SENTINEL,
+            "max_tokens": 200,
+            "temperature": 0.5,
+            "p": 0.5,
+        },
+        ("generations", 0, "text"),
+        # Stream chunks are usually flat but can carry full generations
+        chunk_paths=[("text",), ("generations", 0, "text")],
+        parameter_keys={
+            "temperature": ("temperature",),
+            "top_p": ("p",),
+            "max_tokens": ("max_tokens",),
+        },
+    ),
+    ModelAdapter(
+        ["meta.llama3"],
+        {
+            "prompt": _MESSAGE_SENTINEL,
+            "max_gen_len": 512,
+            "temperature": 0.1,
+            "top_p": 0.9,
+        },
+        ("generation",),
+        prompt_template=(
+            "<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n"
+            "{message}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+        ),
+        parameter_keys={
+            "temperature": ("temperature",),
+            "top_p": ("top_p",),
+            "max_tokens": ("max_gen_len",),
+        },
+    ),
+    ModelAdapter(
+        ["meta.llama2"],
+        {
+            "prompt": _MESSAGE_SENTINEL,
+            "max_gen_len": 128,
+            "temperature": 0.1,
+            "top_p": 0.9,
+        },
+        ("generation",),
+        parameter_keys={
+            "temperature": ("temperature",),
+            "top_p": ("top_p",),
+            "max_tokens": ("max_gen_len",),
+        },
+    ),
+    ModelAdapter(
+        ["mistral."],
+        {
+            "prompt": _MESSAGE_SENTINEL,
+            "max_tokens": 512,
+            "temperature": 0.5,
+            "top_p": 0.9,
+        },
+        ("outputs", 0, "text"),
+        prompt_template="<s>[INST] {message} [/INST]",
+        parameter_keys={
+            "temperature": ("temperature",),
+            "top_p": ("top_p",),
+            "max_tokens": ("max_tokens",),
+        },
+    ),
+]
+
+_adapters_by_model_id = {}
+
+
+def get_model_adapter(model_id: str) -> ModelAdapter:
+    """
+    Returns the adapter with the longest prefix of the model ID, raising
+    ValueError for unknown families
+    """
+    adapter = _adapters_by_model_id.get(model_id)
+    if adapter is None:
+        matches = [
+            (len(prefix), index)
+            for index, candidate in enumerate(MODEL_ADAPTERS)
+            for prefix in candidate.prefixes
+            if model_id.startswith(prefix)
+        ]
+        if not matches:
+            raise ValueError(f"No model adapter found for model ID {model_id}")
+        # Ties go to the adapter listed first
+        _, index = max(matches, key=lambda match: (match[0], -match[1]))
+        adapter = MODEL_ADAPTERS[index]
+        _adapters_by_model_id[model_id] = adapter
+    return adapter
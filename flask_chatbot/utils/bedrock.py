@@ -1,8 +1,22 @@
 import boto3
+import collections
+import contextvars
+import itertools
 import json
+import os
+import random
+import threading
+import time
 
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from loguru import logger as log
 
+from . import metrics
+from .adapters import get_model_adapter
+from .inventory import NameIndex, build_knowledge_base_index
+
 
 # Temporarily hardcoding model IDs but this is not being used
 # The get_foundation_model_ids gets this list dynamically
@@ -27,62 +41,130 @@ BEDROCK_MODEL_IDS = [
     "meta.llama2-70b-chat-v1",
 ]
 
-# https://docs.aws.amazon.com/bedrock/latest/userguide/model-parameters.html
-MODEL_INVOKE_BODY_MAP = {
-    "amazon.titan": {
-        "inputText": "${{message}}",
-        "textGenerationConfig": {
-            "maxTokenCount": 4096,
-            "stopSequences": [],
-            "temperature": 0,
-            "topP": 1,
-        },
-    },
-    "ai21.j2": {
-        "prompt": "${{message}}",
-        "maxTokens": 200,
-        "temperature": 0.5,
-        "topP": 0.5,
-    },
-    "anthropic.claude": {
-        "prompt": "\n\nHuman: ${{message}}\n\nAssistant:",
-        "max_tokens_to_sample": 300,
-        "temperature": 0.1,
-        "top_p": 0.9,
-    },
-    "cohere.command": {
-        "prompt": "${{message}}",
-        "max_tokens": 200,
-        "temperature": 0.5,
-        "p": 0.5,
-    },
-    "meta.llama2": {
-        "prompt": "${{message}}",
-        "max_gen_len": 128,
-        "temperature": 0.1,
-        "top_p": 0.9,
-    },
+# Same embedding model and settings the knowledge base is created with.
+# Titan v1 takes no settings. For a knowledge base created with
+# --embedding-model amazon.titan-embed-text-v2:0 --dimensions 512 use
+# that model with {"dimensions": 512, "normalize": True}.
+BEDROCK_EMBED_MODEL_ID = "amazon.titan-embed-text-v1"
+BEDROCK_EMBED_SETTINGS = {}
+
+# Usage Bedrock reports in the invoke_model response headers, and in the
+# last chunk of a response stream
+INPUT_TOKENS_HEADER = "x-amzn-bedrock-input-token-count"
+OUTPUT_TOKENS_HEADER = "x-amzn-bedrock-output-token-count"
+INVOCATION_LATENCY_HEADER = "x-amzn-bedrock-invocation-latency"
+STREAM_METRICS_KEY = "amazon-bedrock-invocationMetrics"
+
+# botocore settings shared by every client in the registry. Generation
+# calls can run for a while so the read timeout is well above the default.
+CLIENT_CONFIG = {
+    "max_pool_connections": 50,
+    "tcp_keepalive": True,
+    "connect_timeout": 5,
+    "read_timeout": 120,
+    "retries": {"mode": "adaptive", "max_attempts": 4},
+}
+# Calls on the runtime clients are retried by the admission controller,
+# which backs off and shrinks the model's concurrency when throttled. One
+# botocore retry covers dropped connections without hiding throttling from
+# it or multiplying the retries.
+SERVICE_CLIENT_CONFIG = {
+    "bedrock-runtime": {"retries": {"mode": "standard", "max_attempts": 2}},
+    "bedrock-agent-runtime": {"retries": {"mode": "standard", "max_attempts": 2}},
+}
+
+# Cheap calls used to open a pooled connection during warm-up. bedrock-runtime
+# embeds a couple of words, which stores nothing and costs a few tokens.
+# bedrock-agent-runtime has no call that doesn't need a knowledge base, so
+# it's only built and its first retrieve opens the connection.
+WARM_UP_CALLS = {
+    "bedrock": lambda client: client.list_foundation_models(
+        byOutputModality="TEXT"
+    ),
+    "bedrock-runtime": lambda client: client.invoke_model(
+        modelId=BEDROCK_EMBED_MODEL_ID,
+        body=json.dumps({"inputText": "warm up", **BEDROCK_EMBED_SETTINGS}),
+        accept="application/json",
+        contentType="application/json",
+    ),
+    "bedrock-agent": lambda client: client.list_knowledge_bases(maxResults=1),
 }
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def configure_clients(**config) -> None:
+    """
+    Updates CLIENT_CONFIG and drops the registry so new settings apply
+    """
+    with _clients_lock:
+        CLIENT_CONFIG.update(config)
+        _clients.clear()
+
+
+def get_client(service: str, region: str):
+    """
+    Returns the shared client for (service, region), creating it on first use.
+    boto3 clients are thread safe so one per process is enough.
+    """
+    key = (service, region)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            config = {**CLIENT_CONFIG, **SERVICE_CLIENT_CONFIG.get(service, {})}
+            client = boto3.client(service, region_name=region, config=Config(**config))
+            _clients[key] = client
+            log.debug(f"Created {service} client for {region}")
+        return client
+
+
+def register_client(service: str, region: str, client) -> None:
+    """
+    Makes get_client return the given client for (service, region), e.g. a
+    stand-in for Bedrock when benchmarking without AWS
+    """
+    with _clients_lock:
+        _clients[(service, region)] = client
+
+
+def warm_up_clients(region: str, services: list = None) -> None:
+    """
+    Builds the clients up front and opens a connection for those with a
+    WARM_UP_CALLS entry, so the first user request doesn't pay for it
+    """
+    if services is None:
+        services = [
+            "bedrock",
+            "bedrock-runtime",
+            "bedrock-agent",
+            "bedrock-agent-runtime",
+        ]
+    for service in services:
+        client = get_client(service, region)
+        warm_up = WARM_UP_CALLS.get(service)
+        if warm_up is None:
+            continue
+        try:
+            warm_up(client)
+        except Exception as e:
+            log.warning(f"Failed to warm up the {service} client: {e}")
+
 
 def get_bedrock_client(region: str):
-    return boto3.client("bedrock", region_name=region)
+    return get_client("bedrock", region)
 
 
 def get_bedrock_runtime_client(region: str):
-    return boto3.client("bedrock-runtime", region_name=region)
+    return get_client("bedrock-runtime", region)
 
 
 def get_bedrock_agent_client(region: str):
-    return boto3.client("bedrock-agent", region_name=region)
+    return get_client("bedrock-agent", region)
 
 
 def get_bedrock_agent_runtime_client(region: str):
-    return boto3.client("bedrock-agent-runtime", region_name=region)
-
-
-def get_model_id_key(model_id: str) -> str:
-    return model_id.split("-")[0]
+    return get_client("bedrock-agent-runtime", region)
 
 
 def get_foundation_model_ids(client) -> list:
@@ -96,19 +178,38 @@ def get_foundation_model_ids(client) -> list:
     return [model["modelId"] for model in response["modelSummaries"]]
 
 
-def get_model_invoke_body(model_id: str, message: str) -> json:
-    body_key = get_model_id_key(model_id)
-    if body_key not in MODEL_INVOKE_BODY_MAP:
-        raise ValueError(f"Model ID {model_id} not found in MODEL_INVOKE_BODY_MAP")
+def get_model_invoke_body(
+    model_id: str, message: str, overrides: dict = None
+) -> json:
+    with metrics.span("build_body", model_id):
+        return get_model_adapter(model_id).build_body(message, overrides)
 
-    invoke_body = dict(MODEL_INVOKE_BODY_MAP[body_key])
-    if "prompt" in invoke_body:
-        invoke_body["prompt"] = invoke_body["prompt"].replace("${{message}}", message)
-    elif "inputText" in invoke_body:
-        invoke_body["inputText"] = invoke_body["inputText"].replace(
-            "${{message}}", message
-        )
-    return json.dumps(invoke_body)
+
+def record_invocation_metrics(model_id: str, response: dict) -> None:
+    """
+    Records the token counts and latency from invoke_model response headers
+    """
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    metrics.record_invocation(
+        model_id,
+        headers.get(INPUT_TOKENS_HEADER),
+        headers.get(OUTPUT_TOKENS_HEADER),
+        headers.get(INVOCATION_LATENCY_HEADER),
+    )
+
+
+def get_response_text(model_id: str, response_body: dict) -> str:
+    """
+    Pulls the generated text out of an invoke_model response body
+    """
+    return get_model_adapter(model_id).response_text(response_body)
+
+
+def get_stream_chunk_text(model_id: str, chunk: dict) -> str:
+    """
+    Pulls the text out of one invoke_model_with_response_stream chunk
+    """
+    return get_model_adapter(model_id).chunk_text(chunk)
 
 
 def invoke_model(client, model_id: str, invoke_body: json) -> str:
@@ -117,57 +218,944 @@ def invoke_model(client, model_id: str, invoke_body: json) -> str:
     """
     accept = "application/json"
     content_type = "application/json"
-    response = client.invoke_model(
-        modelId=model_id,
-        body=invoke_body,
-        accept=accept,
-        contentType=content_type,
-    )
-    model_key = get_model_id_key(model_id)
-    response_body = json.loads(response.get("body").read())
-
-    if model_key == "amazon.titan":
-        return response_body["results"][0]["outputText"]
-    if model_key == "ai21.j2":
-        return response_body["completions"][0]["data"]["text"]
-    if model_key == "anthropic.claude":
-        return response_body["completion"]
-    if model_key == "cohere.command":
-        return response_body["generations"][0]["text"]
-    if model_key == "meta.llama2":
-        return response_body["generation"]
-    return None
-
-
-def invoke_knowledge_base(client, prompt: str, kb_id: str, model_arn: str):
+    with metrics.span("generate", model_id):
+        response = client.invoke_model(
+            modelId=model_id,
+            body=invoke_body,
+            accept=accept,
+            contentType=content_type,
+        )
+        raw_body = response.get("body").read()
+    record_invocation_metrics(model_id, response)
+    with metrics.span("parse", model_id):
+        return get_response_text(model_id, json.loads(raw_body))
+
+
+def get_embedding(
+    client, text: str, model_id: str = None, settings: dict = None
+) -> list:
+    """
+    Returns the Titan embedding of the given text, by default from
+    BEDROCK_EMBED_MODEL_ID with BEDROCK_EMBED_SETTINGS
+    """
+    if model_id is None:
+        model_id = BEDROCK_EMBED_MODEL_ID
+        settings = BEDROCK_EMBED_SETTINGS if settings is None else settings
+    with metrics.span("embed", model_id):
+        response = client.invoke_model(
+            modelId=model_id,
+            body=json.dumps({"inputText": text, **(settings or {})}),
+            accept="application/json",
+            contentType="application/json",
+        )
+        embedding = json.loads(response.get("body").read())["embedding"]
+    record_invocation_metrics(model_id, response)
+    return embedding
+
+
+def invoke_model_with_response_stream(client, model_id: str, invoke_body: json):
+    """
+    Invokes the specified model and yields the generated text as it arrives.
+    The stream holds an admission slot until it's exhausted or closed.
+    """
+    controller = get_admission_controller(model_id, client.meta.region_name)
+    with metrics.span("admission", model_id):
+        controller.acquire(estimate_tokens(invoke_body), ADMISSION_TIMEOUT_SECONDS)
+    throttled = False
+    start = time.perf_counter()
+    first_token = True
+    try:
+        response = client.invoke_model_with_response_stream(
+            modelId=model_id,
+            body=invoke_body,
+            accept="application/json",
+            contentType="application/json",
+        )
+        for event in response.get("body"):
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+            chunk = json.loads(chunk["bytes"])
+            usage = chunk.get(STREAM_METRICS_KEY)
+            if usage:
+                metrics.record_invocation(
+                    model_id,
+                    usage.get("inputTokenCount"),
+                    usage.get("outputTokenCount"),
+                    usage.get("invocationLatency"),
+                )
+            text = get_stream_chunk_text(model_id, chunk)
+            if text:
+                if first_token:
+                    first_token = False
+                    elapsed = time.perf_counter() - start
+                    metrics.observe("first_token", elapsed, model_id)
+                yield text
+    except Exception as e:
+        throttled = is_throttling_error(e)
+        raise
+    finally:
+        # Includes the time the caller spent between chunks sending them on
+        metrics.observe("generate", time.perf_counter() - start, model_id)
+        controller.release(throttled=throttled)
+
+
+def format_sse(data: dict, event: str = None) -> str:
+    """
+    Formats a Server-Sent Events message with a JSON payload
+    """
+    message = f"data: {json.dumps(data)}\n\n"
+    if event is not None:
+        message = f"event: {event}\n{message}"
+    return message
+
+
+def invoke_knowledge_base(
+    client, prompt: str, kb_id: str, model_arn: str, session_id: str = None
+):
+    """
+    Passing the sessionId of an earlier response continues that
+    conversation, so follow-up questions don't need the earlier turns
+    """
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/bedrock-agent-runtime/client/retrieve_and_generate.html#AgentsforBedrockRuntime.Client.retrieve_and_generate
-    response = client.retrieve_and_generate(
-        input={"text": prompt},
-        retrieveAndGenerateConfiguration={
-            "type": "KNOWLEDGE_BASE",
-            "knowledgeBaseConfiguration": {
-                "knowledgeBaseId": kb_id,
-                "modelArn": model_arn,
+    kwargs = {"sessionId": session_id} if session_id else {}
+    with metrics.span("retrieve_and_generate", model_arn.split("/")[-1]):
+        response = client.retrieve_and_generate(
+            input={"text": prompt},
+            retrieveAndGenerateConfiguration={
+                "type": "KNOWLEDGE_BASE",
+                "knowledgeBaseConfiguration": {
+                    "knowledgeBaseId": kb_id,
+                    "modelArn": model_arn,
+                },
             },
-        },
-    )
+            **kwargs,
+        )
     return response
 
 
-def get_knowledge_base_id(client, name: str) -> str:
-    knowledge_bases = client.list_knowledge_bases()["knowledgeBaseSummaries"]
-    if not knowledge_bases:
-        log.error("No knowledge bases found")
-        return ""
-
-    knowledge_base_id = ""
-    for kb in knowledge_bases:
-        if kb["name"] == name:
-            knowledge_base_id = kb["knowledgeBaseId"]
+def _env_int(name: str, default: int = None) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+# Per-model quotas for the admission controller. Requests and tokens per
+# minute are unlimited unless set, so only real ThrottlingExceptions shrink
+# the concurrency limit. Bedrock on-demand quotas differ per model and
+# region, set the account's with configure_admission or the environment:
+# BEDROCK_REQUESTS_PER_MINUTE, BEDROCK_TOKENS_PER_MINUTE and
+# BEDROCK_MAX_CONCURRENCY for every model, and per model e.g.
+# BEDROCK_MODEL_RATE_LIMITS='{"anthropic.claude-v2": {"max_concurrency": 8}}'
+DEFAULT_RATE_LIMITS = {
+    "requests_per_minute": _env_int("BEDROCK_REQUESTS_PER_MINUTE"),
+    "tokens_per_minute": _env_int("BEDROCK_TOKENS_PER_MINUTE"),
+    "max_concurrency": _env_int("BEDROCK_MAX_CONCURRENCY", 32),
+}
+MODEL_RATE_LIMITS = json.loads(os.environ.get("BEDROCK_MODEL_RATE_LIMITS") or "{}")
+# How long a request may wait for admission before it's rejected
+ADMISSION_TIMEOUT_SECONDS = 10
+# Throttled calls are retried after a random wait of up to base * 2^retry
+# seconds, capped at the max
+ADMISSION_RETRY_BASE_SECONDS = 0.2
+ADMISSION_RETRY_MAX_SECONDS = 5
+
+# Keys holding the max generated tokens in each family's invoke body
+MAX_TOKEN_KEYS = [
+    "maxTokenCount",
+    "maxTokens",
+    "max_tokens_to_sample",
+    "max_tokens",
+    "max_gen_len",
+]
+
+
+class AdmissionTimeout(Exception):
+    """
+    Raised when a request can't be admitted before its deadline
+    """
+
+
+class TokenBucket:
+    """
+    Refills at rate_per_minute up to a burst of one minute's worth
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Seconds until amount tokens are available, 0 if they already are
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class AdmissionController:
+    """
+    Admits calls to one model in one region.
+
+    Request and token rates are held under the model's quota with token
+    buckets, when one is given, and concurrency follows AIMD: it grows by
+    one every time a full window of calls succeeds and halves on
+    ThrottlingException. Callers that can't be admitted wait up to their
+    deadline instead of failing straight away.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+        max_concurrency: int = 32,
+    ):
+        # No bucket for a rate without a quota
+        self.requests = requests_per_minute and TokenBucket(requests_per_minute)
+        self.tokens = tokens_per_minute and TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, estimated_tokens: int, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                buckets = [(self.requests, 1), (self.tokens, estimated_tokens)]
+                buckets = [(bucket, n) for bucket, n in buckets if bucket]
+                wait = max([bucket.wait_time(n) for bucket, n in buckets], default=0)
+                if wait == 0 and self.in_flight < int(self.limit):
+                    for bucket, n in buckets:
+                        bucket.take(n)
+                    self.in_flight += 1
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise AdmissionTimeout("Timed out waiting for Bedrock capacity")
+                # Woken early when a call finishes and frees a slot
+                self._cond.wait(min(remaining, wait or remaining))
+
+    def release(self, throttled: bool = False) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "throttled": self.throttled,
+                "rejected": self.rejected,
+            }
+
+
+_admission_controllers = {}
+_admission_controllers_lock = threading.Lock()
+
+
+def configure_admission(model_limits: dict = None, **limits) -> None:
+    """
+    Updates DEFAULT_RATE_LIMITS and MODEL_RATE_LIMITS and drops the
+    controllers so the new limits apply
+    """
+    with _admission_controllers_lock:
+        DEFAULT_RATE_LIMITS.update(limits)
+        MODEL_RATE_LIMITS.update(model_limits or {})
+        _admission_controllers.clear()
+
+
+def get_rate_limits(model_id: str) -> dict:
+    return {**DEFAULT_RATE_LIMITS, **MODEL_RATE_LIMITS.get(model_id, {})}
+
+
+def get_admission_controller(model_id: str, region: str) -> AdmissionController:
+    key = (model_id, region)
+    with _admission_controllers_lock:
+        controller = _admission_controllers.get(key)
+        if controller is None:
+            controller = AdmissionController(**get_rate_limits(model_id))
+            _admission_controllers[key] = controller
+        return controller
+
+
+def get_admission_stats() -> dict:
+    """
+    Returns {(model_id, region): stats} of every admission controller
+    """
+    with _admission_controllers_lock:
+        controllers = list(_admission_controllers.items())
+    return {key: controller.stats() for key, controller in controllers}
+
+
+def admission_events() -> list:
+    return [
+        ((model_id, region, event), stats[event])
+        for (model_id, region), stats in get_admission_stats().items()
+        for event in ("throttled", "rejected")
+    ]
+
+
+def admission_concurrency() -> list:
+    return [
+        ((model_id, region, value), stats[value])
+        for (model_id, region), stats in get_admission_stats().items()
+        for value in ("limit", "in_flight")
+    ]
+
+
+metrics.ADMISSION_EVENTS.add_source(admission_events)
+metrics.ADMISSION_CONCURRENCY.add_source(admission_concurrency)
+
+
+def is_throttling_error(error: Exception) -> bool:
+    return (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code") == "ThrottlingException"
+    )
+
+
+def is_capacity_error(error: Exception) -> bool:
+    """
+    True when Bedrock is out of capacity for the model, so retrying the
+    request another way would only add to the load
+    """
+    return isinstance(error, AdmissionTimeout) or is_throttling_error(error)
+
+
+def estimate_tokens(invoke_body: str) -> int:
+    """
+    Rough input + max output token count, ~4 characters per token
+    """
+    body = json.loads(invoke_body)
+    config = body.get("textGenerationConfig", body)
+    max_output = sum(config.get(key, 0) for key in MAX_TOKEN_KEYS)
+    return len(invoke_body) // 4 + max_output
+
+
+def call_with_admission(
+    model_id: str, region: str, estimated_tokens: int, fn, *args
+):
+    """
+    Calls fn once the model's controller admits it. Throttled calls are
+    retried with exponential backoff and jitter until
+    ADMISSION_TIMEOUT_SECONDS runs out.
+    """
+    controller = get_admission_controller(model_id, region)
+    deadline = time.monotonic() + ADMISSION_TIMEOUT_SECONDS
+    for retry in itertools.count():
+        with metrics.span("admission", model_id):
+            controller.acquire(
+                estimated_tokens, max(0.0, deadline - time.monotonic())
+            )
+        try:
+            result = fn(*args)
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            controller.release(throttled=throttled)
+            backoff = random.uniform(
+                0,
+                min(
+                    ADMISSION_RETRY_MAX_SECONDS,
+                    ADMISSION_RETRY_BASE_SECONDS * 2**retry,
+                ),
+            )
+            if throttled and time.monotonic() + backoff < deadline:
+                log.warning(
+                    f"Throttled by Amazon Bedrock - Model: {model_id}, "
+                    f"retrying in {backoff:.2f}s"
+                )
+                time.sleep(backoff)
+                continue
+            raise
+        controller.release()
+        return result
+
+
+def admitted_invoke_model(client, model_id: str, invoke_body: json) -> str:
+    return call_with_admission(
+        model_id,
+        client.meta.region_name,
+        estimate_tokens(invoke_body),
+        invoke_model,
+        client,
+        model_id,
+        invoke_body,
+    )
+
+
+def admitted_invoke_knowledge_base(
+    client, prompt: str, kb_id: str, model_arn: str, session_id: str = None
+):
+    # Retrieved chunks are added to the prompt so budget generously for them
+    return call_with_admission(
+        model_arn.split("/")[-1],
+        client.meta.region_name,
+        len(prompt) // 4 + 2000,
+        invoke_knowledge_base,
+        client,
+        prompt,
+        kb_id,
+        model_arn,
+        session_id,
+    )
+
+
+# Hedged invoke_model calls, off by default. A call still running after the
+# given percentile of that model's recent latencies is sent again and the
+# first answer wins. Each call earns budget_ratio of a hedge, so hedges add
+# at most that fraction of extra calls (bursts up to max_budget hedges).
+HEDGE_CONFIG = {
+    "enabled": False,
+    "percentile": 95,
+    "min_delay_seconds": 0.5,
+    "min_samples": 20,
+    "window": 200,
+    "budget_ratio": 0.05,
+    "max_budget": 10,
+}
+# Where a model's hedges go instead of the same model and region, e.g.
+# {"anthropic.claude-v2": ("us-west-2", "anthropic.claude-v2")}. The other
+# model must take the same invoke body (same adapter).
+HEDGE_TARGETS = {}
+
+
+class HedgePolicy:
+    """
+    Decides when a call to one model in one region is hedged.
+
+    The delay is a percentile of the latencies of recent calls and hedges
+    are paid for from a budget that each call tops up by budget_ratio, so a
+    slow patch of Bedrock can't double the request volume.
+    """
+
+    def __init__(
+        self,
+        percentile: float,
+        min_delay_seconds: float,
+        min_samples: int,
+        window: int,
+        budget_ratio: float,
+        max_budget: float,
+    ):
+        self.percentile = percentile
+        self.min_delay_seconds = min_delay_seconds
+        self.min_samples = min_samples
+        self.budget_ratio = budget_ratio
+        self.max_budget = max_budget
+        self.budget = 0.0
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def start_call(self):
+        """
+        Counts a call and returns how long to wait before hedging it, None
+        while there are too few latencies to tell what slow means
+        """
+        with self._lock:
+            self.calls += 1
+            self.budget = min(self.max_budget, self.budget + self.budget_ratio)
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay_seconds, ordered[index])
+
+    def can_hedge(self) -> bool:
+        with self._lock:
+            return self.budget >= 1
+
+    def try_hedge(self) -> bool:
+        with self._lock:
+            if self.budget < 1:
+                self.over_budget += 1
+                return False
+            self.budget -= 1
+            self.hedged += 1
+            return True
+
+    def skipped_hedge(self) -> None:
+        """
+        Counts a call that ran past the delay with no budget to hedge it
+        """
+        with self._lock:
+            self.over_budget += 1
+
+    def hedge_won(self) -> None:
+        with self._lock:
+            self.hedge_wins += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "over_budget": self.over_budget,
+                "budget": round(self.budget, 2),
+                "samples": len(self._latencies),
+            }
+
+
+_hedge_policies = {}
+_hedge_policies_lock = threading.Lock()
+# Runs the hedges, created on the first one
+_hedge_executor = None
+
+
+def configure_hedging(targets: dict = None, **config) -> None:
+    """
+    Updates HEDGE_CONFIG and HEDGE_TARGETS and drops the latency history
+    """
+    targets = targets or {}
+    for model_id, (_, target_model_id) in targets.items():
+        if get_model_adapter(target_model_id) is not get_model_adapter(model_id):
+            raise ValueError(
+                f"Can't hedge {model_id} with {target_model_id}, "
+                "their invoke bodies differ"
+            )
+    with _hedge_policies_lock:
+        HEDGE_CONFIG.update(config)
+        HEDGE_TARGETS.update(targets)
+        _hedge_policies.clear()
+
+
+def get_hedge_policy(model_id: str, region: str) -> HedgePolicy:
+    key = (model_id, region)
+    with _hedge_policies_lock:
+        policy = _hedge_policies.get(key)
+        if policy is None:
+            settings = {k: v for k, v in HEDGE_CONFIG.items() if k != "enabled"}
+            policy = HedgePolicy(**settings)
+            _hedge_policies[key] = policy
+        return policy
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """
+    Returns the pool hedges run on. Hedges are admitted like any other
+    call, so there's no use for more threads than the largest concurrency
+    limit of the admission controllers.
+    """
+    global _hedge_executor
+    with _hedge_policies_lock:
+        if _hedge_executor is None:
+            workers = max(
+                limits.get("max_concurrency", DEFAULT_RATE_LIMITS["max_concurrency"])
+                for limits in [DEFAULT_RATE_LIMITS, *MODEL_RATE_LIMITS.values()]
+            )
+            _hedge_executor = ThreadPoolExecutor(workers, thread_name_prefix="hedge")
+        return _hedge_executor
+
+
+def _timed_call(policy: HedgePolicy, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    policy.record(time.perf_counter() - start)
+    return result
+
+
+def _start_thread(fn, *args) -> Future:
+    """
+    Runs fn on a thread of its own, in a copy of the caller's context so
+    the request's metric labels follow it
+    """
+    future = Future()
+    context = contextvars.copy_context()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(context.run(fn, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="hedged-call", daemon=True).start()
+    return future
+
+
+def hedged_invoke_model(client, model_id: str, invoke_body: json) -> str:
+    """
+    admitted_invoke_model that is sent a second time, to HEDGE_TARGETS or
+    the same model, when it runs slower than most recent calls. The first
+    answer is returned. A call already sent can't be cancelled so the
+    slower one runs to the end and its answer is dropped.
+    """
+    region = client.meta.region_name
+    policy = get_hedge_policy(model_id, region)
+    delay = policy.start_call()
+    args = (policy, admitted_invoke_model, client, model_id, invoke_body)
+    if delay is None or not policy.can_hedge():
+        # Nothing could be hedged, so the call runs on the caller's thread
+        start = time.perf_counter()
+        text = _timed_call(*args)
+        if delay is not None and time.perf_counter() - start > delay:
+            policy.skipped_hedge()
+            metrics.BEDROCK_HEDGES.inc(model=model_id, outcome="over_budget")
+        return text
+
+    # A blocking call can't be abandoned, so the primary gets its own thread
+    # (not a pool slot it might queue for) while this one waits for either
+    primary = _start_thread(_timed_call, *args)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+    if not policy.try_hedge():
+        metrics.BEDROCK_HEDGES.inc(model=model_id, outcome="over_budget")
+        return primary.result()
+
+    hedge_region, hedge_model_id = HEDGE_TARGETS.get(model_id, (region, model_id))
+    log.info(
+        f"Hedging {model_id} call after {delay:.2f}s - "
+        f"Model: {hedge_model_id}, Region: {hedge_region}"
+    )
+    metrics.BEDROCK_HEDGES.inc(model=model_id, outcome="sent")
+    hedge_client = client
+    if hedge_region != region:
+        hedge_client = get_client("bedrock-runtime", hedge_region)
+    hedge = get_hedge_executor().submit(
+        contextvars.copy_context().run,
+        admitted_invoke_model,
+        hedge_client,
+        hedge_model_id,
+        invoke_body,
+    )
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                text = future.result()
+            except Exception as e:
+                if pending:
+                    log.warning(
+                        f"Hedged {model_id} call failed, waiting on the other: {e}"
+                    )
+                error = error or e
+                continue
+            if future is hedge:
+                policy.hedge_won()
+                metrics.BEDROCK_HEDGES.inc(model=model_id, outcome="won")
+            return text
+    raise error
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls so only the first one goes to
+    Bedrock and every caller that arrives while it's in flight shares its
+    result (or its exception)
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.deduplicated = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._in_flight[key] = call
+                self.calls += 1
+            else:
+                self.deduplicated += 1
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn(*args, **kwargs)
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            call["done"].set()
+        return call["result"]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "deduplicated": self.deduplicated,
+                "in_flight": len(self._in_flight),
+            }
+
+
+single_flight = SingleFlight()
+
+
+def single_flight_calls() -> list:
+    stats = single_flight.stats()
+    return [(("leader",), stats["calls"]), (("follower",), stats["deduplicated"])]
+
+
+metrics.SINGLE_FLIGHT_CALLS.add_source(single_flight_calls)
+
+
+def coalesced_invoke_model(client, model_id: str, invoke_body: json) -> str:
+    """
+    invoke_model shared by concurrent callers with the same model and body,
+    hedged when HEDGE_CONFIG is enabled
+    """
+    key = ("invoke_model", model_id, invoke_body)
+    invoke = hedged_invoke_model if HEDGE_CONFIG["enabled"] else admitted_invoke_model
+    return single_flight.do(key, invoke, client, model_id, invoke_body)
+
+
+def coalesced_invoke_knowledge_base(
+    client, prompt: str, kb_id: str, model_arn: str, session_id: str = None
+):
+    """
+    invoke_knowledge_base shared by concurrent callers with the same prompt,
+    knowledge base, model and session
+    """
+    key = ("retrieve_and_generate", model_arn, kb_id, prompt, session_id)
+    return single_flight.do(
+        key,
+        admitted_invoke_knowledge_base,
+        client,
+        prompt,
+        kb_id,
+        model_arn,
+        session_id,
+    )
+
+
+# Prompt used when retrieval and generation are split so the answer can be
+# streamed. Mirrors the grounding instructions of retrieve_and_generate.
+RAG_PROMPT_TEMPLATE = """Use the following search results to answer the question.
+If the search results don't contain the answer, say that you don't know.
+
+<search_results>
+${{search_results}}
+</search_results>
+
+Question: ${{message}}"""
+
+
+def retrieve(client, prompt: str, kb_id: str, number_of_results: int = 5) -> list:
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/bedrock-agent-runtime/client/retrieve.html
+    with metrics.span("retrieve"):
+        response = client.retrieve(
+            knowledgeBaseId=kb_id,
+            retrievalQuery={"text": prompt},
+            retrievalConfiguration={
+                "vectorSearchConfiguration": {"numberOfResults": number_of_results}
+            },
+        )
+    return response["retrievalResults"]
+
+
+def get_reference_citation(reference: dict) -> dict:
+    """
+    Flattens a retrieval result or retrieved reference into text and source
+    """
+    location = reference.get("location", {})
+    return {
+        "text": reference["content"]["text"],
+        "uri": location.get("s3Location", {}).get("uri", ""),
+    }
+
+
+def get_retrieval_citations(retrieval_results: list) -> list:
+    return [get_reference_citation(result) for result in retrieval_results]
+
+
+def get_knowledge_base_citations(response: dict) -> list:
+    """
+    Returns the citations of a blocking retrieve_and_generate response
+    """
+    return [
+        get_reference_citation(reference)
+        for citation in response.get("citations", [])
+        for reference in citation.get("retrievedReferences", [])
+    ]
+
+
+def get_rag_prompt(
+    message: str, retrieval_results: list, max_context_chars: int = None
+) -> str:
+    """
+    Fills RAG_PROMPT_TEMPLATE with as many of the retrieved chunks, best
+    first, as fit in max_context_chars
+    """
+    chunks = []
+    context_chars = 0
+    for result in retrieval_results:
+        text = result["content"]["text"]
+        over_limit = context_chars + len(text) > (max_context_chars or float("inf"))
+        if chunks and over_limit:
             break
-    if not knowledge_base_id:
-        log.error(f"Knowledge base '{name}' not found in {knowledge_bases}")
+        chunks.append(text)
+        context_chars += len(text)
+    search_results = "\n\n".join(chunks)
+    return RAG_PROMPT_TEMPLATE.replace("${{search_results}}", search_results).replace(
+        "${{message}}", message
+    )
+
+
+class KnowledgeBaseResolver:
+    """
+    Maps knowledge base names to IDs with a TTL cache so the chat routes
+    don't pay a list_knowledge_bases round trip per request.
+
+    Every page of list_knowledge_bases is read on refresh, and concurrent
+    refreshes share one listing. Names that still aren't found after a
+    refresh are remembered for miss_ttl so a typo or a deleted knowledge
+    base doesn't list every page again on each request. Call start() to
+    refresh the map in a background thread before it goes stale and
+    invalidate() when a lookup turns out to be wrong (e.g. the knowledge
+    base was deleted and recreated).
+    """
+
+    def __init__(self, client, ttl: float = 300, miss_ttl: float = None):
+        self.client = client
+        self.ttl = ttl
+        self.miss_ttl = ttl if miss_ttl is None else miss_ttl
+        self._index = NameIndex([])
+        self._expires_at = 0.0
+        # name -> monotonic time until which a lookup misses without a refresh
+        self._misses = {}
+        self._refreshes = SingleFlight()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self) -> NameIndex:
+        """
+        Reloads the name index from every page of list_knowledge_bases
+        """
+        return self._refreshes.do("refresh", self._load)
 
+    def _load(self) -> NameIndex:
+        index = build_knowledge_base_index(self.client)
+        with self._lock:
+            self._index = index
+            self._expires_at = time.monotonic() + self.ttl
+        return index
+
+    def get(self, name: str) -> str:
+        """
+        Returns the ID of the named knowledge base or "" if it doesn't exist.
+        A miss forces one refresh in case the knowledge base was just
+        created, then misses without one until miss_ttl runs out.
+        """
+        with metrics.span("kb_lookup"):
+            with self._lock:
+                now = time.monotonic()
+                fresh = now < self._expires_at
+                kb = self._index.get(name)
+                known_miss = kb is None and now < self._misses.get(name, 0.0)
+            if not (fresh and kb) and not known_miss:
+                kb = self.refresh().get(name)
+                if not kb:
+                    with self._lock:
+                        self._misses[name] = time.monotonic() + self.miss_ttl
+        if not kb:
+            log.error(f"Knowledge base '{name}' not found")
+            return ""
+        return kb["knowledgeBaseId"]
+
+    def invalidate(self, name: str = None) -> None:
+        """
+        Marks the index stale if it holds the name (or unconditionally when
+        name is None) so the next lookup goes to AWS
+        """
+        with self._lock:
+            if name is None:
+                self._misses.clear()
+            else:
+                self._misses.pop(name, None)
+            if name is None or name in self._index:
+                self._expires_at = 0.0
+
+    def start(self) -> None:
+        """
+        Starts a daemon thread that refreshes the map before the TTL expires
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._refresh_loop, name="kb-resolver", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh_loop(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the last good map until the next attempt
+                log.warning(f"Failed to refresh knowledge base IDs: {e}")
+            if self._stop.wait(self.ttl * 0.8):
+                break
+
+
+_kb_resolvers = {}
+_kb_resolvers_lock = threading.Lock()
+
+
+def get_knowledge_base_resolver(client) -> KnowledgeBaseResolver:
+    """
+    Returns the shared resolver for a bedrock-agent client
+    """
+    with _kb_resolvers_lock:
+        resolver = _kb_resolvers.get(id(client))
+        if resolver is None or resolver.client is not client:
+            resolver = KnowledgeBaseResolver(client)
+            _kb_resolvers[id(client)] = resolver
+        return resolver
+
+
+def get_knowledge_base_id(client, name: str) -> str:
+    knowledge_base_id = get_knowledge_base_resolver(client).get(name)
     log.info(f"Knowledge base ID: {knowledge_base_id}")
     return knowledge_base_id
 
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from loguru import logger as log
+
+from .inventory import iter_data_sources
+
+
+# Shared by every worker process when the SQLite tier is enabled, and by
+# create_knowledge_base.py to drop answers after a new ingestion job
+DEFAULT_SQLITE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "response_cache.sqlite3",
+)
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split()).casefold()
+
+
+def make_cache_key(
+    model_id: str, prompt: str, kb_id: str = "", params: dict = None
+) -> str:
+    """
+    Hashes the normalized prompt with everything else that shapes the answer
+    """
+    key = json.dumps(
+        [model_id, kb_id or "", normalize_prompt(prompt), params or {}],
+        sort_keys=True,
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Exact-match cache of Bedrock answers.
+
+    Entries live in an in-memory LRU with a TTL and, when sqlite_path is
+    set, in a SQLite table that every worker process reads and writes so
+    one process's answer is a hit for the others. Expired rows are purged
+    every so often and the table is capped at max_sqlite_entries, dropping
+    the rows closest to expiry first. Values are JSON serializable dicts,
+    e.g. {"text": ..., "citations": [...]}.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 3600,
+        sqlite_path: str = None,
+        max_sqlite_entries: int = 100000,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path
+        self.max_sqlite_entries = max_sqlite_entries
+        self.hits = 0
+        self.sqlite_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = None
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, kb_id TEXT, value TEXT, expires_at REAL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_kb_id ON responses (kb_id)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_expires_at "
+                "ON responses (expires_at)"
+            )
+            self._db.commit()
+
+    def get(self, key: str) -> dict:
+        """
+        Returns the cached value or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, _, expires_at = entry
+                if time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                now = time.time()
+                row = self._db.execute(
+                    "SELECT kb_id, value, expires_at FROM responses "
+                    "WHERE key = ? AND expires_at > ?",
+                    (key, now),
+                ).fetchone()
+                if row is not None:
+                    value = json.loads(row[1])
+                    # Expires when the row does, not a full TTL from now
+                    self._set_memory(key, value, row[0], row[2] - now)
+                    self.sqlite_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: dict, kb_id: str = "") -> None:
+        with self._lock:
+            self._set_memory(key, value, kb_id, self.ttl)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, kb_id or "", json.dumps(value), time.time() + self.ttl),
+                )
+                self._writes += 1
+                # Expired and excess rows are purged every so often rather
+                # than per write
+                if self._writes % 100 == 0:
+                    self._purge_sqlite()
+                self._db.commit()
+
+    def _set_memory(self, key: str, value: dict, kb_id: str, ttl: float) -> None:
+        self._entries[key] = (value, kb_id or "", time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _purge_sqlite(self) -> None:
+        # Called with the lock held
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        (rows,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if rows > self.max_sqlite_entries:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY expires_at LIMIT ?)",
+                (rows - self.max_sqlite_entries,),
+            )
+
+    def invalidate_knowledge_base(self, kb_id: str) -> None:
+        """
+        Drops every answer generated from the knowledge base
+        """
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry[1] == kb_id]
+            for key in stale:
+                del self._entries[key]
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses WHERE kb_id = ?", (kb_id,))
+                self._db.commit()
+        log.info(f"Invalidated cached answers for knowledge base {kb_id}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "sqlite_hits": self.sqlite_hits,
+                "misses": self.misses,
+            }
+
+
+# Latest job recorded for a knowledge base none of whose jobs completed yet
+NO_INGESTION_JOB = ""
+
+
+class IngestionWatcher:
+    """
+    Polls a knowledge base for newly completed ingestion jobs and
+    invalidates its answers in every cache when one shows up
+    """
+
+    def __init__(self, client, caches: list, kb_id_getter, interval=60):
+        self.client = client
+        self.caches = caches
+        self.kb_id_getter = kb_id_getter
+        self.interval = interval
+        self._last_job = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self) -> None:
+        kb_id = self.kb_id_getter()
+        if not kb_id:
+            return
+        job = get_latest_ingestion_job(self.client, kb_id) or NO_INGESTION_JOB
+        first_poll = kb_id not in self._last_job
+        previous = self._last_job.get(kb_id)
+        self._last_job[kb_id] = job
+        # The first poll only records where we started, which may be before
+        # any job completed
+        if not first_poll and previous != job:
+            log.info(f"Ingestion job {job} completed for knowledge base {kb_id}")
+            for cache in self.caches:
+                cache.invalidate_knowledge_base(kb_id)
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._watch_loop, name="ingestion-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch_loop(self) -> None:
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                log.warning(f"Failed to check for completed ingestion jobs: {e}")
+            if self._stop.wait(self.interval):
+                break
+
+
+def get_latest_ingestion_job(client, kb_id: str) -> str:
+    """
+    Returns the ID of the most recently started COMPLETE ingestion job
+    across the knowledge base's data sources, None if there isn't one
+    """
+    latest = None
+    for ds in iter_data_sources(client, kb_id):
+        jobs = client.list_ingestion_jobs(
+            knowledgeBaseId=kb_id,
+            dataSourceId=ds["dataSourceId"],
+            filters=[{"attribute": "STATUS", "operator": "EQ", "values": ["COMPLETE"]}],
+            sortBy={"attribute": "STARTED_AT", "order": "DESCENDING"},
+            maxResults=1,
+        )["ingestionJobSummaries"]
+        if jobs and (latest is None or jobs[0]["startedAt"] > latest["startedAt"]):
+            latest = jobs[0]
+    return latest["ingestionJobId"] if latest else None
@@ -0,0 +1,119 @@
+import threading
+import time
+
+from loguru import logger as log
+
+from . import bedrock
+
+
+class ModelCatalog:
+    """
+    In-memory catalog of the text foundation models available on demand.
+
+    The catalog is loaded once at startup and refreshed in a background
+    thread. A failed refresh keeps serving the last good list so a Bedrock
+    control plane hiccup never breaks the index page.
+    """
+
+    def __init__(self, client, refresh_interval: float = 3600):
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self._models = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self) -> dict:
+        """
+        Reloads the model summaries from list_foundation_models
+        """
+        response = self.client.list_foundation_models(
+            byOutputModality="TEXT",
+            byInferenceType="ON_DEMAND",
+        )
+        models = {
+            model["modelId"]: {
+                "modelId": model["modelId"],
+                "modelName": model.get("modelName", model["modelId"]),
+                "providerName": model.get("providerName", ""),
+                "inputModalities": model.get("inputModalities", []),
+                "outputModalities": model.get("outputModalities", []),
+                "responseStreamingSupported": model.get(
+                    "responseStreamingSupported", False
+                ),
+            }
+            for model in response["modelSummaries"]
+        }
+        with self._lock:
+            self._models = models
+            self._loaded_at = time.time()
+        log.info(f"Loaded {len(models)} foundation models into the catalog")
+        return models
+
+    def model_ids(self) -> list:
+        with self._lock:
+            return list(self._models)
+
+    def models(self) -> list:
+        with self._lock:
+            return list(self._models.values())
+
+    def get(self, model_id: str) -> dict:
+        with self._lock:
+            return self._models.get(model_id, {})
+
+    def is_available(self, model_id: str) -> bool:
+        """
+        Returns True if the model is in the catalog. Until the first load
+        succeeds every model is allowed through rather than rejected.
+        """
+        with self._lock:
+            if self._loaded_at is None:
+                return True
+            return model_id in self._models
+
+    def supports_streaming(self, model_id: str) -> bool:
+        return self.get(model_id).get("responseStreamingSupported", False)
+
+    def age(self) -> float:
+        """
+        Seconds since the last successful refresh, None if never loaded
+        """
+        with self._lock:
+            if self._loaded_at is None:
+                return None
+            return time.time() - self._loaded_at
+
+    def start(self) -> None:
+        """
+        Loads the catalog and starts the background refresh thread
+        """
+        if self._thread is not None:
+            return
+        try:
+            self.refresh()
+        except Exception as e:
+            log.warning(f"Failed to load the model catalog: {e}")
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._refresh_loop, name="model-catalog", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                log.warning(f"Failed to refresh the model catalog, serving stale: {e}")
+
+
+def get_model_catalog(region: str, refresh_interval: float = 3600) -> ModelCatalog:
+    return ModelCatalog(bedrock.get_bedrock_client(region), refresh_interval)
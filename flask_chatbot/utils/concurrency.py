@@ -0,0 +1,84 @@
+import asyncio
+import contextlib
+
+from loguru import logger as log
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a model already has too many requests waiting for a slot
+    """
+
+
+class ModelConcurrencyLimiter:
+    """
+    Bounds the number of in-flight Bedrock calls per model for the async app.
+
+    Each model gets its own semaphore so a slow model can't starve the
+    others. get_max_concurrency returns a model's slots, the same limit its
+    admission controller enforces, so requests that can't be admitted wait
+    here on the event loop rather than holding a worker thread. Once
+    max_queue_depth requests are already waiting new ones are rejected with
+    QueueFullError instead of piling up behind the model's quota.
+    """
+
+    def __init__(self, get_max_concurrency, max_queue_depth: int = 128):
+        self.get_max_concurrency = get_max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self._semaphores = {}
+        self._waiting = {}
+
+    def _get_semaphore(self, model_id: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(model_id)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.get_max_concurrency(model_id))
+            self._semaphores[model_id] = semaphore
+            self._waiting[model_id] = 0
+        return semaphore
+
+    def queue_depth(self, model_id: str) -> int:
+        return self._waiting.get(model_id, 0)
+
+    def check_queue(self, model_id: str) -> None:
+        """
+        Raises QueueFullError if a new request for the model would be rejected.
+        Lets streaming routes fail with a status code before the body starts.
+        """
+        semaphore = self._get_semaphore(model_id)
+        if semaphore.locked() and self._waiting[model_id] >= self.max_queue_depth:
+            log.warning(f"Queue for {model_id} is full, rejecting request")
+            raise QueueFullError(f"Too many requests queued for {model_id}")
+
+    @contextlib.asynccontextmanager
+    async def limit(self, model_id: str):
+        """
+        Holds one of the model's slots for the body of the async with block
+        """
+        self.check_queue(model_id)
+        semaphore = self._get_semaphore(model_id)
+        if semaphore.locked():
+            self._waiting[model_id] += 1
+            try:
+                await semaphore.acquire()
+            finally:
+                self._waiting[model_id] -= 1
+        else:
+            await semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+async def iterate_in_thread(iterator):
+    """
+    Drives a blocking iterator from a worker thread so each next() call
+    doesn't block the event loop
+    """
+    iterator = iter(iterator)
+    done = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, done)
+        if item is done:
+            break
+        yield item
@@ -0,0 +1,57 @@
+from loguru import logger as log
+
+
+def paginate(client, operation: str, result_key: str, **kwargs):
+    """
+    Yields every item of a list operation across all pages. Uses the boto3
+    paginator when the service has one, e.g. opensearchserverless doesn't,
+    and follows nextToken by hand otherwise.
+    """
+    if client.can_paginate(operation):
+        for page in client.get_paginator(operation).paginate(**kwargs):
+            yield from page.get(result_key, [])
+        return
+
+    method = getattr(client, operation)
+    while True:
+        page = method(**kwargs)
+        yield from page.get(result_key, [])
+        next_token = page.get("nextToken")
+        if not next_token:
+            return
+        kwargs["nextToken"] = next_token
+
+
+def iter_knowledge_bases(client):
+    return paginate(client, "list_knowledge_bases", "knowledgeBaseSummaries")
+
+
+def iter_data_sources(client, kb_id: str):
+    return paginate(
+        client, "list_data_sources", "dataSourceSummaries", knowledgeBaseId=kb_id
+    )
+
+
+class NameIndex:
+    """
+    Resources keyed by name, built once from a listing so lookups don't go
+    back to AWS or scan every resource
+    """
+
+    def __init__(self, items, name_key: str = "name"):
+        self._items = {item[name_key]: item for item in items}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._items
+
+    def get(self, name: str, default=None):
+        return self._items.get(name, default)
+
+
+def build_knowledge_base_index(client) -> NameIndex:
+    index = NameIndex(iter_knowledge_bases(client))
+    log.debug(f"Indexed {len(index)} knowledge bases")
+    return index
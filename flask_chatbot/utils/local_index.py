@@ -0,0 +1,183 @@
+import json
+import os
+
+import numpy as np
+from loguru import logger as log
+
+
+VECTORS_FILE = "vectors.npy"
+# Lengths of the vectors before they were normalized
+NORMS_FILE = "norms.npy"
+CHUNKS_FILE = "chunks.jsonl"
+CENTROIDS_FILE = "ivf_centroids.npy"
+ORDER_FILE = "ivf_order.npy"
+OFFSETS_FILE = "ivf_offsets.npy"
+
+# Below this many chunks a brute-force scan is as fast as probing an IVF index
+MIN_IVF_VECTORS = 2048
+# IVF lists searched per query, more lists trade latency for recall
+DEFAULT_N_PROBE = 8
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def train_ivf(vectors: np.ndarray, n_lists: int, iterations: int = 10, seed=0):
+    """
+    Spherical k-means over the normalized vectors. Returns the centroids and
+    the list each vector belongs to.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = (vectors @ centroids.T).argmax(axis=1)
+        for i in range(n_lists):
+            members = vectors[assignments == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    assignments = (vectors @ centroids.T).argmax(axis=1)
+    return centroids.astype(np.float32), assignments
+
+
+class LocalVectorIndex:
+    """
+    In-process replica of the knowledge base's vector index.
+
+    Vectors are stored L2 normalized in a .npy file that is memory mapped on
+    load, next to the text chunks and, for larger corpora, an IVF index
+    (k-means centroids plus the vector IDs grouped by list). Searches probe
+    the nearest lists and fall back to a batched brute-force cosine scan
+    when there is no IVF index or the probed lists hold too few vectors.
+    Results are shaped like bedrock-agent-runtime retrieve() results so they
+    can be fed straight to generation.
+    """
+
+    def __init__(self, vectors, chunks, centroids=None, order=None, offsets=None):
+        self.vectors = vectors
+        self.chunks = chunks
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @property
+    def dimension(self) -> int:
+        return self.vectors.shape[1]
+
+    @staticmethod
+    def build(vectors, chunks: list, output_dir: str, n_lists: int = None) -> None:
+        """
+        Writes the vectors, chunks and IVF index to output_dir. Each chunk is
+        a dict with "text" and "uri".
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        np.save(
+            os.path.join(output_dir, NORMS_FILE), np.linalg.norm(vectors, axis=1)
+        )
+        vectors = normalize(vectors)
+        np.save(os.path.join(output_dir, VECTORS_FILE), vectors)
+        with open(os.path.join(output_dir, CHUNKS_FILE), "w") as f:
+            for chunk in chunks:
+                f.write(json.dumps(chunk) + "\n")
+
+        for name in [CENTROIDS_FILE, ORDER_FILE, OFFSETS_FILE]:
+            path = os.path.join(output_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        if n_lists is None and len(vectors) < MIN_IVF_VECTORS:
+            log.info(f"Exported {len(vectors)} vectors without an IVF index")
+            return
+
+        n_lists = min(n_lists or int(np.sqrt(len(vectors))), len(vectors))
+        centroids, assignments = train_ivf(vectors, n_lists)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        np.save(os.path.join(output_dir, CENTROIDS_FILE), centroids)
+        np.save(os.path.join(output_dir, ORDER_FILE), order)
+        np.save(os.path.join(output_dir, OFFSETS_FILE), offsets)
+        log.info(f"Exported {len(vectors)} vectors with a {n_lists} list IVF index")
+
+    @classmethod
+    def load(cls, index_dir: str) -> "LocalVectorIndex":
+        vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(index_dir, CHUNKS_FILE)) as f:
+            chunks = [json.loads(line) for line in f]
+        ivf_paths = [
+            os.path.join(index_dir, name)
+            for name in [CENTROIDS_FILE, ORDER_FILE, OFFSETS_FILE]
+        ]
+        if all(os.path.exists(path) for path in ivf_paths):
+            return cls(vectors, chunks, *(np.load(path) for path in ivf_paths))
+        return cls(vectors, chunks)
+
+    def _brute_force(self, queries: np.ndarray, k: int) -> list:
+        scores = queries @ self.vectors.T
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, ids in zip(scores, top):
+            ids = ids[np.argsort(-row[ids])]
+            results.append(list(zip(ids.tolist(), row[ids].tolist())))
+        return results
+
+    def _probe(self, query: np.ndarray, k: int, n_probe: int) -> list:
+        lists = np.argsort(-(self.centroids @ query))[:n_probe]
+        ids = np.concatenate(
+            [self.order[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+        )
+        if len(ids) < k:
+            return None
+        # Sorted IDs keep the reads from the memory mapped file sequential
+        ids = np.sort(ids)
+        scores = self.vectors[ids] @ query
+        top = np.argsort(-scores)[:k]
+        return list(zip(ids[top].tolist(), scores[top].tolist()))
+
+    def search_batch(
+        self, embeddings, k: int = 5, n_probe: int = DEFAULT_N_PROBE
+    ) -> list:
+        """
+        Returns retrieve()-shaped results for each query embedding
+        """
+        queries = normalize(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+        hits = [None] * len(queries)
+        if self.centroids is not None:
+            hits = [self._probe(query, k, n_probe) for query in queries]
+        missing = [i for i, hit in enumerate(hits) if hit is None]
+        if missing:
+            for i, hit in zip(missing, self._brute_force(queries[missing], k)):
+                hits[i] = hit
+        return [[self._to_result(i, score) for i, score in hit] for hit in hits]
+
+    def search(self, embedding, k: int = 5, n_probe: int = DEFAULT_N_PROBE) -> list:
+        return self.search_batch([embedding], k, n_probe)[0]
+
+    def recall(self, queries, k: int = 5, n_probe: int = DEFAULT_N_PROBE) -> float:
+        """
+        Returns the share of the exact top k neighbours that probing n_probe
+        IVF lists finds, averaged over the queries
+        """
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if self.centroids is None:
+            return 1.0
+        found = 0
+        exact = self._brute_force(queries, k)
+        for query, neighbours in zip(queries, exact):
+            hit = self._probe(query, k, n_probe)
+            if hit is None:
+                # search_batch falls back to the exact scan
+                found += len(neighbours)
+                continue
+            found += len({i for i, _ in hit} & {i for i, _ in neighbours})
+        return found / sum(len(neighbours) for neighbours in exact)
+
+    def _to_result(self, i: int, score: float) -> dict:
+        chunk = self.chunks[i]
+        return {
+            "content": {"text": chunk["text"]},
+            "location": {"type": "S3", "s3Location": {"uri": chunk.get("uri", "")}},
+            "score": score,
+        }
@@ -0,0 +1,385 @@
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+from loguru import logger as log
+
+
+# Histogram upper bounds in seconds, from cache hits to long generations
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120
+)
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    """
+    Prometheus histogram with one series per combination of label values
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple,
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [per bucket counts (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._series.items()
+            ]
+        for key, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                labels = format_labels(self.label_names, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    """
+    Prometheus counter with one series per combination of label values
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class StatsMetric:
+    """
+    Counter or gauge whose series are read at scrape time from components
+    that already keep their own counts, e.g. a cache's stats(). Each source
+    returns a list of (label values, value) pairs.
+    """
+
+    def __init__(
+        self, name: str, documentation: str, label_names: tuple, kind: str = "counter"
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.kind = kind
+        self._sources = []
+        self._lock = threading.Lock()
+
+    def add_source(self, source) -> None:
+        with self._lock:
+            self._sources.append(source)
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            sources = list(self._sources)
+        series = []
+        for source in sources:
+            try:
+                series.extend(source())
+            except Exception as e:
+                log.warning(f"Failed to read {self.name}: {e}")
+        for key, value in sorted(series):
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "chatbot_stage_seconds",
+    "Time spent in each stage of a chat request",
+    ("route", "model", "stage"),
+)
+REQUEST_SECONDS = Histogram(
+    "chatbot_request_seconds",
+    "Time to serve a request, until the last byte for streamed responses",
+    ("route", "model", "status"),
+)
+BEDROCK_INVOCATION_SECONDS = Histogram(
+    "chatbot_bedrock_invocation_seconds",
+    "Model invocation latency reported by Amazon Bedrock",
+    ("route", "model"),
+)
+BEDROCK_TOKENS = Counter(
+    "chatbot_bedrock_tokens_total",
+    "Tokens counted by Amazon Bedrock, by direction (input or output)",
+    ("route", "model", "direction"),
+)
+BEDROCK_HEDGES = Counter(
+    "chatbot_bedrock_hedges_total",
+    "Hedged invoke_model calls by outcome (sent, won or over_budget)",
+    ("model", "outcome"),
+)
+CACHE_LOOKUPS = StatsMetric(
+    "chatbot_cache_lookups_total",
+    "Cache lookups by cache and result (hit, sqlite_hit or miss)",
+    ("cache", "result"),
+)
+SINGLE_FLIGHT_CALLS = StatsMetric(
+    "chatbot_single_flight_calls_total",
+    "Bedrock calls made (leader) or shared with an identical call in flight "
+    "(follower)",
+    ("role",),
+)
+ADMISSION_EVENTS = StatsMetric(
+    "chatbot_admission_events_total",
+    "Bedrock calls throttled by Bedrock or rejected by admission control",
+    ("model", "region", "event"),
+)
+ADMISSION_CONCURRENCY = StatsMetric(
+    "chatbot_admission_concurrency",
+    "Current AIMD concurrency limit and calls in flight per model",
+    ("model", "region", "value"),
+    kind="gauge",
+)
+METRICS = [
+    STAGE_SECONDS,
+    REQUEST_SECONDS,
+    BEDROCK_INVOCATION_SECONDS,
+    BEDROCK_TOKENS,
+    BEDROCK_HEDGES,
+    CACHE_LOOKUPS,
+    SINGLE_FLIGHT_CALLS,
+    ADMISSION_EVENTS,
+    ADMISSION_CONCURRENCY,
+]
+
+
+# CACHE_LOOKUPS result label -> key of the count in a cache's stats()
+CACHE_RESULTS = {"hit": "hits", "sqlite_hit": "sqlite_hits", "miss": "misses"}
+
+
+def add_cache(name: str, cache) -> None:
+    """
+    Reports the hits and misses counted by cache.stats() as CACHE_LOOKUPS
+    """
+
+    def lookups() -> list:
+        stats = cache.stats()
+        return [
+            ((name, result), stats[key])
+            for result, key in CACHE_RESULTS.items()
+            if key in stats
+        ]
+
+    CACHE_LOOKUPS.add_source(lookups)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Route and model of the request being served. Worker threads started with
+# asyncio.to_thread or a copied context see the labels of their request.
+_request_labels = contextvars.ContextVar(
+    "request_labels",
+    default={"route": "", "model": "", "start": None, "span": None},
+)
+
+
+def start_request(route: str, model: str = "") -> None:
+    """
+    Labels the stages recorded from here on in this context, and opens the
+    request's span they are traced under when tracing is enabled
+    """
+    request_span = None
+    if _tracer is not None:
+        request_span = _tracer.start_span(
+            route, attributes={"chatbot.route": route, "chatbot.model": model}
+        )
+    _request_labels.set(
+        {
+            "route": route,
+            "model": model,
+            "start": time.perf_counter(),
+            "span": request_span,
+        }
+    )
+
+
+def set_request_model(model: str) -> None:
+    """
+    Sets the model label once it's known, e.g. after parsing a JSON body
+    """
+    _request_labels.set({**_request_labels.get(), "model": model})
+
+
+def get_request_labels() -> dict:
+    return _request_labels.get()
+
+
+def observe_request(labels: dict, status) -> None:
+    """
+    Records the duration of the request started with the given labels and
+    ends its span
+    """
+    if labels["start"] is None:
+        return
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - labels["start"],
+        route=labels["route"],
+        model=labels["model"],
+        status=status,
+    )
+    request_span = labels["span"]
+    if request_span is not None:
+        request_span.set_attribute("chatbot.model", labels["model"])
+        request_span.set_attribute("http.status_code", int(status))
+        request_span.end()
+
+
+def observe(stage: str, seconds: float, model: str = None) -> None:
+    labels = _request_labels.get()
+    STAGE_SECONDS.observe(
+        seconds, route=labels["route"], model=model or labels["model"], stage=stage
+    )
+
+
+# OpenTelemetry API and tracer, None until enable_tracing() succeeds
+_trace = None
+_tracer = None
+
+
+@contextlib.contextmanager
+def span(stage: str, model: str = None):
+    """
+    Times the body of the with block as one stage of the current request,
+    and traces it when tracing is enabled. The stage's span is a child of
+    the request's and is current inside the block, so spans started there
+    (e.g. by botocore instrumentation) nest under it.
+    """
+    if _tracer is None:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            observe(stage, time.perf_counter() - start, model)
+        return
+
+    labels = _request_labels.get()
+    attributes = {
+        "chatbot.route": labels["route"],
+        "chatbot.model": model or labels["model"],
+    }
+    # Stages nest under the current stage, and otherwise under the request
+    # span the labels carry into worker threads
+    parent = None
+    current = _trace.get_current_span().get_span_context()
+    if not current.is_valid and labels["span"] is not None:
+        parent = _trace.set_span_in_context(labels["span"])
+    trace_span = _tracer.start_span(stage, context=parent, attributes=attributes)
+    start = time.perf_counter()
+    try:
+        with _trace.use_span(trace_span, end_on_exit=True):
+            yield
+    finally:
+        observe(stage, time.perf_counter() - start, model)
+
+
+def record_invocation(
+    model: str, input_tokens=None, output_tokens=None, latency_ms=None
+) -> None:
+    """
+    Records the token counts and latency Bedrock reported for one call.
+    Values may be strings (response headers) or None when not reported.
+    """
+    route = _request_labels.get()["route"]
+    for direction, tokens in (("input", input_tokens), ("output", output_tokens)):
+        if tokens is not None:
+            BEDROCK_TOKENS.inc(
+                int(tokens), route=route, model=model, direction=direction
+            )
+    if latency_ms is not None:
+        BEDROCK_INVOCATION_SECONDS.observe(
+            int(latency_ms) / 1000, route=route, model=model
+        )
+
+
+def enable_tracing(service_name: str = "chatbot") -> bool:
+    """
+    Also reports every stage as an OpenTelemetry span. The SDK and exporter
+    are configured outside the app, e.g. by running it under
+    opentelemetry-instrument, otherwise the spans go nowhere.
+    """
+    global _trace, _tracer
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        log.warning("opentelemetry-api is not installed, tracing stays disabled")
+        return False
+    _trace = trace
+    _tracer = trace.get_tracer(service_name)
+    log.info("OpenTelemetry tracing enabled")
+    return True
@@ -0,0 +1,107 @@
+import threading
+import time
+
+import numpy as np
+from loguru import logger as log
+
+
+class SemanticCache:
+    """
+    Answers questions that are worded differently from an earlier one but
+    mean the same thing.
+
+    Question embeddings are kept L2 normalized in one preallocated NumPy
+    matrix so a lookup is a single matrix product against every entry.
+    Entries are scoped by (model ID, knowledge base ID) and once the matrix
+    is full the least recently used row is overwritten.
+    """
+
+    def __init__(self, capacity: int = 4096, threshold: float = 0.95, ttl=86400):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._embeddings = None
+        self._scopes = np.full(capacity, -1, dtype=np.int64)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._expires_at = np.zeros(capacity, dtype=np.float64)
+        self._answers = [None] * capacity
+        self._kb_ids = [""] * capacity
+        self._scope_ids = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _get_scope_id(self, model_id: str, kb_id: str) -> int:
+        return self._scope_ids.setdefault((model_id, kb_id or ""), len(self._scope_ids))
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def lookup_batch(self, embeddings, model_id: str, kb_id: str = "") -> list:
+        """
+        Returns the cached answer (or None) for each row of embeddings
+        """
+        queries = self._normalize(np.atleast_2d(np.asarray(embeddings, np.float32)))
+        results = [None] * len(queries)
+        with self._lock:
+            scope = self._scope_ids.get((model_id, kb_id or ""))
+            if self._size and scope is not None:
+                now = time.monotonic()
+                valid = (self._scopes[: self._size] == scope) & (
+                    self._expires_at[: self._size] > now
+                )
+                if valid.any():
+                    # (n_queries, n_entries) cosine similarities in one product
+                    similarities = queries @ self._embeddings[: self._size].T
+                    similarities[:, ~valid] = -np.inf
+                    best = similarities.argmax(axis=1)
+                    scores = similarities[np.arange(len(queries)), best]
+                    for i, (row, score) in enumerate(zip(best, scores)):
+                        if score >= self.threshold:
+                            self._last_used[row] = now
+                            results[i] = self._answers[row]
+            hits = sum(result is not None for result in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def lookup(self, embedding, model_id: str, kb_id: str = "") -> dict:
+        return self.lookup_batch([embedding], model_id, kb_id)[0]
+
+    def add(self, embedding, answer: dict, model_id: str, kb_id: str = "") -> None:
+        vector = self._normalize(np.asarray(embedding, np.float32))
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.capacity, len(vector)), np.float32)
+            if self._size < self.capacity:
+                row = self._size
+                self._size += 1
+            else:
+                row = int(self._last_used.argmin())
+            now = time.monotonic()
+            self._embeddings[row] = vector
+            self._scopes[row] = self._get_scope_id(model_id, kb_id)
+            self._last_used[row] = now
+            self._expires_at[row] = now + self.ttl
+            self._answers[row] = answer
+            self._kb_ids[row] = kb_id or ""
+
+    def invalidate_knowledge_base(self, kb_id: str) -> None:
+        """
+        Expires every answer generated from the knowledge base. The rows are
+        reused first since they have the oldest last-used time.
+        """
+        with self._lock:
+            for row in range(self._size):
+                if self._kb_ids[row] == kb_id:
+                    self._expires_at[row] = 0.0
+                    self._last_used[row] = 0.0
+                    self._answers[row] = None
+        log.info(f"Invalidated semantic cache entries for knowledge base {kb_id}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": self._size, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,215 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from loguru import logger as log
+
+
+# Rough size of a token in characters, close enough to budget the history
+CHARS_PER_TOKEN = 4
+
+CONVERSATION_PROMPT_TEMPLATE = """The conversation so far:
+{history}
+
+Reply to the user's latest message.
+User: {message}"""
+
+_SESSION_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+def is_valid_session_id(session_id: str) -> bool:
+    return bool(session_id) and bool(_SESSION_ID_PATTERN.match(session_id))
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def trim_history(history: list, max_tokens: int) -> list:
+    """
+    Returns the most recent turns that fit in max_tokens, dropping the
+    oldest first
+    """
+    trimmed = []
+    tokens = 0
+    for turn in reversed(history):
+        tokens += estimate_tokens(turn["user"]) + estimate_tokens(turn["assistant"])
+        if tokens > max_tokens:
+            break
+        trimmed.append(turn)
+    return trimmed[::-1]
+
+
+def get_conversation_prompt(history: list, message: str) -> str:
+    """
+    Prefixes the message with the earlier turns, or returns it unchanged
+    when the conversation just started
+    """
+    if not history:
+        return message
+    lines = []
+    for turn in history:
+        lines.append(f"User: {turn['user']}")
+        lines.append(f"Assistant: {turn['assistant']}")
+    return CONVERSATION_PROMPT_TEMPLATE.format(
+        history="\n".join(lines), message=message
+    )
+
+
+class SessionStore:
+    """
+    Conversation state per browser session.
+
+    A session holds the retrieve_and_generate sessionId used for follow-up
+    RAG questions and a rolling history of turns for plain model chats. The
+    history is trimmed to max_history_tokens as turns are added so prompts
+    stop growing once a conversation is long. Sessions live in an in-memory
+    LRU and are evicted once idle for idle_ttl seconds. When sqlite_path is
+    set SQLite is the source of truth instead, so every worker process sees
+    the same conversation.
+
+    Every method accepts a None session ID and treats it as an empty
+    session, so callers without a browser session need no special case.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 10000,
+        idle_ttl: float = 1800,
+        max_history_tokens: int = 2000,
+        sqlite_path: str = None,
+    ):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_history_tokens = max_history_tokens
+        self.sqlite_path = sqlite_path
+        self.evicted = 0
+        # session ID -> (state, last seen), least recently saved first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = None
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, state TEXT, last_seen REAL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def _new_state() -> dict:
+        return {"kb_session_id": None, "history": []}
+
+    def get(self, session_id: str) -> dict:
+        """
+        Returns a copy of {"kb_session_id", "history"} for the session
+        """
+        if session_id is None:
+            return self._new_state()
+        with self._lock:
+            state = self._load(session_id)
+        return {
+            "kb_session_id": state["kb_session_id"],
+            "history": list(state["history"]),
+        }
+
+    def add_turn(
+        self, session_id: str, message: str, answer: str, kb_session_id: str = None
+    ) -> None:
+        """
+        Appends a turn, trimming the history to the token budget, and
+        records the knowledge base session the answer came from
+        """
+        if session_id is None:
+            return
+        # Held from read to write so concurrent turns (two tabs, or a stream
+        # finishing next to a blocking call) don't overwrite each other
+        with self._lock:
+            if self._db is not None:
+                # Also keeps other worker processes out until the commit
+                self._db.execute("BEGIN IMMEDIATE")
+            try:
+                state = self._load(session_id)
+                state = {
+                    "kb_session_id": kb_session_id or state["kb_session_id"],
+                    "history": trim_history(
+                        state["history"] + [{"user": message, "assistant": answer}],
+                        self.max_history_tokens,
+                    ),
+                }
+                self._save(session_id, state)
+            except Exception:
+                if self._db is not None:
+                    self._db.rollback()
+                raise
+
+    def clear(self, session_id: str) -> None:
+        if session_id is None:
+            return
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                self._db.commit()
+
+    def _load(self, session_id: str) -> dict:
+        # Called with the lock held
+        self._evict_idle()
+        if self._db is not None:
+            # Another worker process may have added the last turn
+            row = self._db.execute(
+                "SELECT state FROM sessions WHERE id = ? AND last_seen > ?",
+                (session_id, time.time() - self.idle_ttl),
+            ).fetchone()
+            return json.loads(row[0]) if row else self._new_state()
+        entry = self._sessions.get(session_id)
+        return entry[0] if entry is not None else self._new_state()
+
+    def _save(self, session_id: str, state: dict) -> None:
+        # Called with the lock held
+        self._sessions[session_id] = (state, time.monotonic())
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                (session_id, json.dumps(state), time.time()),
+            )
+            self._writes += 1
+            # Expired rows are purged every so often rather than per write
+            if self._writes % 100 == 0:
+                self._db.execute(
+                    "DELETE FROM sessions WHERE last_seen <= ?",
+                    (time.time() - self.idle_ttl,),
+                )
+            self._db.commit()
+
+    def _evict_idle(self) -> None:
+        # Least recently used first, so stop at the first active session
+        idle_before = time.monotonic() - self.idle_ttl
+        while self._sessions:
+            session_id, (_, last_seen) = next(iter(self._sessions.items()))
+            if last_seen > idle_before:
+                break
+            del self._sessions[session_id]
+            self.evicted += 1
+            log.debug(f"Evicted idle chat session {session_id}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._sessions), "evicted": self.evicted}
@@ -0,0 +1,162 @@
+"""
+Vector index profiles for the knowledge base's OpenSearch Serverless index.
+
+A profile picks the k-NN engine, the HNSW graph parameters and optional
+fp16 scalar quantization. Smaller graphs (lower m and ef_construction) and
+fp16 vectors use less memory, and a lower ef_search answers faster, at the
+cost of some recall. Run evaluate_index_profiles.py to measure the trade
+off on your own vectors before picking one in create_knowledge_base.py.
+"""
+
+
+# Output dimensions of the embedding models a knowledge base can use. The
+# first entry is the model's default, the others can be requested instead.
+EMBEDDING_MODEL_DIMENSIONS = {
+    "amazon.titan-embed-text-v1": [1536],
+    "amazon.titan-embed-text-v2:0": [1024, 512, 256],
+    "cohere.embed-english-v3": [1024],
+    "cohere.embed-multilingual-v3": [1024],
+}
+
+# Models whose embeddings are unit length as Bedrock returns them. Titan v2
+# normalizes unless told not to, the others keep each vector's magnitude.
+NORMALIZED_EMBEDDING_MODELS = {"amazon.titan-embed-text-v2:0"}
+
+# "default" is the index this project has always created
+INDEX_PROFILES = {
+    "default": {
+        "engine": "nmslib",
+        "m": None,
+        "ef_construction": None,
+        "ef_search": 512,
+        "quantization": None,
+    },
+    # Higher recall than "fast" with a fraction of "default"'s query latency
+    "balanced": {
+        "engine": "faiss",
+        "m": 16,
+        "ef_construction": 256,
+        "ef_search": 128,
+        "quantization": None,
+    },
+    # Half the vector memory, a little less recall
+    "fast": {
+        "engine": "faiss",
+        "m": 16,
+        "ef_construction": 128,
+        "ef_search": 64,
+        "quantization": "fp16",
+    },
+    # Smallest graph for large corpora where memory dominates the cost
+    "compact": {
+        "engine": "faiss",
+        "m": 8,
+        "ef_construction": 128,
+        "ef_search": 64,
+        "quantization": "fp16",
+    },
+}
+
+# Cosine on nmslib. faiss only has L2 and inner product here, and L2 ranks
+# embeddings the same way cosine does only when they are normalized, so
+# the faiss profiles are limited to NORMALIZED_EMBEDDING_MODELS.
+ENGINE_SPACE_TYPES = {"nmslib": "cosinesimil", "faiss": "l2"}
+
+
+def get_embedding_dimension(model_id: str, dimensions: int = None) -> int:
+    """
+    Returns the vector dimension for the model, validating a requested one
+    """
+    supported = EMBEDDING_MODEL_DIMENSIONS.get(model_id)
+    if supported is None:
+        raise ValueError(f"Unknown embedding model {model_id}")
+    if dimensions is None:
+        return supported[0]
+    if dimensions not in supported:
+        raise ValueError(
+            f"{model_id} supports dimensions {supported}, not {dimensions}"
+        )
+    return dimensions
+
+
+def check_profile(profile_name: str, embed_model_id: str) -> None:
+    """
+    Raises ValueError if the profile would rank the model's embeddings
+    differently from cosine similarity
+    """
+    engine = INDEX_PROFILES[profile_name]["engine"]
+    if (
+        ENGINE_SPACE_TYPES[engine] != "cosinesimil"
+        and embed_model_id not in NORMALIZED_EMBEDDING_MODELS
+    ):
+        raise ValueError(
+            f"The '{profile_name}' profile ranks by L2 distance, which only "
+            f"matches cosine for normalized embeddings and {embed_model_id} "
+            "doesn't normalize them. Use the 'default' profile or one of "
+            f"{sorted(NORMALIZED_EMBEDDING_MODELS)}"
+        )
+
+
+def get_vector_method(profile: dict) -> dict:
+    quantization = profile["quantization"]
+    if quantization not in (None, "fp16"):
+        # Byte vectors must be written as int8 values, which Bedrock
+        # knowledge base ingestion doesn't do
+        raise ValueError(f"Unsupported quantization {quantization}")
+    if quantization and profile["engine"] != "faiss":
+        raise ValueError("fp16 quantization requires the faiss engine")
+
+    parameters = {}
+    if profile["m"] is not None:
+        parameters["m"] = profile["m"]
+    if profile["ef_construction"] is not None:
+        parameters["ef_construction"] = profile["ef_construction"]
+    if profile["engine"] == "faiss":
+        # nmslib takes ef_search as an index setting instead
+        parameters["ef_search"] = profile["ef_search"]
+        if quantization == "fp16":
+            parameters["encoder"] = {"name": "sq", "parameters": {"type": "fp16"}}
+    return {
+        "engine": profile["engine"],
+        "space_type": ENGINE_SPACE_TYPES[profile["engine"]],
+        "name": "hnsw",
+        "parameters": parameters,
+    }
+
+
+def get_index_body(
+    profile_name: str, dimension: int, vector_field: str, embed_model_id: str
+) -> dict:
+    """
+    Returns the indices.create body for a knowledge base index
+    """
+    check_profile(profile_name, embed_model_id)
+    profile = INDEX_PROFILES[profile_name]
+    index_settings = {"knn": "true"}
+    if profile["engine"] == "nmslib":
+        index_settings["knn.algo_param"] = {"ef_search": str(profile["ef_search"])}
+    return {
+        "settings": {"index": index_settings},
+        "mappings": {
+            "properties": {
+                "AMAZON_BEDROCK_METADATA": {"type": "text", "index": False},
+                "AMAZON_BEDROCK_TEXT_CHUNK": {"type": "text"},
+                vector_field: {
+                    "type": "knn_vector",
+                    "dimension": dimension,
+                    "method": get_vector_method(profile),
+                },
+            }
+        },
+    }
+
+
+def estimate_memory_bytes(profile_name: str, dimension: int, vectors: int) -> int:
+    """
+    Rough native memory of the HNSW graph: the vectors plus m links per
+    vector on the base layer (OpenSearch's sizing formula)
+    """
+    profile = INDEX_PROFILES[profile_name]
+    bytes_per_value = 2 if profile["quantization"] == "fp16" else 4
+    m = profile["m"] or 16
+    return int(1.1 * (bytes_per_value * dimension + 8 * m) * vectors)
@@ -0,0 +1,126 @@
+"""
+Runs the provisioning scripts' steps as a dependency graph.
+
+Each step names the steps it depends on and is started on a thread pool as
+soon as they have all finished, so independent steps (e.g. the three
+OpenSearch policies) run concurrently. Steps are expected to check whether
+their resource already exists so a re-run after a failure picks up where
+the last one stopped. When the run ends a report lists when each step
+started, how long it took, and which steps formed the critical path.
+"""
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from loguru import logger as log
+
+
+# Most steps spend their time waiting on AWS, not on the CPU
+MAX_WORKERS = 8
+
+
+class Step:
+    """
+    A named unit of work. func is called with a dict of the results of every
+    step finished so far and its return value becomes this step's result.
+    """
+
+    def __init__(self, name: str, func, depends_on: list = None):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on or [])
+
+
+def run_steps(steps: list, max_workers: int = MAX_WORKERS) -> dict:
+    """
+    Runs the steps in dependency order, concurrently where possible, and
+    returns {step name: result}. If a step raises, no new steps are started,
+    the running ones are allowed to finish and the first error is re-raised.
+    """
+    by_name = {step.name: step for step in steps}
+    for step in steps:
+        for dependency in step.depends_on:
+            if dependency not in by_name:
+                raise ValueError(
+                    f"Step '{step.name}' depends on unknown step '{dependency}'"
+                )
+
+    waiting_on = {step.name: set(step.depends_on) for step in steps}
+    results = {}
+    timings = {}
+    error = None
+    run_start = time.monotonic()
+
+    def run_step(step: Step):
+        start = time.monotonic() - run_start
+        log.info(f"Starting step '{step.name}'")
+        try:
+            return step.func(results)
+        finally:
+            timings[step.name] = (start, time.monotonic() - run_start)
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        running = {}
+        while True:
+            if error is None:
+                ready = [name for name, deps in waiting_on.items() if not deps]
+                for name in ready:
+                    del waiting_on[name]
+                    running[executor.submit(run_step, by_name[name])] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    log.error(f"Step '{name}' failed: {e}")
+                    error = error or e
+                    continue
+                for deps in waiting_on.values():
+                    deps.discard(name)
+
+    report_timings(by_name, timings)
+    if error is not None:
+        log.error(f"Skipped steps: {', '.join(waiting_on) or 'none'}")
+        raise error
+    if waiting_on:
+        raise ValueError(f"Dependency cycle between steps: {', '.join(waiting_on)}")
+    return results
+
+
+def log_plan(steps: list) -> None:
+    """
+    Logs the steps and what each waits for without running anything
+    """
+    for step in steps:
+        after = ", ".join(step.depends_on) or "nothing"
+        log.info(f"Step '{step.name}' runs after: {after}")
+
+
+def get_critical_path(by_name: dict, timings: dict) -> list:
+    """
+    Walks back from the last step to finish through whichever dependency
+    finished last, i.e. the chain of steps that set the total run time
+    """
+    if not timings:
+        return []
+    path = [max(timings, key=lambda name: timings[name][1])]
+    while True:
+        finished = [name for name in by_name[path[-1]].depends_on if name in timings]
+        if not finished:
+            break
+        path.append(max(finished, key=lambda name: timings[name][1]))
+    return path[::-1]
+
+
+def report_timings(by_name: dict, timings: dict) -> None:
+    critical_path = get_critical_path(by_name, timings)
+    log.info(f"{'Step':<40} {'Start':>8} {'Took':>8}")
+    for name, (start, end) in sorted(timings.items(), key=lambda item: item[1][0]):
+        marker = " *" if name in critical_path else ""
+        log.info(f"{name:<40} {start:7.1f}s {end - start:7.1f}s{marker}")
+    wall_time = max((end for _, end in timings.values()), default=0)
+    serial_time = sum(end - start for start, end in timings.values())
+    log.info(f"Critical path (*): {' -> '.join(critical_path)}")
+    log.info(f"Total {wall_time:.1f}s, {serial_time:.1f}s if run serially")
@@ -0,0 +1,195 @@
+"""
+Incrementally syncs the local rag_data directory to the knowledge base
+S3 bucket and re-ingests only when something changed.
+
+Files are hashed (re-using the previous hash when size and mtime are
+unchanged) and compared against a manifest of what is in the bucket. New
+and changed files are uploaded in parallel, with multipart uploads for
+large files, removed files are deleted, and an ingestion job is started
+only if the bucket actually changed.
+
+The manifest is kept in .rag_data_manifest.json rather than in the bucket
+so it isn't ingested as a document. If it's missing it's rebuilt from the
+sha256 metadata each uploaded object carries. It stays marked pending from
+the upload until an ingestion job completes, so a failed or interrupted
+ingestion is retried on the next run.
+
+Pre-requisites:
+- Run the create_knowledge_base.py script to create a knowledge base
+
+Call with:
+python sync_rag_data.py
+"""
+import hashlib
+import json
+import os
+import utils
+
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger as log
+
+
+# Constants
+shared_consts = utils.get_shared_consts()
+KB_NAME = shared_consts["KB_NAME"]
+KB_BUCKET_NAME = shared_consts["KB_BUCKET_NAME"]
+RAG_DATA_DIR = os.path.join(utils.PROJECT_DIR, "rag_data")
+MANIFEST_PATH = os.path.join(utils.PROJECT_DIR, ".rag_data_manifest.json")
+MAX_WORKERS = 8
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+)
+
+s3_client = utils.LazyClient("s3")
+bedrock_client = utils.LazyClient("bedrock-agent")
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest() -> tuple:
+    """
+    Returns {key: {"sha256", "size", "mtime"}} for the objects in the bucket
+    and whether they still have to be ingested
+    """
+    if os.path.exists(MANIFEST_PATH):
+        with open(MANIFEST_PATH) as f:
+            manifest = json.load(f)
+        if manifest.get("bucket") == KB_BUCKET_NAME:
+            return manifest["files"], manifest.get("pending", False)
+    log.info("Manifest not found... Rebuilding it from the bucket")
+    # There's no telling whether the bucket was ingested, so ingest it
+    return rebuild_manifest(), True
+
+
+def rebuild_manifest() -> dict:
+    keys = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=KB_BUCKET_NAME):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+
+    def head(key):
+        response = s3_client.head_object(Bucket=KB_BUCKET_NAME, Key=key)
+        return key, {
+            "sha256": response["Metadata"].get("sha256", ""),
+            "size": response["ContentLength"],
+            "mtime": 0,
+        }
+
+    with ThreadPoolExecutor(MAX_WORKERS) as executor:
+        return dict(executor.map(head, keys))
+
+
+def save_manifest(files: dict, pending: bool) -> None:
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump(
+            {"bucket": KB_BUCKET_NAME, "files": files, "pending": pending},
+            f,
+            indent=2,
+        )
+
+
+def scan_local_files(manifest: dict) -> dict:
+    """
+    Returns {key: {"sha256", "size", "mtime"}} for every file in rag_data,
+    skipping the hash for files whose size and mtime match the manifest
+    """
+    files = {}
+    for root, _, names in os.walk(RAG_DATA_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            key = os.path.relpath(path, RAG_DATA_DIR).replace(os.sep, "/")
+            stat = os.stat(path)
+            known = manifest.get(key, {})
+            if known.get("size") == stat.st_size and known.get("mtime") == stat.st_mtime:
+                sha256 = known["sha256"]
+            else:
+                sha256 = hash_file(path)
+            files[key] = {
+                "sha256": sha256,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+    return files
+
+
+def upload_file(key: str, sha256: str) -> None:
+    s3_client.upload_file(
+        os.path.join(RAG_DATA_DIR, key),
+        KB_BUCKET_NAME,
+        key,
+        ExtraArgs={"Metadata": {"sha256": sha256}},
+        Config=TRANSFER_CONFIG,
+    )
+    log.info(f"Uploaded {key}")
+
+
+def delete_files(keys: list) -> None:
+    # delete_objects takes at most 1000 keys per call
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=KB_BUCKET_NAME,
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
+        )
+    for key in keys:
+        log.info(f"Deleted {key}")
+
+
+def main():
+    if not os.path.isdir(RAG_DATA_DIR):
+        log.error(f"{RAG_DATA_DIR} directory not found")
+        exit(1)
+
+    manifest, pending = load_manifest()
+    local_files = scan_local_files(manifest)
+    changed = [
+        key
+        for key, info in local_files.items()
+        if manifest.get(key, {}).get("sha256") != info["sha256"]
+    ]
+    removed = [key for key in manifest if key not in local_files]
+    log.info(f"{len(changed)} new or changed files, {len(removed)} removed files")
+
+    if not changed and not removed and not pending:
+        # Saved to record the new mtimes
+        save_manifest(local_files, pending=False)
+        log.success("Knowledge base data is already in sync")
+        return
+
+    # Looked up before uploading so nothing changes without being ingested
+    kb_id = utils.get_knowledge_base_id(bedrock_client, KB_NAME)
+    if not kb_id:
+        log.error(f"Knowledge base {KB_NAME} not found, run create_knowledge_base.py")
+        exit(1)
+    kb_ds_ids = utils.get_knowledge_base_data_source_ids(bedrock_client, kb_id)
+    if not kb_ds_ids:
+        log.error("Knowledge base data source not found, run create_knowledge_base.py")
+        exit(1)
+
+    if changed:
+        with ThreadPoolExecutor(MAX_WORKERS) as executor:
+            list(
+                executor.map(
+                    lambda key: upload_file(key, local_files[key]["sha256"]), changed
+                )
+            )
+    if removed:
+        delete_files(removed)
+    # The bucket now matches the local files but isn't ingested yet
+    save_manifest(local_files, pending=True)
+
+    utils.ingest_data_source(bedrock_client, kb_id, kb_ds_ids[0]["id"])
+    save_manifest(local_files, pending=False)
+    log.success("Successfully synced the knowledge base data!!!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+
+# The app imports its helpers as `utils.*`, the way `python app.py` runs it
+FLASK_CHATBOT_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flask_chatbot"
+)
+if FLASK_CHATBOT_DIR not in sys.path:
+    sys.path.insert(0, FLASK_CHATBOT_DIR)
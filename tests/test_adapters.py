@@ -0,0 +1,33 @@
+import pytest
+
+from utils import adapters
+from utils.adapters import ModelAdapter, get_model_adapter
+
+
+def test_longest_prefix_wins_whatever_the_order(monkeypatch):
+    body = {"prompt": adapters._MESSAGE_SENTINEL}
+    generic = ModelAdapter(["anthropic.claude"], body, ("completion",))
+    claude_3 = ModelAdapter(["anthropic.claude-3"], body, ("content",))
+    monkeypatch.setattr(adapters, "MODEL_ADAPTERS", [generic, claude_3])
+    monkeypatch.setattr(adapters, "_adapters_by_model_id", {})
+    assert get_model_adapter("anthropic.claude-3-haiku-20240307-v1:0") is claude_3
+    assert get_model_adapter("anthropic.claude-v2") is generic
+
+
+@pytest.mark.parametrize(
+    "model_id,expected_prefix",
+    [
+        ("anthropic.claude-3-sonnet-20240229-v1:0", "anthropic.claude-3"),
+        ("anthropic.claude-instant-v1", "anthropic.claude"),
+        ("cohere.command-r-v1:0", "cohere.command-r"),
+        ("cohere.command-text-v14", "cohere.command"),
+        ("meta.llama3-8b-instruct-v1:0", "meta.llama3"),
+    ],
+)
+def test_registered_families(model_id, expected_prefix):
+    assert expected_prefix in get_model_adapter(model_id).prefixes
+
+
+def test_unknown_family_raises():
+    with pytest.raises(ValueError):
+        get_model_adapter("amazon.nova-lite-v1:0")
@@ -0,0 +1,154 @@
+import threading
+import time
+
+import pytest
+
+from botocore.exceptions import ClientError
+
+from utils import bedrock
+from utils.bedrock import AdmissionController, AdmissionTimeout, TokenBucket
+
+
+def make_controller(max_concurrency: int = 4) -> AdmissionController:
+    return AdmissionController(
+        requests_per_minute=60000,
+        tokens_per_minute=10**9,
+        max_concurrency=max_concurrency,
+    )
+
+
+def throttling_error() -> ClientError:
+    return ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}},
+        "InvokeModel",
+    )
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(rate_per_minute=60)
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    # One token per second
+    assert bucket.wait_time(1) == pytest.approx(1, abs=0.05)
+
+
+def test_throttling_halves_the_limit_down_to_one():
+    controller = make_controller(max_concurrency=8)
+    for expected in (4, 2, 1, 1):
+        controller.acquire(1, timeout=1)
+        controller.release(throttled=True)
+        assert controller.stats()["limit"] == expected
+    assert controller.stats()["throttled"] == 4
+
+
+def test_rates_are_unlimited_without_a_quota():
+    controller = AdmissionController(max_concurrency=1)
+    start = time.monotonic()
+    for _ in range(1000):
+        controller.acquire(10**6, timeout=0)
+        controller.release()
+    assert time.monotonic() - start < 1
+    assert controller.stats()["rejected"] == 0
+
+
+def test_successes_grow_the_limit_additively_up_to_the_max():
+    controller = make_controller(max_concurrency=4)
+    controller.acquire(1, timeout=1)
+    controller.release(throttled=True)
+    assert controller.stats()["limit"] == 2
+    # About one more slot per window of limit successful calls
+    for _ in range(2):
+        controller.acquire(1, timeout=1)
+        controller.release()
+    assert controller.stats()["limit"] == 2
+    for _ in range(2):
+        controller.acquire(1, timeout=1)
+        controller.release()
+    assert controller.stats()["limit"] == 3
+    for _ in range(50):
+        controller.acquire(1, timeout=1)
+        controller.release()
+    assert controller.stats()["limit"] == 4
+
+
+def test_acquire_rejects_after_timeout_when_full():
+    controller = make_controller(max_concurrency=1)
+    controller.acquire(1, timeout=1)
+    with pytest.raises(AdmissionTimeout):
+        controller.acquire(1, timeout=0.05)
+    assert controller.stats() == {
+        "limit": 1,
+        "in_flight": 1,
+        "throttled": 0,
+        "rejected": 1,
+    }
+
+
+def test_release_wakes_a_waiting_caller():
+    controller = make_controller(max_concurrency=1)
+    controller.acquire(1, timeout=1)
+    timer = threading.Timer(0.05, controller.release)
+    timer.start()
+    start = time.monotonic()
+    controller.acquire(1, timeout=2)
+    assert time.monotonic() - start < 1
+    timer.join()
+
+
+def test_call_with_admission_retries_throttled_calls():
+    model_id = "test.retry-model"
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise throttling_error()
+        return "answer"
+
+    assert bedrock.call_with_admission(model_id, "us-east-1", 1, fn) == "answer"
+    stats = bedrock.get_admission_controller(model_id, "us-east-1").stats()
+    assert len(attempts) == 3
+    assert stats["throttled"] == 2
+    assert stats["in_flight"] == 0
+
+
+def test_call_with_admission_backs_off_exponentially(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(bedrock.random, "uniform", lambda low, high: high)
+    monkeypatch.setattr(bedrock.time, "sleep", sleeps.append)
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) < 4:
+            raise throttling_error()
+        return "answer"
+
+    assert bedrock.call_with_admission("test.backoff-model", "us-east-1", 1, fn)
+    base = bedrock.ADMISSION_RETRY_BASE_SECONDS
+    assert sleeps == [base, base * 2, base * 4]
+
+
+def test_call_with_admission_raises_other_errors_without_retrying():
+    model_id = "test.error-model"
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        bedrock.call_with_admission(model_id, "us-east-1", 1, fn)
+    assert len(attempts) == 1
+    stats = bedrock.get_admission_controller(model_id, "us-east-1").stats()
+    assert stats["in_flight"] == 0
+
+
+def test_capacity_errors_are_admission_timeouts_and_throttling():
+    assert bedrock.is_capacity_error(AdmissionTimeout("busy"))
+    assert bedrock.is_capacity_error(throttling_error())
+    validation = ClientError(
+        {"Error": {"Code": "ValidationException", "Message": "Bad"}}, "InvokeModel"
+    )
+    assert not bedrock.is_capacity_error(validation)
+    assert not bedrock.is_capacity_error(ValueError("no index"))
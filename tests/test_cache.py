@@ -0,0 +1,126 @@
+import sqlite3
+import time
+
+from utils.cache import IngestionWatcher, ResponseCache
+
+
+class FakeAgentClient:
+    """
+    bedrock-agent client with one data source whose latest completed
+    ingestion job is set by the test
+    """
+
+    def __init__(self):
+        self.job = None
+
+    def can_paginate(self, operation: str) -> bool:
+        return False
+
+    def list_data_sources(self, **kwargs) -> dict:
+        return {"dataSourceSummaries": [{"dataSourceId": "DS1"}]}
+
+    def list_ingestion_jobs(self, **kwargs) -> dict:
+        jobs = []
+        if self.job is not None:
+            jobs.append({"ingestionJobId": self.job, "startedAt": 1})
+        return {"ingestionJobSummaries": jobs}
+
+
+class RecordingCache:
+    def __init__(self):
+        self.invalidated = []
+
+    def invalidate_knowledge_base(self, kb_id: str) -> None:
+        self.invalidated.append(kb_id)
+
+
+def make_watcher():
+    client = FakeAgentClient()
+    cache = RecordingCache()
+    return client, cache, IngestionWatcher(client, [cache], lambda: "KB1")
+
+
+def test_first_poll_only_records_the_latest_job():
+    client, cache, watcher = make_watcher()
+    client.job = "JOB1"
+    watcher.check()
+    watcher.check()
+    assert cache.invalidated == []
+
+
+def test_new_job_invalidates():
+    client, cache, watcher = make_watcher()
+    client.job = "JOB1"
+    watcher.check()
+    client.job = "JOB2"
+    watcher.check()
+    assert cache.invalidated == ["KB1"]
+
+
+def test_first_job_after_startup_without_jobs_invalidates():
+    client, cache, watcher = make_watcher()
+    watcher.check()
+    assert cache.invalidated == []
+    client.job = "JOB1"
+    watcher.check()
+    assert cache.invalidated == ["KB1"]
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.set("a", {"text": "a"})
+    cache.set("b", {"text": "b"})
+    cache.get("a")
+    cache.set("c", {"text": "c"})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"text": "a"}
+    assert cache.get("c") == {"text": "c"}
+
+
+def test_entries_expire_after_the_ttl():
+    cache = ResponseCache(ttl=0.05)
+    cache.set("a", {"text": "a"})
+    assert cache.get("a") == {"text": "a"}
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_sqlite_tier_is_shared_between_caches(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    writer = ResponseCache(sqlite_path=path)
+    reader = ResponseCache(sqlite_path=path)
+    writer.set("a", {"text": "a", "citations": []}, "KB1")
+    assert reader.get("a") == {"text": "a", "citations": []}
+    assert reader.get("a") == {"text": "a", "citations": []}
+    assert reader.stats()["sqlite_hits"] == 1
+    assert reader.stats()["hits"] == 1
+
+    writer.set("b", {"text": "b"}, "KB2")
+    writer.invalidate_knowledge_base("KB1")
+    assert ResponseCache(sqlite_path=path).get("a") is None
+    assert ResponseCache(sqlite_path=path).get("b") == {"text": "b"}
+
+
+def test_sqlite_hit_keeps_the_remaining_ttl(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(ttl=0.2, sqlite_path=path).set("a", {"text": "a"})
+    time.sleep(0.1)
+    reader = ResponseCache(ttl=0.2, sqlite_path=path)
+    assert reader.get("a") == {"text": "a"}
+    time.sleep(0.15)
+    # Past the row's expiry, though not a full TTL after it was read
+    assert reader.get("a") is None
+
+
+def test_sqlite_tier_purges_expired_rows_and_caps_its_size(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(ttl=0.01, sqlite_path=path).set("old", {"text": "old"})
+    time.sleep(0.05)
+    cache = ResponseCache(sqlite_path=path, max_sqlite_entries=10)
+    for i in range(100):
+        cache.set(str(i), {"text": str(i)})
+    rows = sqlite3.connect(path).execute("SELECT key FROM responses")
+    keys = {row[0] for row in rows}
+    # The rows closest to expiry, the oldest, go first
+    assert keys == {str(i) for i in range(90, 100)}
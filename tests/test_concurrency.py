@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from utils import bedrock
+from utils.concurrency import (
+    ModelConcurrencyLimiter,
+    QueueFullError,
+    iterate_in_thread,
+)
+
+
+MODEL_ID = "anthropic.claude-v2"
+
+
+def test_limit_bounds_in_flight_calls_per_model():
+    limiter = ModelConcurrencyLimiter(lambda model_id: 2, max_queue_depth=10)
+    in_flight = 0
+    peak = 0
+
+    async def call():
+        nonlocal in_flight, peak
+        async with limiter.limit(MODEL_ID):
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    async def main():
+        await asyncio.gather(*[call() for _ in range(6)])
+
+    asyncio.run(main())
+    assert peak == 2
+    assert limiter.queue_depth(MODEL_ID) == 0
+
+
+def test_full_queue_rejects_new_requests():
+    limiter = ModelConcurrencyLimiter(lambda model_id: 1, max_queue_depth=1)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.limit(MODEL_ID):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        waiter = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        assert limiter.queue_depth(MODEL_ID) == 1
+        with pytest.raises(QueueFullError):
+            async with limiter.limit(MODEL_ID):
+                pass
+        # Other models have their own slots and queue
+        async with limiter.limit("meta.llama2-13b-chat-v1"):
+            pass
+        release.set()
+        await asyncio.gather(holder, waiter)
+
+    asyncio.run(main())
+
+
+def test_rate_limits_apply_the_model_overrides(monkeypatch):
+    monkeypatch.setitem(bedrock.DEFAULT_RATE_LIMITS, "max_concurrency", 32)
+    monkeypatch.setitem(bedrock.MODEL_RATE_LIMITS, MODEL_ID, {"max_concurrency": 8})
+    assert bedrock.get_rate_limits(MODEL_ID)["max_concurrency"] == 8
+    assert bedrock.get_rate_limits("meta.llama2-13b-chat-v1")["max_concurrency"] == 32
+
+
+def test_iterate_in_thread_yields_every_item():
+    async def main():
+        return [item async for item in iterate_in_thread(iter(range(5)))]
+
+    assert asyncio.run(main()) == [0, 1, 2, 3, 4]
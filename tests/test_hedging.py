@@ -0,0 +1,157 @@
+import io
+import itertools
+import json
+import threading
+import time
+
+import pytest
+
+from utils import bedrock
+from utils.bedrock import HedgePolicy
+
+
+MODEL_ID = "anthropic.claude-v2"
+_regions = itertools.count()
+
+
+class FakeRuntimeClient:
+    """
+    Stands in for a bedrock-runtime client. Each call sleeps for the next
+    of the given delays, and a (delay, exception) pair fails after it.
+    """
+
+    def __init__(self, *delays):
+        # A region of its own so every test gets fresh policies and limits
+        self.meta = type("Meta", (), {"region_name": f"test-{next(_regions)}"})
+        self.delays = list(delays)
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, body, accept, contentType):
+        with self._lock:
+            call = len(self.threads)
+            self.threads.append(threading.current_thread())
+            delay = self.delays[min(call, len(self.delays) - 1)]
+        delay, error = delay if isinstance(delay, tuple) else (delay, None)
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return {
+            "body": io.BytesIO(json.dumps({"completion": f"answer {call}"}).encode()),
+            "ResponseMetadata": {"HTTPHeaders": {}},
+        }
+
+
+@pytest.fixture
+def hedging():
+    saved = dict(bedrock.HEDGE_CONFIG)
+    bedrock.configure_hedging(
+        enabled=True, min_samples=3, min_delay_seconds=0.05, budget_ratio=1
+    )
+    yield
+    bedrock.configure_hedging(**saved)
+
+
+def make_policy(**settings) -> HedgePolicy:
+    defaults = {
+        "percentile": 95,
+        "min_delay_seconds": 0.5,
+        "min_samples": 3,
+        "window": 100,
+        "budget_ratio": 0.5,
+        "max_budget": 2,
+    }
+    return HedgePolicy(**{**defaults, **settings})
+
+
+def seed(client, seconds: float = 0.01, count: int = 3) -> HedgePolicy:
+    policy = bedrock.get_hedge_policy(MODEL_ID, client.meta.region_name)
+    for _ in range(count):
+        policy.record(seconds)
+    return policy
+
+
+def test_no_delay_until_enough_samples():
+    policy = make_policy()
+    assert policy.start_call() is None
+    for _ in range(3):
+        policy.record(1.0)
+    assert policy.start_call() == 1.0
+
+
+def test_delay_is_the_percentile_with_a_floor():
+    policy = make_policy(percentile=50, min_delay_seconds=0.5)
+    for seconds in (0.1, 0.2, 0.3, 2.0):
+        policy.record(seconds)
+    assert policy.start_call() == 0.5
+    for seconds in (3.0, 4.0, 5.0):
+        policy.record(seconds)
+    assert policy.start_call() == 2.0
+
+
+def test_budget_is_topped_up_per_call_and_capped():
+    policy = make_policy(budget_ratio=0.5, max_budget=2)
+    policy.start_call()
+    assert not policy.can_hedge()
+    assert not policy.try_hedge()
+    policy.start_call()
+    assert policy.try_hedge()
+    assert not policy.try_hedge()
+    for _ in range(10):
+        policy.start_call()
+    assert policy.budget == 2
+    assert policy.stats()["hedged"] == 1
+    assert policy.stats()["over_budget"] == 2
+
+
+def test_slow_primary_is_hedged_and_the_hedge_wins(hedging):
+    client = FakeRuntimeClient(1.0, 0.01)
+    policy = seed(client)
+    start = time.perf_counter()
+    answer = bedrock.hedged_invoke_model(client, MODEL_ID, "{}")
+    assert answer == "answer 1"
+    assert time.perf_counter() - start < 0.5
+    assert policy.stats()["hedged"] == 1
+    assert policy.stats()["hedge_wins"] == 1
+
+
+def test_hedge_covers_a_failing_primary(hedging):
+    client = FakeRuntimeClient((0.2, RuntimeError("primary failed")), 0.3)
+    policy = seed(client)
+    assert bedrock.hedged_invoke_model(client, MODEL_ID, "{}") == "answer 1"
+    assert policy.stats()["hedge_wins"] == 1
+
+
+def test_primary_runs_on_the_callers_thread_without_budget(hedging):
+    client = FakeRuntimeClient(0.1)
+    bedrock.configure_hedging(budget_ratio=0)
+    policy = seed(client)
+    assert bedrock.hedged_invoke_model(client, MODEL_ID, "{}") == "answer 0"
+    assert client.threads == [threading.current_thread()]
+    # Slower than the delay, so it would have been hedged
+    assert policy.stats()["over_budget"] == 1
+    assert policy.stats()["hedged"] == 0
+
+
+def test_primary_runs_on_the_callers_thread_before_there_are_samples(hedging):
+    client = FakeRuntimeClient(0.01)
+    bedrock.hedged_invoke_model(client, MODEL_ID, "{}")
+    assert client.threads == [threading.current_thread()]
+
+
+def test_fast_primary_is_not_hedged(hedging):
+    client = FakeRuntimeClient(0.01)
+    policy = seed(client, seconds=1.0)
+    assert bedrock.hedged_invoke_model(client, MODEL_ID, "{}") == "answer 0"
+    assert len(client.threads) == 1
+    assert policy.stats()["hedged"] == 0
+
+
+def test_both_failing_raises(hedging):
+    client = FakeRuntimeClient(
+        (0.1, RuntimeError("primary failed")), (0.01, RuntimeError("hedge failed"))
+    )
+    seed(client)
+    with pytest.raises(RuntimeError):
+        bedrock.hedged_invoke_model(client, MODEL_ID, "{}")
+    assert len(client.threads) == 2
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from utils.bedrock import KnowledgeBaseResolver
+
+
+class FakeAgentClient:
+    """
+    bedrock-agent client listing the given knowledge bases on one page
+    """
+
+    def __init__(self, names, delay: float = 0.0):
+        self.names = list(names)
+        self.delay = delay
+        self.list_calls = 0
+        self._lock = threading.Lock()
+
+    def can_paginate(self, operation: str) -> bool:
+        return False
+
+    def list_knowledge_bases(self, **kwargs) -> dict:
+        with self._lock:
+            self.list_calls += 1
+        time.sleep(self.delay)
+        return {
+            "knowledgeBaseSummaries": [
+                {"name": name, "knowledgeBaseId": f"ID-{name}"} for name in self.names
+            ]
+        }
+
+
+def test_get_returns_cached_id():
+    client = FakeAgentClient(["demo-rag"])
+    resolver = KnowledgeBaseResolver(client)
+    assert resolver.get("demo-rag") == "ID-demo-rag"
+    assert resolver.get("demo-rag") == "ID-demo-rag"
+    assert client.list_calls == 1
+
+
+def test_unknown_name_refreshes_once_per_miss_ttl():
+    client = FakeAgentClient(["demo-rag"])
+    resolver = KnowledgeBaseResolver(client, miss_ttl=60)
+    for _ in range(5):
+        assert resolver.get("typo") == ""
+    assert client.list_calls == 1
+
+
+def test_expired_miss_refreshes_again_and_finds_new_name():
+    client = FakeAgentClient(["demo-rag"])
+    resolver = KnowledgeBaseResolver(client, miss_ttl=0)
+    assert resolver.get("new-kb") == ""
+    client.names.append("new-kb")
+    assert resolver.get("new-kb") == "ID-new-kb"
+    assert client.list_calls == 2
+
+
+def test_invalidate_forgets_miss():
+    client = FakeAgentClient(["demo-rag"])
+    resolver = KnowledgeBaseResolver(client, miss_ttl=60)
+    assert resolver.get("new-kb") == ""
+    client.names.append("new-kb")
+    resolver.invalidate("new-kb")
+    assert resolver.get("new-kb") == "ID-new-kb"
+
+
+def test_concurrent_misses_share_one_listing():
+    client = FakeAgentClient(["demo-rag"], delay=0.2)
+    resolver = KnowledgeBaseResolver(client)
+    threads = [
+        threading.Thread(target=resolver.get, args=("typo",)) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.list_calls == 1
@@ -0,0 +1,54 @@
+import io
+import json
+
+import numpy as np
+
+from utils import bedrock
+from utils.local_index import NORMS_FILE, LocalVectorIndex
+
+
+def test_build_and_load_round_trip(tmp_path):
+    vectors = np.array([[3.0, 4.0, 0.0], [0.0, 0.0, 2.0]], dtype=np.float32)
+    chunks = [{"text": "first", "uri": "s3://b/1"}, {"text": "second", "uri": ""}]
+    LocalVectorIndex.build(vectors, chunks, str(tmp_path))
+    index = LocalVectorIndex.load(str(tmp_path))
+    assert index.dimension == 3
+    assert np.allclose(np.load(tmp_path / NORMS_FILE), [5.0, 2.0])
+    (hit,) = index.search([0.0, 0.1, 1.0], k=1)
+    assert hit["content"]["text"] == "second"
+    assert hit["location"]["s3Location"]["uri"] == ""
+
+
+class FakeEmbeddingClient:
+    def __init__(self):
+        self.bodies = []
+
+    def invoke_model(self, modelId, body, accept, contentType):
+        self.bodies.append(json.loads(body))
+        return {
+            "body": io.BytesIO(json.dumps({"embedding": [0.0] * 4}).encode()),
+            "ResponseMetadata": {"HTTPHeaders": {}},
+        }
+
+
+def test_get_embedding_sends_the_configured_settings(monkeypatch):
+    settings = {"dimensions": 256, "normalize": True}
+    monkeypatch.setattr(bedrock, "BEDROCK_EMBED_SETTINGS", settings)
+    client = FakeEmbeddingClient()
+    bedrock.get_embedding(client, "question")
+    bedrock.get_embedding(client, "question", "amazon.titan-embed-text-v1")
+    assert client.bodies == [
+        {"inputText": "question", **settings},
+        {"inputText": "question"},
+    ]
+
+
+def test_recall_rises_with_n_probe(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((400, 16)).astype(np.float32)
+    chunks = [{"text": str(i)} for i in range(len(vectors))]
+    LocalVectorIndex.build(vectors, chunks, str(tmp_path), n_lists=20)
+    index = LocalVectorIndex.load(str(tmp_path))
+    queries = vectors[:50] + rng.standard_normal((50, 16)).astype(np.float32) * 0.1
+    assert index.recall(queries, k=5, n_probe=1) < 1.0
+    assert index.recall(queries, k=5, n_probe=20) == 1.0
@@ -0,0 +1,69 @@
+import contextvars
+import threading
+
+import pytest
+
+from utils import metrics
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    trace = pytest.importorskip("opentelemetry.trace")
+    sdk_trace = pytest.importorskip("opentelemetry.sdk.trace")
+    export = pytest.importorskip("opentelemetry.sdk.trace.export")
+    in_memory = pytest.importorskip(
+        "opentelemetry.sdk.trace.export.in_memory_span_exporter"
+    )
+    exporter = in_memory.InMemorySpanExporter()
+    provider = sdk_trace.TracerProvider()
+    provider.add_span_processor(export.SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(metrics, "_trace", trace)
+    monkeypatch.setattr(metrics, "_tracer", provider.get_tracer("test"))
+    return exporter
+
+
+def test_span_records_the_stage_duration():
+    metrics.start_request("/test-stage", "test.model")
+    with metrics.span("build_body"):
+        pass
+    rendered = metrics.render_metrics()
+    assert 'route="/test-stage",model="test.model",stage="build_body"' in rendered
+
+
+def test_stages_are_traced_under_the_request(spans):
+    metrics.start_request("/traced", "test.model")
+    labels = metrics.get_request_labels()
+    with metrics.span("embed"):
+        pass
+
+    def worker():
+        with metrics.span("generate"):
+            with metrics.span("parse"):
+                pass
+
+    # Worker threads get the request through a copy of its context
+    context = contextvars.copy_context()
+    thread = threading.Thread(target=context.run, args=(worker,))
+    thread.start()
+    thread.join()
+    metrics.observe_request(labels, 200)
+
+    finished = {span.name: span for span in spans.get_finished_spans()}
+    assert set(finished) == {"/traced", "embed", "generate", "parse"}
+    request_span = finished["/traced"]
+    assert request_span.parent is None
+    assert request_span.attributes["http.status_code"] == 200
+    trace_ids = {span.context.trace_id for span in finished.values()}
+    assert trace_ids == {request_span.context.trace_id}
+    assert finished["embed"].parent.span_id == request_span.context.span_id
+    assert finished["generate"].parent.span_id == request_span.context.span_id
+    assert finished["parse"].parent.span_id == finished["generate"].context.span_id
+
+
+def test_failed_stage_records_the_exception(spans):
+    metrics.start_request("/failing", "test.model")
+    with pytest.raises(ValueError):
+        with metrics.span("generate"):
+            raise ValueError("bad request")
+    (span,) = spans.get_finished_spans()
+    assert span.events[0].name == "exception"
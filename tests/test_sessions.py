@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from utils import sessions
+from utils.sessions import SessionStore
+
+
+SESSION_ID = sessions.new_session_id()
+
+
+@pytest.fixture
+def slow_trim(monkeypatch):
+    """
+    Widens the gap between reading and writing a session so concurrent
+    turns overlap every time
+    """
+    trim_history = sessions.trim_history
+
+    def slow(history, max_tokens):
+        time.sleep(0.01)
+        return trim_history(history, max_tokens)
+
+    monkeypatch.setattr(sessions, "trim_history", slow)
+
+
+def add_turns_concurrently(stores: list, turns_per_thread: int) -> None:
+    def add_turns(store, thread_number):
+        for turn in range(turns_per_thread):
+            store.add_turn(SESSION_ID, f"question {thread_number}.{turn}", "answer")
+
+    threads = [
+        threading.Thread(target=add_turns, args=(store, number))
+        for number, store in enumerate(stores)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_history_is_trimmed_to_the_token_budget():
+    store = SessionStore(max_history_tokens=20)
+    for turn in range(10):
+        store.add_turn(SESSION_ID, f"question {turn}", "answer")
+    history = store.get(SESSION_ID)["history"]
+    assert 0 < len(history) < 10
+    assert history[-1]["user"] == "question 9"
+
+
+def test_kb_session_id_is_kept_until_replaced():
+    store = SessionStore()
+    store.add_turn(SESSION_ID, "first", "answer", "kb-1")
+    store.add_turn(SESSION_ID, "second", "answer")
+    assert store.get(SESSION_ID)["kb_session_id"] == "kb-1"
+    store.add_turn(SESSION_ID, "third", "answer", "kb-2")
+    assert store.get(SESSION_ID)["kb_session_id"] == "kb-2"
+
+
+def test_concurrent_turns_are_all_kept(slow_trim):
+    store = SessionStore(max_history_tokens=100000)
+    add_turns_concurrently([store] * 4, turns_per_thread=5)
+    assert len(store.get(SESSION_ID)["history"]) == 20
+
+
+def test_concurrent_turns_across_sqlite_stores_are_all_kept(slow_trim, tmp_path):
+    # One store per thread stands in for one store per worker process
+    path = str(tmp_path / "sessions.sqlite3")
+    stores = [
+        SessionStore(max_history_tokens=100000, sqlite_path=path) for _ in range(3)
+    ]
+    add_turns_concurrently(stores, turns_per_thread=5)
+    assert len(stores[0].get(SESSION_ID)["history"]) == 15
+
+
+def test_idle_sessions_are_evicted():
+    store = SessionStore(idle_ttl=0.05)
+    store.add_turn(SESSION_ID, "question", "answer")
+    time.sleep(0.1)
+    assert store.get(SESSION_ID)["history"] == []
+    assert store.stats()["evicted"] == 1
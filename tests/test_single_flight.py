@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from utils.bedrock import SingleFlight
+
+
+def run_concurrently(count: int, target) -> None:
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_followers_share_the_leaders_result():
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.1)
+        return "answer"
+
+    run_concurrently(5, lambda: results.append(flight.do("key", fn)))
+    assert calls == [1]
+    assert results == ["answer"] * 5
+    assert flight.stats() == {"calls": 1, "deduplicated": 4, "in_flight": 0}
+
+
+def test_followers_get_the_leaders_exception():
+    flight = SingleFlight()
+    errors = []
+
+    def fn():
+        time.sleep(0.1)
+        raise ValueError("throttled")
+
+    def call():
+        try:
+            flight.do("key", fn)
+        except ValueError as e:
+            errors.append(e)
+
+    run_concurrently(4, call)
+    assert len(errors) == 4
+    assert len({id(error) for error in errors}) == 1
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_calls_after_completion_run_again():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("first")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    assert flight.do("key", lambda: "second") == "second"
+    assert flight.stats()["calls"] == 2
+
+
+def test_different_keys_are_not_coalesced():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("b", lambda: 2) == 2
+    assert flight.stats()["deduplicated"] == 0
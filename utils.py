@@ -1,12 +1,19 @@
 import boto3
+import json
+import os
+import threading
 import time
+import waiters
 
+from collections.abc import Mapping
 from loguru import logger as log
+from waiters import WaiterError
 
 # Constants
 AWS_REGION = "us-east-1"
 KB_NAME = "demo-rag"
 KB_DESCRIPTION = "Demo knowledge base for RAG"
+# Same as BEDROCK_EMBED_MODEL_ID in flask_chatbot/utils/bedrock.py
 BEDROCK_FM = "amazon.titan-embed-text-v1"
 BEDROCK_EMBED_MODEL_ARN = f"arn:aws:bedrock:{AWS_REGION}::foundation-model/{BEDROCK_FM}"
 OS_COLLECTION_NAME = f"{KB_NAME}-os-collection"
@@ -16,6 +23,17 @@ OS_POLICY_NAME = "bedrock-security-policy"
 # Output from ./terraform apply
 KB_ROLE_NAME = "AmazonBedrockExecutionRoleForKnowledgeBase_Default"
 
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Written with: terraform -chdir=terraform output -json > terraform/outputs.json
+TERRAFORM_OUTPUTS_PATH = os.path.join(PROJECT_DIR, "terraform", "outputs.json")
+TERRAFORM_OUTPUT_NAMES = {
+    "KB_BUCKET_NAME": "genai_knowledge_base_s3_bucket_name",
+    "KB_ROLE_ARN": "bedrock_execution_role_arn",
+}
+# Values looked up from AWS are cached per account and region
+SHARED_CONSTS_CACHE_PATH = os.path.join(PROJECT_DIR, ".shared_consts_cache.json")
+SHARED_CONSTS_CACHE_TTL = 24 * 3600
+
 
 def get_bedrock_s3_bucket_name() -> str:
     client = boto3.client("s3")
@@ -32,107 +50,277 @@ def get_aws_iam_role_arn(name: str) -> str:
     return response["Role"]["Arn"]
 
 
-def get_shared_consts() -> dict:
-    kb_role_arn = get_aws_iam_role_arn(KB_ROLE_NAME)
-    kb_bucket_name = get_bedrock_s3_bucket_name()
-    kb_bucket_arn = f"arn:aws:s3:::{kb_bucket_name}"
-    return {
-        "AWS_REGION": AWS_REGION,
-        "KB_NAME": KB_NAME,
-        "KB_DESCRIPTION": KB_DESCRIPTION,
-        "KB_BUCKET_NAME": kb_bucket_name,
-        "KB_BUCKET_ARN": kb_bucket_arn,
-        "BEDROCK_FM": BEDROCK_FM,
-        "BEDROCK_EMBED_MODEL_ARN": BEDROCK_EMBED_MODEL_ARN,
-        "OS_COLLECTION_NAME": OS_COLLECTION_NAME,
-        "OS_VECTOR_PREFIX": OS_VECTOR_PREFIX,
-        "OS_POLICY_NAME": OS_POLICY_NAME,
-        "KB_ROLE_NAME": KB_ROLE_NAME,
-        "KB_ROLE_ARN": kb_role_arn,
-    }
+class SharedConsts(Mapping):
+    """
+    Configuration shared by the scripts, resolved lazily.
+
+    Static values are plain constants. Values that need AWS calls (the
+    knowledge base bucket and IAM role) are resolved on first access from,
+    in order: an environment variable of the same name, the Terraform
+    outputs file, the local cache file, and finally AWS, after which the
+    value is written to the cache. Nothing touches AWS until one of them is
+    read, so --help and dry runs start instantly.
+    """
+
+    def __init__(self):
+        self._values = {
+            "AWS_REGION": AWS_REGION,
+            "KB_NAME": KB_NAME,
+            "KB_DESCRIPTION": KB_DESCRIPTION,
+            "BEDROCK_FM": BEDROCK_FM,
+            "BEDROCK_EMBED_MODEL_ARN": BEDROCK_EMBED_MODEL_ARN,
+            "OS_COLLECTION_NAME": OS_COLLECTION_NAME,
+            "OS_VECTOR_PREFIX": OS_VECTOR_PREFIX,
+            "OS_POLICY_NAME": OS_POLICY_NAME,
+            "KB_ROLE_NAME": KB_ROLE_NAME,
+        }
+        self._resolvers = {
+            "KB_BUCKET_NAME": get_bedrock_s3_bucket_name,
+            "KB_BUCKET_ARN": self._get_bucket_arn,
+            "KB_ROLE_ARN": lambda: get_aws_iam_role_arn(KB_ROLE_NAME),
+        }
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key: str):
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+            if key not in self._resolvers:
+                raise KeyError(key)
+            value = self._resolve(key)
+            if value:
+                self._values[key] = value
+            return value
+
+    def __iter__(self):
+        return iter([*self._values, *self._resolvers])
+
+    def __len__(self) -> int:
+        return len(set(self._values) | set(self._resolvers))
+
+    def _get_bucket_arn(self) -> str:
+        bucket = self["KB_BUCKET_NAME"]
+        return f"arn:aws:s3:::{bucket}" if bucket else ""
+
+    def _resolve(self, key: str):
+        if os.environ.get(key):
+            return os.environ[key]
+        value = self._read_terraform_output(key)
+        if value:
+            return value
+        if key not in TERRAFORM_OUTPUT_NAMES:
+            # Derived values are cheap once their inputs are resolved
+            return self._resolvers[key]()
+
+        cache_key = self._get_cache_key()
+        cache = self._read_cache()
+        entry = cache.get(cache_key, {}).get(key)
+        if entry and entry["value"] and entry["expires_at"] > time.time():
+            return entry["value"]
+        value = self._resolvers[key]()
+        if not value:
+            # Not created yet e.g. before terraform apply, look again next time
+            log.warning(f"{key} not found in AWS")
+            return value
+        log.info(f"Resolved {key} from AWS")
+        cache.setdefault(cache_key, {})[key] = {
+            "value": value,
+            "expires_at": time.time() + SHARED_CONSTS_CACHE_TTL,
+        }
+        self._write_cache(cache)
+        return value
+
+    def _read_terraform_output(self, key: str) -> str:
+        name = TERRAFORM_OUTPUT_NAMES.get(key)
+        if name is None or not os.path.exists(TERRAFORM_OUTPUTS_PATH):
+            return ""
+        with open(TERRAFORM_OUTPUTS_PATH) as f:
+            return json.load(f).get(name, {}).get("value", "")
+
+    def _get_cache_key(self) -> str:
+        account_id = boto3.client("sts").get_caller_identity()["Account"]
+        return f"{account_id}:{AWS_REGION}"
+
+    def _read_cache(self) -> dict:
+        try:
+            with open(SHARED_CONSTS_CACHE_PATH) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_cache(self, cache: dict) -> None:
+        tmp_path = f"{SHARED_CONSTS_CACHE_PATH}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, SHARED_CONSTS_CACHE_PATH)
+
+
+_shared_consts = None
+_shared_consts_lock = threading.Lock()
+
+
+def get_shared_consts() -> SharedConsts:
+    global _shared_consts
+    with _shared_consts_lock:
+        if _shared_consts is None:
+            _shared_consts = SharedConsts()
+        return _shared_consts
+
+
+class LazyClient:
+    """
+    Stands in for a boto3 client and creates it on first use, so importing
+    a script doesn't pay for building clients it may never call
+    """
+
+    def __init__(self, service: str):
+        self._service = service
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = boto3.client(self._service, region_name=AWS_REGION)
+        return getattr(self._client, name)
+
+
+_opensearch_auth = None
+
+
+def get_opensearch_auth():
+    """
+    Returns AWS4Auth for signing OpenSearch Serverless requests
+    """
+    global _opensearch_auth
+    if _opensearch_auth is None:
+        from requests_aws4auth import AWS4Auth
+
+        credentials = boto3.Session().get_credentials()
+        _opensearch_auth = AWS4Auth(
+            credentials.access_key,
+            credentials.secret_key,
+            AWS_REGION,
+            "aoss",
+            session_token=credentials.token,
+        )
+    return _opensearch_auth
 
 
 #############################################
 # Helper Functions
 #############################################
-def wait_for_operation(method, check_keys, expected_value, timeout, **kwargs):
+def get_response_value(response: dict, check_keys: list):
+    return (
+        response[check_keys[0]]
+        if len(check_keys) == 1
+        else response[check_keys[0]][check_keys[1]]
+    )
+
+
+def wait_for_operation(
+    method, check_keys, expected_value, timeout, failure_values=(), **kwargs
+) -> float:
     """
     Waits for an AWS operation to complete by checking a specific key in the response.
+    Returns the elapsed seconds and raises WaiterError on timeout or failure.
 
-    :param client: The boto3 client
     :param method: The client method to call (e.g., client.list_data_sources)
-    :param check_key: The key in the response to check (e.g., "dataSourceSummaries")
+    :param check_keys: The keys in the response to check (e.g., ["dataSourceSummaries"])
     :param expected_value: The value of the check_key that indicates completion (e.g., empty list)
     :param timeout: Timeout in seconds
+    :param failure_values: Values of the check_key that mean the operation failed
     :param kwargs: Additional arguments to pass to the method
     """
-    start_time = time.time()
-    while True:
-        if time.time() - start_time > timeout:
-            log.error(f"Wait operation failed to complete after '{timeout}' seconds")
-            exit(1)
-        response = method(**kwargs)
-        val = (
-            response[check_keys[0]]
-            if len(check_keys) == 1
-            else response[check_keys[0]][check_keys[1]]
-        )
-        if val == expected_value:
-            log.info("Operation completed successfully")
-            break
-        else:
-            log.info("Operation is still in progress...")
-            time.sleep(10)
 
+    def probe():
+        val = get_response_value(method(**kwargs), check_keys)
+        if val in failure_values:
+            raise WaiterError(f"{method.__name__} reached '{val}'")
+        return val == expected_value
+
+    return waiters.wait_until(probe, method.__name__, timeout)
 
-def wait_for_resource_to_not_exist(
-    client, method, check_keys, expected_value, timeout, **kwargs
-):
+
+def wait_for_resource_to_not_exist(client, method, timeout, **kwargs) -> float:
     """
     Waits for an AWS resource to be deleted by checking it's not found.
+    Returns the elapsed seconds and raises WaiterError on timeout.
     """
-    start_time = time.time()
-    while True:
-        if time.time() - start_time > timeout:
-            log.error(f"Delete operation failed to complete after '{timeout}' seconds")
-            exit(1)
+
+    def probe():
         try:
-            response = method(**kwargs)
-            val = (
-                response[check_keys[0]]
-                if len(check_keys) == 1
-                else response[check_keys[0]][check_keys[1]]
-            )
-            if val == expected_value:
-                log.info("Resource is still deleting...")
-                time.sleep(10)
+            method(**kwargs)
         except client.exceptions.ResourceNotFoundException:
             log.info("Resource successfully deleted")
-            break
+            return True
+        return False
+
+    description = f"{method.__name__} to not find the resource"
+    return waiters.wait_until(probe, description, timeout)
 
 
 #############################################
 # Amazon Bedrock Functions
 #############################################
+# The chatbot's modules are imported where they are used so the scripts
+# only load the parts of it they call
+
+
 def get_knowledge_base_id(client, name: str) -> str:
-    response = client.list_knowledge_bases(maxResults=123)
-    for kb in response["knowledgeBaseSummaries"]:
-        if kb["name"] == name:
-            return kb["knowledgeBaseId"]
-    return ""
+    from flask_chatbot.utils.bedrock import get_knowledge_base_resolver
+
+    return get_knowledge_base_resolver(client).get(name)
+
+
+def invalidate_cached_answers(kb_id: str) -> None:
+    """
+    Drops the Flask app's shared cached answers for the knowledge base
+    """
+    from flask_chatbot.utils.cache import DEFAULT_SQLITE_PATH, ResponseCache
+
+    if os.path.exists(DEFAULT_SQLITE_PATH):
+        ResponseCache(sqlite_path=DEFAULT_SQLITE_PATH).invalidate_knowledge_base(kb_id)
+
+
+def ingest_data_source(client, kb_id: str, data_source_id: str) -> None:
+    """
+    Starts an ingestion job and waits for it to complete
+    """
+    response = client.start_ingestion_job(
+        knowledgeBaseId=kb_id,
+        dataSourceId=data_source_id,
+        description="Syncing S3 data source",
+    )
+    data = response["ingestionJob"]
+    log.info("Ingestion Job Started...")
+    log.info(f"Ingestion Job Status: {data['status']} ID: {data['ingestionJobId']}")
+
+    wait_for_operation(
+        client.get_ingestion_job,
+        ["ingestionJob", "status"],
+        "COMPLETE",
+        700,
+        failure_values=("FAILED",),
+        knowledgeBaseId=kb_id,
+        dataSourceId=data_source_id,
+        ingestionJobId=data["ingestionJobId"],
+    )
+    # Answers cached by the Flask app were generated from the old data
+    invalidate_cached_answers(kb_id)
 
 
 def get_knowledge_base_data_source_ids(client, kb_id: str) -> list[dict[str, str]]:
-    response = client.list_data_sources(knowledgeBaseId=kb_id, maxResults=123)
-    results = list()
-    for ds in response["dataSourceSummaries"]:
-        results.append(
-            {
-                "id": ds["dataSourceId"],
-                "name": ds["name"],
-            }
-        )
-    return results
+    from flask_chatbot.utils.inventory import iter_data_sources
+
+    return [
+        {
+            "id": ds["dataSourceId"],
+            "name": ds["name"],
+        }
+        for ds in iter_data_sources(client, kb_id)
+    ]
 
 
 def invoke_knowledge_base(client, prompt: str, kb_id: str, model_arn: str):
@@ -172,6 +360,22 @@ def check_if_os_policy_exists(client, policy_name: str, policy_type) -> bool:
             return False
 
 
+def get_opensearch_collection_client(host: str):
+    """
+    Returns a client for the collection's data plane (indices and documents)
+    """
+    from opensearchpy import OpenSearch, RequestsHttpConnection
+
+    return OpenSearch(
+        hosts=[{"host": host, "port": 443}],
+        http_auth=get_opensearch_auth(),
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection,
+        timeout=300,
+    )
+
+
 def get_opensearch_collection(client, name: str):
     response = client.batch_get_collection(names=[name])
     for collection in response["collectionDetails"]:
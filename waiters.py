@@ -0,0 +1,54 @@
+"""
+Readiness waiters for the provisioning scripts.
+
+Instead of fixed sleeps, each wait polls a probe with exponential backoff
+and jitter, so a stage finishes as soon as AWS reports it ready.
+Waiters raise WaiterError on timeout or failure rather than exiting, so
+the step scheduler in provisioning.py can stop cleanly.
+"""
+import random
+import time
+
+from loguru import logger as log
+
+
+class WaiterError(Exception):
+    """
+    Raised when a resource doesn't become ready before the timeout or
+    reaches a failure state
+    """
+
+
+def wait_until(
+    probe,
+    description: str,
+    timeout: float,
+    initial_delay: float = 1,
+    max_delay: float = 30,
+    factor: float = 2,
+) -> float:
+    """
+    Calls probe() until it returns a truthy value and returns the elapsed
+    seconds. The delay between attempts grows exponentially, with half of it
+    jittered so concurrent waiters don't poll in lockstep.
+
+    :param probe: Callable returning truthy when ready. May raise WaiterError to stop early
+    :param description: What is being waited for, used in logs and errors
+    :param timeout: Timeout in seconds
+    """
+    start_time = time.monotonic()
+    delay = initial_delay
+    attempt = 1
+    while True:
+        if probe():
+            elapsed = time.monotonic() - start_time
+            log.info(f"{description} ready after {elapsed:.1f}s ({attempt} checks)")
+            return elapsed
+        elapsed = time.monotonic() - start_time
+        if elapsed >= timeout:
+            raise WaiterError(f"{description} not ready after {timeout} seconds")
+        sleep = min(delay / 2 + random.uniform(0, delay / 2), timeout - elapsed)
+        log.info(f"Waiting for {description}... ({elapsed:.0f}s elapsed)")
+        time.sleep(sleep)
+        delay = min(delay * factor, max_delay)
+        attempt += 1